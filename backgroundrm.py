@@ -1,7 +1,20 @@
 import os
+import sys
+import csv
+import time
+import tempfile
+import threading
+import cv2
+import numpy as np
 import replicate
 import requests
-from io import BytesIO
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from download_cache import fetch_bytes
+from instrumentation import span, count
+from scheduler import get_scheduler, ProviderUnavailable
+from image_selector import ProductImageSelector
+from product_store import PROCESSED_IMAGES_DIR
 from PIL import Image
 import logging
 
@@ -9,17 +22,92 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-class BackgroundRemover:
-    def __init__(self):
-        self.api_token = os.getenv("REPLICATE_API_TOKEN")
-        if not self.api_token:
-            raise ValueError("Replicate API token not found. Please set REPLICATE_API_TOKEN environment variable.")
-        os.environ["REPLICATE_API_TOKEN"] = self.api_token
+REPLICATE_MODEL = "851-labs/background-remover:a029dff38972b5fda4ec5d75d7d1cd25aeff621d2cf4946a41055d7db66b80bc"
 
-    def remove_background(self, image_url, output_path):
+ENGINES = ("replicate", "local", "auto")
+
+DEFAULT_MAX_PREDICTIONS = 8
+DEFAULT_PREDICTION_TIMEOUT = 300
+
+
+class PredictionFailed(Exception):
+    """Raised when a Replicate prediction fails, is canceled or times out."""
+
+
+class PredictionQueue:
+    """
+    Runs background-removal predictions on Replicate without blocking per image.
+
+    submit() queues an image and returns a Future. One poller thread creates up
+    to `max_in_flight` predictions at a time, polls them together every
+    `poll_interval` seconds, cancels any that run longer than `timeout`, and
+    hands finished outputs to a small thread pool that streams them to disk.
+
+    Creates go through the scheduler's "replicate" limits and status polls
+    through the separate "replicate_poll" ones, so polling never uses up the
+    budget for new predictions. A prediction whose status cannot be read is
+    canceled before its Future fails, so it does not keep running unseen.
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_PREDICTIONS, timeout=DEFAULT_PREDICTION_TIMEOUT,
+                 poll_interval=None, download_workers=4):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.poll_interval = poll_interval or float(os.getenv("REPLICATE_POLL_INTERVAL", 0.5))
+        self.version = REPLICATE_MODEL.split(":", 1)[1]
+        self._pending = deque()
+        self._active = []
+        self._condition = threading.Condition()
+        self._downloads = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="replicate-output")
+        self._thread = None
+
+    def submit(self, image_url, output_path):
+        """
+        Queue one image.
+
+        Returns:
+            Future: Resolves to `output_path` once the result is written, or raises
+                PredictionFailed / scheduler.ProviderUnavailable
+        """
+        future = Future()
+        with self._condition:
+            self._pending.append((image_url, output_path, future))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="replicate-poller", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._active:
+                    # Let the thread exit when idle; submit() starts a new one
+                    if not self._condition.wait(timeout=30):
+                        if not self._pending and not self._active:
+                            self._thread = None
+                            return
+                starting = []
+                while self._pending and len(self._active) + len(starting) < self.max_in_flight:
+                    starting.append(self._pending.popleft())
+
+            for job in starting:
+                self._start(job)
+            self._poll()
+
+            with self._condition:
+                if self._active:
+                    self._condition.wait(timeout=self.poll_interval)
+
+    def _start(self, job):
+        image_url, output_path, future = job
+        if not future.set_running_or_notify_cancel():
+            return
         try:
-            output = replicate.run(
-                "851-labs/background-remover:a029dff38972b5fda4ec5d75d7d1cd25aeff621d2cf4946a41055d7db66b80bc",
+            count("api_calls.replicate")
+            prediction = get_scheduler().call(
+                "replicate", replicate.predictions.create,
+                version=self.version,
                 input={
                     "image": image_url,
                     "format": "png",
@@ -28,28 +116,291 @@ class BackgroundRemover:
                     "background_type": "rgba"
                 }
             )
-            
-            # Download the processed image
-            response = requests.get(output)
-            if response.status_code == 200:
-                img = Image.open(BytesIO(response.content))
-                img.save(output_path)
-                logger.info(f"Background removed image saved to {output_path}")
-                return True
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self._active.append((prediction, output_path, future, time.monotonic()))
+
+    def _cancel(self, prediction):
+        try:
+            get_scheduler().call("replicate", prediction.cancel)
+            count("replicate.canceled")
+        except Exception as e:
+            logger.warning(f"Could not cancel prediction {prediction.id}: {e}")
+
+    def _poll(self):
+        still_running = []
+        for prediction, output_path, future, started in self._active:
+            try:
+                if prediction.status not in ("succeeded", "failed", "canceled"):
+                    count("replicate.polls")
+                    get_scheduler().call("replicate_poll", prediction.reload)
+            except Exception as e:
+                # We stop tracking it, so make sure it stops running (and billing) too
+                self._cancel(prediction)
+                future.set_exception(e)
+                continue
+
+            if prediction.status == "succeeded":
+                count("replicate.seconds", time.monotonic() - started)
+                self._downloads.submit(self._save_output, prediction.output, output_path, future)
+            elif prediction.status in ("failed", "canceled"):
+                future.set_exception(PredictionFailed(f"Prediction {prediction.id} {prediction.status}: {prediction.error}"))
+            elif time.monotonic() - started > self.timeout:
+                self._cancel(prediction)
+                future.set_exception(PredictionFailed(f"Prediction {prediction.id} timed out after {self.timeout}s"))
             else:
-                logger.error(f"Failed to download processed image: {response.status_code}")
-                return False
-                
+                still_running.append((prediction, output_path, future, started))
+        self._active = still_running
+
+    def _save_output(self, output, output_path, future):
+        """Stream the prediction output to `output_path` (written atomically)."""
+        output_url = output[0] if isinstance(output, list) else getattr(output, "url", output)
+        try:
+            with span("replicate.download"):
+                get_scheduler().call("download", _stream_to_file, output_url, output_path)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        future.set_result(output_path)
+
+
+def _stream_to_file(url, output_path, timeout=60):
+    directory = os.path.dirname(output_path) or "."
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    tmp.write(chunk)
+                    count("download.bytes", len(chunk))
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+_prediction_queue = None
+_prediction_queue_lock = threading.Lock()
+
+
+def get_prediction_queue():
+    """
+    Return the process-wide prediction queue.
+
+    Configured through REPLICATE_MAX_PREDICTIONS (predictions in flight) and
+    REPLICATE_PREDICTION_TIMEOUT (seconds) environment variables.
+    """
+    global _prediction_queue
+    with _prediction_queue_lock:
+        if _prediction_queue is None:
+            _prediction_queue = PredictionQueue(
+                max_in_flight=int(os.getenv("REPLICATE_MAX_PREDICTIONS", DEFAULT_MAX_PREDICTIONS)),
+                timeout=float(os.getenv("REPLICATE_PREDICTION_TIMEOUT", DEFAULT_PREDICTION_TIMEOUT))
+            )
+        return _prediction_queue
+
+
+class BackgroundRemover:
+    """
+    Removes image backgrounds with one of three engines:
+    - "replicate": the remote Replicate model (default)
+    - "local": an on-CPU cut-out for images on bright, uniform backgrounds
+    - "auto": the local engine, falling back to Replicate when its mask confidence
+      is below `min_local_confidence`
+    """
+
+    def __init__(self, engine="replicate", min_local_confidence=0.6, grabcut_max_side=800):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown background removal engine: {engine}. Choose one of {', '.join(ENGINES)}.")
+        self.engine = engine
+        self.min_local_confidence = min_local_confidence
+        self.grabcut_max_side = grabcut_max_side
+        self.api_token = os.getenv("REPLICATE_API_TOKEN")
+        if engine == "replicate" and not self.api_token:
+            raise ValueError("Replicate API token not found. Please set REPLICATE_API_TOKEN environment variable.")
+        if self.api_token:
+            os.environ["REPLICATE_API_TOKEN"] = self.api_token
+
+    def remove_background(self, image_url, output_path):
+        if self.engine == "replicate":
+            return self.remove_background_replicate(image_url, output_path)
+
+        try:
+            data = fetch_bytes(image_url, timeout=30)
+            with span("background.local"):
+                cutout, confidence = self.local_cutout(data)
+        except Exception as e:
+            logger.error(f"Error removing background locally: {str(e)}")
+            cutout, confidence = None, 0
+
+        if cutout is not None and (self.engine == "local" or confidence >= self.min_local_confidence):
+            cutout.save(output_path)
+            logger.info(f"Background removed locally (confidence {confidence:.2f}), saved to {output_path}")
+            return True
+
+        if self.engine == "local":
+            logger.error(f"Local background removal found no object in {image_url}")
+            return False
+        if not self.api_token:
+            logger.error("Local mask confidence too low and REPLICATE_API_TOKEN is not set for the fallback.")
+            return False
+        logger.info(f"Local mask confidence {confidence:.2f} below {self.min_local_confidence}, using Replicate")
+        count("background.local_fallbacks")
+        return self.remove_background_replicate(image_url, output_path)
+
+    def remove_background_replicate(self, image_url, output_path):
+        """Run the Replicate model through the shared prediction queue and wait for the result."""
+        try:
+            with span("replicate.run"):
+                get_prediction_queue().submit(image_url, output_path).result()
+            logger.info(f"Background removed image saved to {output_path}")
+            return True
+
+        except ProviderUnavailable:
+            raise
+        except requests.HTTPError as e:
+            logger.error(f"Failed to download processed image: {e.response.status_code}")
+            return False
         except Exception as e:
             logger.error(f"Error removing background: {str(e)}")
             return False
 
-def process_image(image_url, output_filename):
-    remover = BackgroundRemover()
-    output_path = f"processed_images/{output_filename}"
-    
+    def local_cutout(self, data):
+        """
+        Cut the main object out of an image on a bright background
+
+        Bright regions connected to the image border are taken as certain background
+        (a flood fill from the border over the selector's background mask), the
+        largest contour from ProductImageSelector.get_object_size seeds the probable
+        foreground, and GrabCut refines the boundary on a downscaled copy.
+
+        Returns:
+            tuple: (RGBA PIL image or None, confidence between 0 and 1). Confidence
+                combines how much of the border is clean background with how well the
+                GrabCut foreground agrees with the seeding contour.
+        """
+        selector = ProductImageSelector(max_pixels=None)
+        img = selector.decode_image(data)
+        gray = selector.to_gray(img)
+        has_bright_bg, _, background_mask = selector.check_background_brightness(img, gray)
+        _, _, largest_contour = selector.get_object_size(img, background_mask)
+        if largest_contour is None:
+            return None, 0
+
+        height, width = gray.shape
+        # Flood fill from the border: bright components touching an edge are background
+        _, labels = cv2.connectedComponents((background_mask > 0).astype(np.uint8), connectivity=4)
+        border_labels = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+        border_labels = border_labels[border_labels != 0]
+        sure_background = np.isin(labels, border_labels)
+
+        seed = np.zeros((height, width), np.uint8)
+        cv2.drawContours(seed, [largest_contour], -1, 255, thickness=cv2.FILLED)
+
+        grabcut_mask = np.full((height, width), cv2.GC_PR_BGD, np.uint8)
+        grabcut_mask[seed > 0] = cv2.GC_PR_FGD
+        grabcut_mask[sure_background] = cv2.GC_BGD
+
+        scale = min(1.0, self.grabcut_max_side / max(height, width))
+        small_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        small_img = cv2.resize(img, small_size, interpolation=cv2.INTER_AREA) if scale < 1 else img
+        small_mask = cv2.resize(grabcut_mask, small_size, interpolation=cv2.INTER_NEAREST) if scale < 1 else grabcut_mask
+
+        if np.any(np.isin(small_mask, (cv2.GC_FGD, cv2.GC_PR_FGD))) and np.any(np.isin(small_mask, (cv2.GC_BGD, cv2.GC_PR_BGD))):
+            bgd_model = np.zeros((1, 65), np.float64)
+            fgd_model = np.zeros((1, 65), np.float64)
+            cv2.grabCut(small_img, small_mask, None, bgd_model, fgd_model, 3, cv2.GC_INIT_WITH_MASK)
+
+        foreground = np.isin(small_mask, (cv2.GC_FGD, cv2.GC_PR_FGD)).astype(np.uint8) * 255
+        if scale < 1:
+            foreground = cv2.resize(foreground, (width, height), interpolation=cv2.INTER_LINEAR)
+        alpha = cv2.GaussianBlur(foreground, (3, 3), 0)
+
+        border = np.concatenate([sure_background[0], sure_background[-1], sure_background[:, 0], sure_background[:, -1]])
+        border_background = border.mean()
+        foreground_bool = foreground > 127
+        seed_bool = seed > 0
+        union = np.count_nonzero(foreground_bool | seed_bool)
+        agreement = np.count_nonzero(foreground_bool & seed_bool) / union if union else 0
+        confidence = float(border_background * agreement) if has_bright_bg else 0.0
+
+        rgba = cv2.cvtColor(img, cv2.COLOR_BGR2RGBA)
+        rgba[:, :, 3] = alpha
+        return Image.fromarray(rgba), confidence
+
+
+_removers = {}
+_removers_lock = threading.Lock()
+
+
+def get_remover(engine=None):
+    """Return a shared BackgroundRemover for an engine (defaults to BACKGROUND_ENGINE, then "replicate")."""
+    engine = engine or os.getenv("BACKGROUND_ENGINE", "replicate")
+    with _removers_lock:
+        if engine not in _removers:
+            _removers[engine] = BackgroundRemover(engine=engine)
+        return _removers[engine]
+
+
+def process_image(image_url, output_filename, engine=None, output_dir=None):
+    """
+    Remove the background of an image and save it under processed_images/
+
+    Args:
+        image_url (str): Image to process
+        output_filename (str): File name inside the output directory
+        engine (str): "replicate", "local" or "auto" (defaults to the BACKGROUND_ENGINE
+            environment variable, then "replicate")
+        output_dir (str): Output directory (defaults to PROCESSED_IMAGES_DIR)
+    """
+    remover = get_remover(engine)
+    output_dir = output_dir or PROCESSED_IMAGES_DIR
+    output_path = os.path.join(output_dir, output_filename)
+
     # Create output directory if it doesn't exist
-    os.makedirs("processed_images", exist_ok=True)
-    
+    os.makedirs(output_dir, exist_ok=True)
+
     success = remover.remove_background(image_url, output_path)
     return output_path if success else None
+
+
+def process_images(items, engine=None, workers=16):
+    """
+    Remove the backgrounds of many images at once
+
+    Replicate predictions for all images are in flight together (up to the
+    prediction queue's cap) instead of one after another.
+
+    Args:
+        items (iterable): (image_url, output_filename) pairs
+        engine (str): Background removal engine (see process_image)
+        workers (int): Images handled concurrently (local cut-outs run on these threads)
+
+    Returns:
+        list: Output path or None per item, in input order
+    """
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items) or 1))) as executor:
+        futures = [executor.submit(process_image, image_url, filename, engine) for image_url, filename in items]
+    results = []
+    for (image_url, _), future in zip(items, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f"Error removing background of {image_url}: {e}")
+            results.append(None)
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python backgroundrm.py <best_images_csv> [engine]")
+        sys.exit(1)
+
+    with open(sys.argv[1], "r", newline="") as infile:
+        rows = list(csv.DictReader(infile))
+    items = [(row["image_url"], f"{row['brand']}_{row['product_name'].replace(' ', '_')}.png") for row in rows]
+    paths = process_images(items, engine=sys.argv[2] if len(sys.argv) == 3 else None)
+    print(f"Processed {sum(1 for path in paths if path)} of {len(items)} images")
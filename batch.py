@@ -0,0 +1,215 @@
+import os
+import sys
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from openai_client import get_openai_client
+from pipeline import process_product, PipelineError, ProductSkipped
+from product_store import open_store, PROCESSED_IMAGES_DIR
+from backgroundrm import ENGINES
+from response_cache import report_cache_stats
+from instrumentation import profiling
+from taxonomy_classifier import train_from_store, learn
+from scheduler import get_scheduler, DEFAULT_PROVIDER_LIMITS
+from shards import parse_shard, select_shard, shard_dir, DEFAULT_SHARD_ROOT, SHARD_STORE
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def read_manifest(path):
+    """
+    Read image URLs from a manifest file, one per line.
+
+    Args:
+        path (str): Path to the manifest, or "-" to read from stdin
+
+    Returns:
+        list: Image URLs, skipping blank lines and lines starting with '#'
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r") as infile:
+            lines = infile.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+
+def process_url(image_url, client, store, enrichment="stepwise", force=False, selector_options=None,
+                background_engine=None, image_dir=None, resume=None):
+    """
+    Process one image URL and store the product, never raising.
+
+    Args:
+        image_url (str): URL of the product photo
+        client (OpenAI): Shared OpenAI client
+        store (ProductStore): Catalog the record is written to
+        enrichment (str): Text enrichment mode passed to process_product
+        force (bool): Reprocess the product even if it is already in the store
+        selector_options (dict): Extra keyword arguments for ProductImageSelector
+        background_engine (str): Background removal engine passed to process_product
+        image_dir (str): Directory for processed images (defaults to processed_images/)
+        resume (bool): Reuse the saved stage checkpoints (default: unless `force`)
+
+    Returns:
+        dict: Outcome with "status" ("ok", "skipped", "failed" or "error"), the failed
+            "stage" and "error", the stored "record", the "resumed" stages and "seconds"
+    """
+    started = time.monotonic()
+    outcome = {"image_url": image_url, "status": "ok", "stage": None, "error": None, "resumed": []}
+    try:
+        existing = None if force else store.get_by_source(image_url)
+        if existing:
+            outcome.update(status="skipped", record=existing,
+                           product=f"{existing['brand']} - {existing['product_name']}")
+        else:
+            job = store.job(image_url, resume=not force if resume is None else resume)
+            outcome["resumed"] = job.resumed
+
+            def save(record):
+                store.add(record, source_image_url=image_url)
+                learn(record)
+
+            record = process_product(client, image_url, enrichment=enrichment,
+                                     store=None if force else store, selector_options=selector_options,
+                                     background_engine=background_engine, job=job, image_dir=image_dir, save=save)
+            outcome.update(record=record, product=f"{record['brand']} - {record['product_name']}")
+    except ProductSkipped as e:
+        store.add(e.record, source_image_url=image_url)
+        outcome.update(status="skipped", record=e.record,
+                       product=f"{e.record['brand']} - {e.record['product_name']}")
+    except PipelineError as e:
+        outcome.update(status="failed", stage=e.stage, error=str(e))
+    except Exception as e:
+        logger.exception(f"Unexpected error processing {image_url}")
+        outcome.update(status="error", error=str(e))
+    outcome["seconds"] = time.monotonic() - started
+    return outcome
+
+
+def run_batch(image_urls, client, store, workers=8, limits=None, enrichment="stepwise", force=False,
+              selector_options=None, background_engine=None, image_dir=None, resume=None):
+    """
+    Process many product images concurrently.
+
+    Args:
+        image_urls (list): Image URLs to process
+        client (OpenAI): Shared OpenAI client
+        store (ProductStore): Catalog the records are written to
+        workers (int): Number of products in flight at once
+        limits (dict): Provider name -> max concurrent calls, applied to the shared
+            scheduler (unset providers keep its defaults, see scheduler.py)
+        enrichment (str): Text enrichment mode passed to process_product
+        force (bool): Reprocess products that are already in the store
+        selector_options (dict): Extra keyword arguments for ProductImageSelector
+        background_engine (str): Background removal engine passed to process_product
+        image_dir (str): Directory for processed images (defaults to processed_images/)
+        resume (bool): Reuse the saved stage checkpoints (default: unless `force`)
+
+    Returns:
+        list: One outcome dict per image URL, in manifest order; "resumed" lists the
+            stages whose saved checkpoint was reused
+    """
+    # The local category classifier starts from the catalog and learns from each new product
+    train_from_store(store)
+    scheduler = get_scheduler()
+    for provider, max_in_flight in (limits or {}).items():
+        if max_in_flight:
+            scheduler.configure(provider, max_in_flight=max_in_flight)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda image_url: process_url(image_url, client, store, enrichment=enrichment, force=force,
+                                          selector_options=selector_options, background_engine=background_engine,
+                                          image_dir=image_dir, resume=resume),
+            image_urls))
+
+
+def print_report(outcomes, elapsed):
+    """Print per-product outcomes and overall throughput."""
+    print("\nPer-product outcomes:")
+    for outcome in outcomes:
+        detail = outcome.get("product") or f"{outcome['stage'] or 'unexpected'}: {outcome['error']}"
+        if outcome.get("resumed"):
+            detail += f" (resumed, skipped {', '.join(outcome['resumed'])})"
+        print(f"  [{outcome['status']}] {outcome['image_url']} ({outcome['seconds']:.1f}s) {detail}")
+
+    succeeded = sum(1 for outcome in outcomes if outcome["status"] == "ok")
+    skipped = sum(1 for outcome in outcomes if outcome["status"] == "skipped")
+    failed = len(outcomes) - succeeded - skipped
+    print(f"\nProcessed {len(outcomes)} products in {elapsed:.1f}s: {succeeded} ok, {skipped} skipped, {failed} failed")
+    resumed_stages = sum(len(outcome.get("resumed") or ()) for outcome in outcomes)
+    if resumed_stages:
+        print(f"Resumed from checkpoints: {resumed_stages} stages skipped")
+    if elapsed > 0:
+        print(f"Throughput: {len(outcomes) / elapsed * 60:.1f} products/min")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the product pipeline over a manifest of image URLs.")
+    parser.add_argument("manifest", help="File with one image URL per line, or '-' for stdin")
+    parser.add_argument("--workers", type=int, default=8, help="Products processed concurrently")
+    parser.add_argument("--store", default=None, help="Product store database (default products.db, or the shard's own)")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="Only process shard I of N of the manifest, in its own working directory "
+                             "(merge the shards afterwards with shards.py)")
+    parser.add_argument("--shard-root", default=DEFAULT_SHARD_ROOT, help="Parent directory of the shard working directories")
+    parser.add_argument("--download-workers", type=int, default=8, help="Candidate images downloaded concurrently per product")
+    parser.add_argument("--scoring-workers", type=int, default=os.cpu_count() or 1,
+                        help="Processes shared by all products for image scoring (0 scores in-thread)")
+    parser.add_argument("--background-engine", choices=ENGINES, default=None,
+                        help="Background removal engine (default: BACKGROUND_ENGINE or replicate)")
+    parser.add_argument("--early-exit", action="store_true",
+                        help="Stop evaluating candidate images once one meets the quality thresholds")
+    parser.add_argument("--force", action="store_true", help="Reprocess products that are already stored")
+    parser.add_argument("--export-csv", metavar="PATH", help="Export the catalog as CSV after the run (e.g. data.csv)")
+    parser.add_argument("--enrichment", choices=["stepwise", "structured"], default="stepwise",
+                        help="Generate description and categories with three prompts or one structured call")
+    for provider, settings in DEFAULT_PROVIDER_LIMITS.items():
+        parser.add_argument(f"--{provider}-limit", type=int, default=None,
+                            help=f"Max concurrent {provider} calls (default {settings['max_in_flight']}, "
+                                 f"or {provider.upper()}_MAX_IN_FLIGHT)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write per-stage timings and counters to PATH (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args()
+
+    client = get_openai_client()
+
+    image_urls = read_manifest(args.manifest)
+    limits = {provider: getattr(args, f"{provider}_limit") for provider in DEFAULT_PROVIDER_LIMITS}
+
+    image_dir = None
+    if args.shard:
+        # Each shard keeps its catalog and images in its own directory; the .cache/ caches stay shared
+        index, count = args.shard
+        workdir = shard_dir(args.shard_root, index, count)
+        os.makedirs(workdir, exist_ok=True)
+        total = len(image_urls)
+        image_urls = select_shard(image_urls, index, count)
+        image_dir = os.path.join(workdir, PROCESSED_IMAGES_DIR)
+        store = open_store(args.store or os.path.join(workdir, SHARD_STORE), legacy_csv=None)
+        print(f"Shard {index}/{count}: {len(image_urls)} of {total} manifest entries, working in {workdir}")
+    else:
+        store = open_store(args.store or "products.db")
+
+    started = time.monotonic()
+    with profiling(args.profile):
+        outcomes = run_batch(image_urls, client, store, workers=args.workers, limits=limits,
+                             enrichment=args.enrichment, force=args.force,
+                             selector_options={"download_workers": args.download_workers,
+                                               "scoring_workers": args.scoring_workers,
+                                               "early_exit": args.early_exit},
+                             background_engine=args.background_engine, image_dir=image_dir)
+    print_report(outcomes, time.monotonic() - started)
+    if args.export_csv:
+        store.export_csv(args.export_csv)
+    report_cache_stats()
+
+
+if __name__ == "__main__":
+    main()
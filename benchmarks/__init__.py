@@ -0,0 +1 @@
+"""Offline benchmark harness: fake API services, fixture photos and the benchmark runner."""
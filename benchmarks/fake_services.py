@@ -0,0 +1,426 @@
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from io import BytesIO
+from email.parser import BytesParser
+from email.policy import HTTP
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from category1 import CATEGORIES
+from category2 import CATEGORY_HIERARCHY
+from benchmarks.fixtures import generate_corpus
+
+DEFAULT_LATENCY = {
+    "openai": 0.4,
+    "google": 0.25,
+    "replicate": 1.5,
+    "images": 0.05,
+    "batch": 1.0,  # time until a submitted Batch API job completes
+}
+
+
+def _stable_hash(text):
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16)
+
+
+class FakeServices:
+    """
+    Local stand-ins for the OpenAI chat completions, files and batches APIs, Google
+    Custom Search, Replicate predictions and the image hosts search results point to.
+
+    Every provider gets a configurable mean latency (jittered +/-50%) and error rate.
+    Failed API calls answer 429 with a Retry-After header; failed image downloads
+    answer 503 and failed prediction status reads ("replicate_poll") answer 500. Responses are deterministic for a given request, so runs are
+    comparable.
+
+    Usage:
+        with FakeServices(latency={"openai": 0.2}) as services:
+            os.environ.update(services.env())
+            ...
+    """
+
+    def __init__(self, latency=None, error_rate=None, corpus=None, seed=0, host="127.0.0.1", port=0):
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.error_rate = {provider: 0.0 for provider in DEFAULT_LATENCY}
+        self.error_rate.update(error_rate or {})
+        self.corpus = corpus or generate_corpus(seed=seed)
+        self.requests = Counter()
+        self.errors = Counter()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._predictions = {}
+        self._files = {}
+        self._batches = {}
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        """Environment variables that point the pipeline modules at these fakes."""
+        return {
+            "OPENAI_API_KEY": "fake-openai-key",
+            "OPENAI_BASE_URL": f"{self.base_url}/v1",
+            "GOOGLE_API_KEY": "fake-google-key",
+            "GOOGLE_CX": "fake-cx",
+            "GOOGLE_SEARCH_URL": f"{self.base_url}/customsearch/v1",
+            "REPLICATE_API_TOKEN": "fake-replicate-token",
+            "REPLICATE_BASE_URL": self.base_url,
+            "REPLICATE_POLL_INTERVAL": "0.05",
+        }
+
+    def image_url(self, name):
+        return f"{self.base_url}/images/{name}"
+
+    def product_photo_urls(self, count):
+        """Input photo URLs for `count` distinct products."""
+        return [self.image_url(f"product-{index:05d}.jpg") for index in range(count)]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _delay(self, provider):
+        with self._rng_lock:
+            jitter = self._rng.uniform(0.5, 1.5)
+            failed = self._rng.random() < self.error_rate.get(provider, 0.0)
+        self.requests[provider] += 1
+        time.sleep(self.latency.get(provider, 0.0) * jitter)
+        if failed:
+            self.errors[provider] += 1
+        return failed
+
+    def _corpus_image(self, name):
+        return self.corpus[_stable_hash(name) % len(self.corpus)][1]
+
+    # --- OpenAI ---------------------------------------------------------------
+
+    def _chat_answer(self, body):
+        messages = body.get("messages", [])
+        texts, has_image, image_key = [], False, ""
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                texts.append(content)
+            elif isinstance(content, list):
+                for part in content:
+                    if part.get("type") == "text":
+                        texts.append(part["text"])
+                    elif part.get("type") == "image_url":
+                        has_image = True
+                        image_key = part["image_url"]["url"][-64:]
+        prompt = "\n".join(texts)
+
+        if has_image:
+            index = _stable_hash(image_key) % 5000
+            return json.dumps({"brand": f"Brand {index % 97}", "product_name": f"Product {index}"})
+
+        seed = _stable_hash(prompt)
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            category1 = list(CATEGORY_HIERARCHY)[seed % len(CATEGORY_HIERARCHY)]
+            subcategories = CATEGORY_HIERARCHY[category1]
+            return json.dumps({
+                "description": "A fake product description used for offline benchmarking.",
+                "category1": category1,
+                "category2": subcategories[seed % len(subcategories)],
+            })
+
+        main_category = re.search(r"^Main Category: (.+)$", prompt, re.MULTILINE)
+        if main_category and main_category.group(1) in CATEGORY_HIERARCHY:
+            subcategories = CATEGORY_HIERARCHY[main_category.group(1)]
+            return subcategories[seed % len(subcategories)]
+        if "select the most appropriate category" in prompt:
+            return CATEGORIES[seed % len(CATEGORIES)]
+        return ("A fake product description used for offline benchmarking. It is about as long as "
+                "a real one so that token counts and payload sizes stay realistic.")
+
+    def _chat_completion(self, body):
+        content = self._chat_answer(body)
+        prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _store_file(self, data, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex[:16]}"
+        self._files[file_id] = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+            "data": data,
+        }
+        return {key: value for key, value in self._files[file_id].items() if key != "data"}
+
+    def _create_batch(self, body):
+        self.requests["batch"] += 1
+        with self._rng_lock:
+            jitter = self._rng.uniform(0.5, 1.5)
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        self._batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint"),
+            "input_file_id": body.get("input_file_id"),
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "metadata": body.get("metadata"),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "ready_at": time.monotonic() + self.latency["batch"] * jitter,
+        }
+        return self._batch(batch_id)
+
+    def _run_batch(self, batch):
+        """Answer every request of a batch; requests failing at the "openai" error rate go to the error file."""
+        outputs, errors = [], []
+        for line in self._files[batch["input_file_id"]]["data"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            with self._rng_lock:
+                failed = self._rng.random() < self.error_rate.get("openai", 0.0)
+            if failed:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": request["custom_id"],
+                               "response": {"status_code": 429, "body": {"error": {"message": "Rate limit (fake)"}}},
+                               "error": None})
+                continue
+            outputs.append({"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": request["custom_id"],
+                            "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                         "body": self._chat_completion(request["body"])},
+                            "error": None})
+        for items, field in ((outputs, "output_file_id"), (errors, "error_file_id")):
+            if items:
+                data = "".join(json.dumps(item) + "\n" for item in items).encode("utf-8")
+                batch[field] = self._store_file(data, f"{batch['id']}_{field}.jsonl", "batch_output")["id"]
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        batch["status"] = "completed"
+
+    def _batch(self, batch_id):
+        batch = self._batches[batch_id]
+        if batch["status"] == "in_progress" and time.monotonic() >= batch["ready_at"]:
+            self._run_batch(batch)
+        return {key: value for key, value in batch.items() if key != "ready_at"}
+
+    # --- Google Custom Search -------------------------------------------------
+
+    def _search(self, params):
+        query = params.get("q", [""])[0]
+        start = int(params.get("start", ["1"])[0])
+        num = int(params.get("num", ["10"])[0])
+        slug = hashlib.sha256(query.encode("utf-8")).hexdigest()[:10]
+        return {"items": [
+            {"link": self.image_url(f"{slug}-{rank}.jpg"), "title": f"{query} #{rank}"}
+            for rank in range(start, start + num)
+        ]}
+
+    # --- Replicate ------------------------------------------------------------
+
+    def _prediction(self, prediction_id):
+        prediction = self._predictions[prediction_id]
+        done = time.monotonic() >= prediction["ready_at"]
+        return {
+            "id": prediction_id,
+            "model": "851-labs/background-remover",
+            "version": prediction["version"],
+            "status": "canceled" if prediction.get("canceled") else "succeeded" if done else "processing",
+            "input": prediction["input"],
+            "output": f"{self.base_url}/outputs/{prediction_id}.png" if done else None,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": prediction["created_at"],
+            "started_at": prediction["created_at"],
+            "completed_at": prediction["created_at"] if done else None,
+            "urls": {
+                "get": f"{self.base_url}/v1/predictions/{prediction_id}",
+                "cancel": f"{self.base_url}/v1/predictions/{prediction_id}/cancel",
+            },
+        }
+
+    def _create_prediction(self, body, wait):
+        with self._rng_lock:
+            jitter = self._rng.uniform(0.5, 1.5)
+            failed = self._rng.random() < self.error_rate.get("replicate", 0.0)
+        self.requests["replicate"] += 1
+        if failed:
+            self.errors["replicate"] += 1
+            return None
+        prediction_id = uuid.uuid4().hex[:16]
+        self._predictions[prediction_id] = {
+            "version": body.get("version", ""),
+            "input": body.get("input", {}),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "ready_at": time.monotonic() + self.latency["replicate"] * jitter,
+        }
+        if wait:
+            time.sleep(max(0.0, self._predictions[prediction_id]["ready_at"] - time.monotonic()))
+        return self._prediction(prediction_id)
+
+    def _prediction_output(self, prediction_id):
+        source_url = self._predictions[prediction_id]["input"].get("image", "")
+        source = self._corpus_image(urlparse(source_url).path.rsplit("/", 1)[-1])
+        img = Image.open(BytesIO(source)).convert("RGBA")
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    # --- HTTP plumbing ----------------------------------------------------------
+
+    def _make_handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=b"", content_type="application/json", headers=None):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _rate_limited(self):
+                self._send(429, {"error": {"message": "Rate limit exceeded (fake)", "type": "rate_limit"}},
+                           headers={"Retry-After": "1"})
+
+            def _json_body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                path = parsed.path
+                if path.startswith("/images/"):
+                    if services._delay("images"):
+                        return self._send(503, b"", content_type="text/plain")
+                    name = path[len("/images/"):]
+                    data = services._corpus_image(name)
+                    etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        return self._send(304, b"", content_type="image/jpeg", headers={"ETag": etag})
+                    return self._send(200, data, content_type="image/jpeg", headers={"ETag": etag})
+                if path == "/customsearch/v1":
+                    if services._delay("google"):
+                        return self._rate_limited()
+                    return self._send(200, services._search(parse_qs(parsed.query)))
+                if path.startswith("/v1/batches/"):
+                    batch_id = path.rsplit("/", 1)[-1]
+                    if batch_id not in services._batches:
+                        return self._send(404, {"error": {"message": "No such batch"}})
+                    return self._send(200, services._batch(batch_id))
+                if path.startswith("/v1/files/") and path.endswith("/content"):
+                    file_id = path.split("/")[-2]
+                    if file_id not in services._files:
+                        return self._send(404, {"error": {"message": "No such file"}})
+                    return self._send(200, services._files[file_id]["data"], content_type="application/octet-stream")
+                if path.startswith("/v1/predictions/"):
+                    prediction_id = path.rsplit("/", 1)[-1]
+                    if prediction_id not in services._predictions:
+                        return self._send(404, {"detail": "Not found"})
+                    if services._delay("replicate_poll"):
+                        return self._send(500, {"detail": "Internal server error"})
+                    return self._send(200, services._prediction(prediction_id))
+                if path.startswith("/v1/models/") and "/versions/" in path:
+                    return self._send(200, {
+                        "id": path.rsplit("/", 1)[-1],
+                        "created_at": "2024-01-01T00:00:00Z",
+                        "cog_version": "0.9.0",
+                        "openapi_schema": {},
+                    })
+                if path.startswith("/outputs/"):
+                    prediction_id = path.rsplit("/", 1)[-1].split(".")[0]
+                    if prediction_id not in services._predictions:
+                        return self._send(404, b"", content_type="text/plain")
+                    return self._send(200, services._prediction_output(prediction_id), content_type="image/png")
+                self._send(404, {"error": f"Unknown path {path}"})
+
+            def _multipart_body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                header = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode("utf-8")
+                message = BytesParser(policy=HTTP).parsebytes(header + self.rfile.read(length))
+                return {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                if path == "/v1/files":
+                    parts = self._multipart_body()
+                    upload = parts["file"]
+                    return self._send(200, services._store_file(upload.get_payload(decode=True), upload.get_filename(),
+                                                                parts["purpose"].get_content().strip()))
+                body = self._json_body()
+                if path == "/v1/batches":
+                    return self._send(200, services._create_batch(body))
+                if path.startswith("/v1/batches/") and path.endswith("/cancel"):
+                    batch_id = path.split("/")[-2]
+                    if batch_id not in services._batches:
+                        return self._send(404, {"error": {"message": "No such batch"}})
+                    services._batches[batch_id]["status"] = "cancelled"
+                    return self._send(200, services._batch(batch_id))
+                if path == "/v1/chat/completions":
+                    if services._delay("openai"):
+                        return self._rate_limited()
+                    return self._send(200, services._chat_completion(body))
+                if path == "/v1/predictions":
+                    prediction = services._create_prediction(body, wait="wait" in (self.headers.get("Prefer") or ""))
+                    if prediction is None:
+                        return self._rate_limited()
+                    return self._send(201, prediction)
+                if path.startswith("/v1/predictions/") and path.endswith("/cancel"):
+                    prediction_id = path.split("/")[-2]
+                    if prediction_id not in services._predictions:
+                        return self._send(404, {"detail": "Not found"})
+                    services.requests["replicate_cancel"] += 1
+                    services._predictions[prediction_id]["canceled"] = True
+                    return self._send(200, services._prediction(prediction_id))
+                self._send(404, {"error": f"Unknown path {path}"})
+
+        return Handler
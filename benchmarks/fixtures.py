@@ -0,0 +1,88 @@
+import os
+import random
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFilter
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def _product_shot(rng, width, height, background, busy):
+    """Draw a packaged product (box, bottle or pouch) with a printed label."""
+    img = Image.new("RGB", (width, height), background)
+    draw = ImageDraw.Draw(img)
+
+    if busy:
+        # Shelf-like clutter instead of a clean packshot background
+        for _ in range(40):
+            x, y = rng.randrange(width), rng.randrange(height)
+            size = rng.randrange(20, max(21, width // 4))
+            color = tuple(rng.randrange(30, 200) for _ in range(3))
+            draw.rectangle([x, y, x + size, y + size], fill=color)
+
+    fill = rng.uniform(0.25, 0.75)
+    object_w, object_h = int(width * fill * rng.uniform(0.5, 0.9)), int(height * fill)
+    left, top = (width - object_w) // 2, (height - object_h) // 2
+    color = tuple(rng.randrange(20, 220) for _ in range(3))
+    shape = rng.choice(["box", "bottle", "pouch"])
+    if shape == "box":
+        draw.rectangle([left, top, left + object_w, top + object_h], fill=color)
+    elif shape == "bottle":
+        neck = object_w // 3
+        draw.rectangle([left + neck, top, left + 2 * neck, top + object_h // 5], fill=color)
+        draw.rounded_rectangle([left, top + object_h // 5, left + object_w, top + object_h], radius=object_w // 6, fill=color)
+    else:
+        draw.ellipse([left, top, left + object_w, top + object_h], fill=color)
+
+    # Label with text and fine detail so sharpness scores are realistic
+    label_top = top + object_h // 3
+    draw.rectangle([left + object_w // 8, label_top, left + 7 * object_w // 8, label_top + object_h // 3], fill=(250, 245, 230))
+    for line in range(4):
+        y = label_top + 8 + line * max(10, object_h // 18)
+        draw.text((left + object_w // 6, y), "BRAND PRODUCT 250g", fill=(10, 10, 10))
+
+    if rng.random() < 0.3:
+        img = img.filter(ImageFilter.GaussianBlur(rng.uniform(0.8, 2.5)))
+    return img
+
+
+def generate_corpus(count=24, seed=0):
+    """
+    Generate a deterministic set of synthetic product photos.
+
+    About two thirds are clean packshots on white or off-white backgrounds and the
+    rest are on dark or cluttered backgrounds, so the selector has something to reject.
+
+    Returns:
+        list: (name, JPEG bytes) tuples
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(count):
+        width = rng.choice([480, 640, 800, 1024, 1200, 1600])
+        height = int(width * rng.choice([0.75, 1.0, 1.25]))
+        kind = rng.random()
+        if kind < 0.66:
+            level = rng.randrange(235, 256)
+            img = _product_shot(rng, width, height, (level, level, level), busy=False)
+        elif kind < 0.85:
+            level = rng.randrange(10, 90)
+            img = _product_shot(rng, width, height, (level, level, level), busy=False)
+        else:
+            img = _product_shot(rng, width, height, (200, 190, 170), busy=True)
+
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=rng.choice([70, 85, 92]))
+        corpus.append((f"fixture_{index:03d}.jpg", buffer.getvalue()))
+    return corpus
+
+
+def load_corpus(directory):
+    """Load real product photos from a directory as (name, bytes) tuples."""
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(directory, name), "rb") as image_file:
+                corpus.append((name, image_file.read()))
+    if not corpus:
+        raise ValueError(f"No images found in {directory}")
+    return corpus
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.fake_services import FakeServices, DEFAULT_LATENCY
+from benchmarks.fixtures import generate_corpus, load_corpus
+from instrumentation import profiling
+
+STAGES = ["identify", "describe", "category1", "category2", "enrich", "search", "select",
+          "background_replicate", "background_local", "pipeline"]
+
+
+def percentile(values, q):
+    """Linear-interpolated percentile of a list of numbers (q in 0..100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class RssSampler:
+    """Tracks peak resident memory while a stage runs (Linux /proc, else ru_maxrss)."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def _current(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * self._page_size
+        except OSError:
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, self._current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_bytes = self._current()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self._current())
+
+
+def measure(name, fn, inputs, workers=1):
+    """
+    Call `fn` once per input (on `workers` threads) and collect latency statistics.
+
+    Returns:
+        dict: Stage name, call count, error count, latency percentiles (seconds),
+            throughput (calls/second) and peak RSS (bytes)
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(item):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok = fn(item)
+        except Exception as e:
+            print(f"  {name}: {type(e).__name__}: {e}")
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if ok is False:
+                errors += 1
+
+    with RssSampler() as memory:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(timed, inputs))
+        wall = time.perf_counter() - started
+
+    return {
+        "stage": name,
+        "calls": len(latencies),
+        "errors": errors,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+        "wall_seconds": wall,
+        "throughput": len(latencies) / wall if wall > 0 else 0.0,
+        "peak_rss_bytes": memory.peak_bytes,
+    }
+
+
+def run_benchmarks(services, stages, products, iterations, workers, selector_options):
+    """Run the selected stages against the fake services and return their results."""
+    # Imported here so the modules read the fake-service environment at import time
+    from openai_client import get_openai_client
+    from image_to_brand import get_brand_and_product
+    from description import create_description
+    from category1 import create_category_level_1
+    from category2 import create_category_level_2
+    from enrichment import enrich_product
+    from image_search import search_images
+    from image_selector import ProductImageSelector
+    from backgroundrm import BackgroundRemover
+    from product_store import ProductStore
+    from batch import run_batch
+
+    client = get_openai_client()
+    photo_urls = services.product_photo_urls(iterations)
+    identified = [(f"Brand {index % 97}", f"Product {index}") for index in range(iterations)]
+    candidates = {}
+    if "select" in stages:
+        # Search results are fetched up front so the select stage measures download and scoring only
+        for item in identified:
+            candidates[item] = [result.get("link") for result in search_images(f"{item[0]} {item[1]}")]
+    corpus_urls = [services.image_url(f"bench-{index}.jpg") for index in range(iterations)]
+
+    os.makedirs("processed_images", exist_ok=True)
+    replicate_remover = BackgroundRemover(engine="replicate") if "background_replicate" in stages else None
+    local_remover = BackgroundRemover(engine="local")
+
+    stage_functions = {
+        "identify": (lambda url: get_brand_and_product(client, url) != (None, None), photo_urls),
+        "describe": (lambda item: create_description(*item) != "Description not available", identified),
+        "category1": (lambda item: create_category_level_1(item[0], item[1], "A product.") != "Uncategorized", identified),
+        "category2": (lambda item: create_category_level_2(item[1], "A product.", "Snacks") != "Uncategorized", identified),
+        "enrich": (lambda item: enrich_product(*item) is not None, identified),
+        "search": (lambda item: bool(search_images(f"{item[0]} {item[1]}")), identified),
+        "select": (lambda item: ProductImageSelector(**selector_options).select_best_image(
+            item[0], item[1], candidates[item]) is not None, identified),
+        "background_replicate": (lambda url: replicate_remover.remove_background(
+            url, os.path.join("processed_images", f"replicate_{abs(hash(url))}.png")), corpus_urls),
+        "background_local": (lambda url: local_remover.remove_background(
+            url, os.path.join("processed_images", f"local_{abs(hash(url))}.png")), corpus_urls),
+    }
+
+    results = []
+    for stage in stages:
+        if stage == "pipeline":
+            continue
+        fn, inputs = stage_functions[stage]
+        print(f"Benchmarking {stage} ({len(inputs)} calls)...")
+        results.append(measure(stage, fn, inputs, workers=1))
+
+    if "pipeline" in stages:
+        print(f"Benchmarking full pipeline ({products} products, {workers} workers)...")
+        store = ProductStore("benchmark_products.db")
+        with RssSampler() as memory:
+            started = time.perf_counter()
+            outcomes = run_batch(services.product_photo_urls(products), client, store, workers=workers,
+                                 force=True, selector_options=selector_options)
+            wall = time.perf_counter() - started
+        latencies = [outcome["seconds"] for outcome in outcomes]
+        results.append({
+            "stage": "pipeline",
+            "calls": len(outcomes),
+            "errors": sum(1 for outcome in outcomes if outcome["status"] != "ok"),
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "wall_seconds": wall,
+            "throughput": len(outcomes) / wall if wall > 0 else 0.0,
+            "peak_rss_bytes": memory.peak_bytes,
+        })
+    return results
+
+
+def print_results(results, services):
+    print(f"\n{'stage':<22}{'calls':>6}{'errors':>7}{'p50 s':>9}{'p90 s':>9}{'p99 s':>9}{'ops/s':>9}{'peak MB':>9}")
+    for result in results:
+        print(f"{result['stage']:<22}{result['calls']:>6}{result['errors']:>7}"
+              f"{result['p50']:>9.3f}{result['p90']:>9.3f}{result['p99']:>9.3f}"
+              f"{result['throughput']:>9.2f}{result['peak_rss_bytes'] / 1e6:>9.1f}")
+    print(f"\nFake service requests: {dict(services.requests)}; injected errors: {dict(services.errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark against local fake services.")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"Comma-separated stages to run (default: all of {', '.join(STAGES)})")
+    parser.add_argument("--iterations", type=int, default=10, help="Calls per isolated stage")
+    parser.add_argument("--products", type=int, default=20, help="Products pushed through the full pipeline")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent products in the pipeline benchmark")
+    parser.add_argument("--scoring-workers", type=int, default=0, help="Process pool size for image scoring")
+    for provider, default in DEFAULT_LATENCY.items():
+        parser.add_argument(f"--{provider}-latency", type=float, default=default,
+                            help=f"Mean {provider} latency in seconds (default {default})")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API calls that fail with 429")
+    parser.add_argument("--corpus", help="Directory of product photos to serve instead of the generated fixtures")
+    parser.add_argument("--corpus-size", type=int, default=24, help="Number of generated fixture photos")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="Also write the results as JSON")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write pipeline spans and counters to PATH (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(unknown)}")
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(args.corpus_size, seed=args.seed)
+    latency = {provider: getattr(args, f"{provider}_latency") for provider in DEFAULT_LATENCY}
+    error_rate = {provider: args.error_rate for provider in ("openai", "google", "replicate")}
+
+    work_dir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    original_dir = os.getcwd()
+    profile_path = os.path.abspath(args.profile) if args.profile else None
+    try:
+        with FakeServices(latency=latency, error_rate=error_rate, corpus=corpus, seed=args.seed) as services:
+            os.environ.update(services.env())
+            os.environ["LLM_CACHE_DISABLED"] = "1"
+            os.environ["SEARCH_CACHE_DISABLED"] = "1"
+            os.environ["DOWNLOAD_CACHE_DIR"] = os.path.join(work_dir, "downloads")
+            os.chdir(work_dir)
+            with profiling(profile_path):
+                results = run_benchmarks(services, stages, args.products, args.iterations, args.workers,
+                                         {"scoring_workers": args.scoring_workers})
+            print_results(results, services)
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump({"config": vars(args), "results": results}, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from openai_client import get_openai_client
+from product_store import open_store
+from batch import read_manifest, run_batch, print_report
+from description import description_request
+from category1 import category1_request
+from category2 import category2_request, CATEGORY_HIERARCHY
+from image_to_brand import image_payload, brand_request, parse_brand_response, has_brand_and_product
+from response_cache import get_llm_cache, chat_cache_key, report_cache_stats
+from taxonomy_classifier import get_taxonomy_classifier, product_text, train_from_store
+from instrumentation import span, count, profiling
+import scheduler
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+DEFAULT_WORKDIR = ".bulk"
+DEFAULT_POLL_INTERVAL = 60
+# Batch API input limits are 50,000 requests and 200 MB per file
+MAX_REQUESTS_PER_FILE = 50_000
+MAX_FILE_BYTES = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Photos downloaded ahead while the vision wave's request files are written
+VISION_CHUNK = 256
+
+
+def _custom_id(wave, key):
+    """Stable request ID, so a resumed wave recognizes what it already submitted."""
+    return f"{wave}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]}"
+
+
+class BatchRunner:
+    """
+    Runs waves of chat completion requests through the OpenAI Batch API.
+
+    A wave's requests are written to JSONL files in `workdir`, uploaded and submitted
+    as one or more batches, then polled until every batch has finished. The submitted
+    batch IDs are kept in `<workdir>/<wave>.json` until the results are collected, so
+    an interrupted run picks up the same batches instead of paying for them twice;
+    the request files are removed with it.
+    """
+
+    def __init__(self, client, workdir=DEFAULT_WORKDIR, poll_interval=DEFAULT_POLL_INTERVAL,
+                 completion_window=COMPLETION_WINDOW):
+        self.client = client
+        self.workdir = workdir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        os.makedirs(workdir, exist_ok=True)
+
+    def _state_path(self, wave):
+        return os.path.join(self.workdir, f"{wave}.json")
+
+    def _load_state(self, wave):
+        if not os.path.exists(self._state_path(wave)):
+            return {"batches": [], "custom_ids": [], "files": []}
+        with open(self._state_path(wave), "r") as infile:
+            return json.load(infile)
+
+    def _save_state(self, wave, state):
+        path = self._state_path(wave)
+        with open(path + ".tmp", "w") as outfile:
+            json.dump(state, outfile)
+        os.replace(path + ".tmp", path)
+
+    def submitted(self, wave):
+        """Return the custom IDs of the wave's requests that are already submitted and not yet collected."""
+        return set(self._load_state(wave)["custom_ids"])
+
+    def run_wave(self, wave, requests):
+        """
+        Submit a wave of requests and wait for the answers.
+
+        Args:
+            wave (str): Wave name, used for file names and the resume state
+            requests (iterable): (custom ID, chat completion arguments) pairs; consumed
+                lazily, so large inline images need not all be held in memory
+
+        Returns:
+            dict: Custom ID -> response content, for every request that succeeded
+                (including requests submitted by an interrupted earlier run)
+        """
+        state = self._load_state(wave)
+        if state["batches"]:
+            logger.info(f"Resuming {len(state['batches'])} {wave} batches submitted earlier")
+        submitted = set(state["custom_ids"])
+        new_ids = []
+        paths = self._write_files(wave, ((custom_id, body) for custom_id, body in requests
+                                         if custom_id not in submitted), new_ids)
+        if paths:
+            state["batches"] += self._submit(wave, paths)
+            state["custom_ids"] += new_ids
+            state["files"] += paths
+            self._save_state(wave, state)
+            count("bulk.requests", len(new_ids))
+        if not state["batches"]:
+            return {}
+
+        results = self._wait(wave, state["batches"])
+        for path in state["files"] + [self._state_path(wave)]:
+            if os.path.exists(path):
+                os.remove(path)
+        return results
+
+    def _write_files(self, wave, requests, custom_ids):
+        """Write requests to JSONL files within the Batch API limits, appending their IDs to `custom_ids`."""
+        paths, handle, lines, size = [], None, 0, 0
+        try:
+            for custom_id, body in requests:
+                line = json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT,
+                                   "body": body}).encode("utf-8") + b"\n"
+                if handle is None or lines >= MAX_REQUESTS_PER_FILE or size + len(line) > MAX_FILE_BYTES:
+                    if handle is not None:
+                        handle.close()
+                    paths.append(os.path.join(self.workdir, f"{wave}-{uuid.uuid4().hex[:12]}.jsonl"))
+                    handle, lines, size = open(paths[-1], "wb"), 0, 0
+                handle.write(line)
+                custom_ids.append(custom_id)
+                lines += 1
+                size += len(line)
+        finally:
+            if handle is not None:
+                handle.close()
+        return paths
+
+    def _submit(self, wave, paths):
+        batch_ids = []
+        for path in paths:
+            with open(path, "rb") as infile:
+                uploaded = scheduler.call("openai", self.client.files.create, file=infile, purpose="batch")
+            batch = scheduler.call("openai", self.client.batches.create, input_file_id=uploaded.id,
+                                   endpoint=BATCH_ENDPOINT, completion_window=self.completion_window,
+                                   metadata={"wave": wave})
+            batch_ids.append(batch.id)
+            count("bulk.batches")
+            logger.info(f"Submitted {wave} batch {batch.id} from {path}")
+        return batch_ids
+
+    def _wait(self, wave, batch_ids):
+        results = {}
+        pending = list(batch_ids)
+        with span(f"bulk.{wave}"):
+            while pending:
+                for batch_id in list(pending):
+                    batch = scheduler.call("openai", self.client.batches.retrieve, batch_id)
+                    if batch.status not in TERMINAL_STATUSES:
+                        continue
+                    pending.remove(batch_id)
+                    counts = batch.request_counts
+                    logger.info(f"{wave} batch {batch_id} {batch.status}"
+                                + (f": {counts.completed} completed, {counts.failed} failed" if counts else ""))
+                    # Expired and cancelled batches still return the requests that finished
+                    results.update(self._read_output(batch.output_file_id))
+                    self._log_errors(wave, batch.error_file_id)
+                if pending:
+                    time.sleep(self.poll_interval)
+        return results
+
+    def _read_output(self, file_id):
+        results = {}
+        if not file_id:
+            return results
+        content = scheduler.call("openai", self.client.files.content, file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            usage = body.get("usage") or {}
+            count("bulk.prompt_tokens", usage.get("prompt_tokens") or 0)
+            count("bulk.completion_tokens", usage.get("completion_tokens") or 0)
+            results[item["custom_id"]] = body["choices"][0]["message"]["content"]
+        return results
+
+    def _log_errors(self, wave, file_id):
+        if not file_id:
+            return
+        content = scheduler.call("openai", self.client.files.content, file_id).text
+        failed = [line for line in content.splitlines() if line.strip()]
+        count("bulk.failed_requests", len(failed))
+        if failed:
+            logger.warning(f"{len(failed)} {wave} requests failed and will be retried on the next run, "
+                           f"e.g. {failed[0][:200]}")
+
+
+def _answers(runner, wave, requests, validate=None):
+    """
+    Run a wave, answering requests from the LLM cache first and caching new answers.
+
+    Args:
+        requests (iterable): (custom ID, chat completion arguments) pairs
+        validate (callable): Optional predicate; answers failing it are not cached
+
+    Returns:
+        dict: Custom ID -> response content
+    """
+    cache = get_llm_cache()
+    answers, keys = {}, {}
+
+    def uncached():
+        for custom_id, body in requests:
+            keys[custom_id] = chat_cache_key(**body)
+            cached = cache.get(keys[custom_id]) if cache is not None else None
+            if cached is not None:
+                answers[custom_id] = cached
+            else:
+                yield custom_id, body
+
+    batch_answers = runner.run_wave(wave, uncached())
+    cached = len(answers)
+    for custom_id, content in batch_answers.items():
+        if cache is not None and custom_id in keys and content is not None and (validate is None or validate(content)):
+            cache.set(keys[custom_id], content)
+        answers.setdefault(custom_id, content)
+    if keys:
+        logger.info(f"{wave}: {len(answers)} of {len(keys)} requests answered ({cached} from the LLM cache)")
+    return answers
+
+
+def run_bulk(image_urls, runner, store, force=False, download_workers=16):
+    """
+    Identify and enrich a backlog of product photos in Batch API waves.
+
+    Every photo goes through the vision wave, then every newly identified product
+    through the description wave and the two category waves (products the local
+    taxonomy classifier recognizes skip the category requests). Results are saved
+    as the "identify" and "enrich" checkpoints of each photo (see ProductStore.job),
+    so the image stages can then finish the products as usual (see run_batch).
+    Photos of products already in the catalog are linked to them, like the
+    synchronous pipeline does. Requests that fail stay pending for the next run.
+
+    Args:
+        image_urls (list): Input photo URLs
+        runner (BatchRunner): Batch API runner
+        store (ProductStore): Catalog and checkpoint store
+        force (bool): Redo photos that were already processed, discarding their checkpoints
+        download_workers (int): Photos downloaded concurrently while building the vision wave
+
+    Returns:
+        list: Image URLs whose text stages are complete
+    """
+    train_from_store(store)
+    classifier = get_taxonomy_classifier()
+    jobs = {url: store.job(url, resume=not force) for url in dict.fromkeys(image_urls)
+            if force or not store.is_processed(url)}
+
+    # Wave 1: brand and product name from the photo
+    to_identify = [url for url, job in jobs.items() if "identify" not in job]
+    sources = {_custom_id("identify", url): url for url in to_identify}
+    # Photos in batches submitted by an interrupted run are not downloaded and encoded again
+    submitted = runner.submitted("identify")
+    to_fetch = [url for url in to_identify if _custom_id("identify", url) not in submitted]
+
+    def vision_requests():
+        # Photos are fetched a chunk at a time so inline images are written out as they arrive
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            for start in range(0, len(to_fetch), VISION_CHUNK):
+                chunk = to_fetch[start:start + VISION_CHUNK]
+                for url, image_part in zip(chunk, executor.map(lambda url: image_payload(url)[0], chunk)):
+                    if image_part is None:
+                        logger.warning(f"Could not fetch {url}; it is left for the next run")
+                        continue
+                    yield _custom_id("identify", url), brand_request(image_part)
+
+    for custom_id, content in _answers(runner, "identify", vision_requests(), validate=has_brand_and_product).items():
+        brand, product_name = parse_brand_response(content)
+        if brand and product_name and custom_id in sources:
+            jobs[sources[custom_id]].save("identify", [brand, product_name])
+
+    # Photos of products that are already catalogued are linked and done
+    products = {}
+    for url, job in list(jobs.items()):
+        if "identify" not in job:
+            continue
+        brand, product_name = job.outputs["identify"]
+        existing = None if force else store.get(brand, product_name)
+        if existing:
+            store.add(existing, source_image_url=url)
+            del jobs[url]
+        elif "enrich" not in job:
+            products.setdefault((brand, product_name), []).append(job)
+
+    def save(stage, values):
+        for (brand, product_name), value in values.items():
+            for job in products[(brand, product_name)]:
+                job.save(stage, value)
+
+    def stage_value(stage, key):
+        return products[key][0].outputs.get(stage)
+
+    # Wave 2: descriptions, once per distinct product
+    pending = {key: _custom_id("description", json.dumps(key)) for key in products
+               if stage_value("bulk.description", key) is None}
+    answers = _answers(runner, "description",
+                       ((custom_id, description_request(*key)) for key, custom_id in pending.items()))
+    save("bulk.description", {key: answers[custom_id].strip() for key, custom_id in pending.items() if custom_id in answers})
+
+    # Wave 3: main category, unless the local classifier is confident
+    local, pending = {}, {}
+    for key in products:
+        description = stage_value("bulk.description", key)
+        if description is None or stage_value("bulk.category1", key) is not None:
+            continue
+        category, _ = classifier.predict_category1(product_text(*key, description)) if classifier is not None else (None, 0.0)
+        if category:
+            count("taxonomy.local.category1")
+            local[key] = category
+        else:
+            pending[key] = (_custom_id("category1", json.dumps(key)), category1_request(*key, description))
+    answers = _answers(runner, "category1", pending.values())
+    local.update({key: answers[custom_id].strip() for key, (custom_id, _) in pending.items() if custom_id in answers})
+    save("bulk.category1", local)
+
+    # Wave 4: subcategory within the main category
+    local, pending = {}, {}
+    for key in products:
+        brand, product_name = key
+        description, category1 = stage_value("bulk.description", key), stage_value("bulk.category1", key)
+        if category1 is None:
+            continue
+        if category1 not in CATEGORY_HIERARCHY:
+            local[key] = "Uncategorized"
+            continue
+        subcategory, _ = (classifier.predict_category2(product_text(brand, product_name, description), category1)
+                          if classifier is not None else (None, 0.0))
+        if subcategory:
+            count("taxonomy.local.category2")
+            local[key] = subcategory
+        else:
+            pending[key] = (_custom_id("category2", json.dumps(key)),
+                            category2_request(product_name, description, category1))
+    answers = _answers(runner, "category2", pending.values())
+    local.update({key: answers[custom_id].strip() for key, (custom_id, _) in pending.items() if custom_id in answers})
+    save("enrich", {key: [stage_value("bulk.description", key), stage_value("bulk.category1", key), category2]
+                    for key, category2 in local.items()})
+
+    ready = [url for url, job in jobs.items() if "identify" in job and "enrich" in job]
+    logger.info(f"Bulk enrichment: {len(ready)} of {len(jobs)} photos identified and enriched")
+    return ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill a manifest of image URLs with the OpenAI Batch API.")
+    parser.add_argument("manifest", help="File with one image URL per line, or '-' for stdin")
+    parser.add_argument("--store", default="products.db", help="Product store database")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="Directory for batch files and resume state")
+    parser.add_argument("--poll-interval", type=float, default=float(os.getenv("BULK_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)),
+                        help="Seconds between batch status checks")
+    parser.add_argument("--force", action="store_true", help="Reprocess products that are already stored")
+    parser.add_argument("--text-only", action="store_true",
+                        help="Stop after the Batch API waves; run batch.py later to finish the image stages")
+    parser.add_argument("--workers", type=int, default=8, help="Products finished concurrently in the image stages")
+    parser.add_argument("--export-csv", metavar="PATH", help="Export the catalog as CSV after the run (e.g. data.csv)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write per-stage timings and counters to PATH (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args()
+
+    client = get_openai_client()
+    image_urls = read_manifest(args.manifest)
+    store = open_store(args.store)
+    runner = BatchRunner(client, workdir=args.workdir, poll_interval=args.poll_interval)
+
+    started = time.monotonic()
+    with profiling(args.profile):
+        ready = run_bulk(image_urls, runner, store, force=args.force)
+        if not args.text_only and ready:
+            # Identify and enrich are resumed from the checkpoints (also with --force, which
+            # already discarded the old ones); only the image stages run
+            outcomes = run_batch(ready, client, store, workers=args.workers, force=args.force, resume=True)
+            print_report(outcomes, time.monotonic() - started)
+    if args.export_csv:
+        store.export_csv(args.export_csv)
+    report_cache_stats()
+
+
+if __name__ == "__main__":
+    main()
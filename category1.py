@@ -1,38 +1,50 @@
-import openai
-import os
 from dotenv import load_dotenv
+from response_cache import cached_chat_completion
+from openai_client import get_openai_client
+from scheduler import ProviderUnavailable
+from taxonomy_classifier import get_taxonomy_classifier, product_text
+from instrumentation import count
 
 # Load environment variables
 load_dotenv()
 
-def create_category_level_1(brand, product_name, description):
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OpenAI API key is missing. Set the environment variable OPENAI_API_KEY.")
-
-    client = openai.OpenAI(api_key=api_key)
-
-    categories = [
-        "Bakery", "Fresh Produce", "Meat & Poultry", "Seafood",
-        "Dairy & Eggs", "Dry Goods & Pantry", "Beverages",
-        "Frozen Food", "Condiments & Sauces", "Confectionery & Sweets", "Snacks"
-    ]
+CATEGORIES = [
+    "Bakery", "Fresh Produce", "Meat & Poultry", "Seafood",
+    "Dairy & Eggs", "Dry Goods & Pantry", "Beverages",
+    "Frozen Food", "Condiments & Sauces", "Confectionery & Sweets", "Snacks"
+]
 
+def category1_request(brand, product_name, description):
+    """Request that asks for the main category of a product."""
     prompt = (
         f"Based on the following product information, select the most appropriate category from the list provided:\n\n"
         f"Brand: {brand}\n"
         f"Product Name: {product_name}\n"
         f"Description: {description}\n\n"
-        f"Categories: {', '.join(categories)}\n\n"
+        f"Categories: {', '.join(CATEGORIES)}\n\n"
         f"Please provide only the category name as your answer."
     )
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 10
+    }
+
+def create_category_level_1(brand, product_name, description):
+    # Products close to already categorized ones are labelled locally
+    classifier = get_taxonomy_classifier()
+    if classifier is not None:
+        category, _ = classifier.predict_category1(product_text(brand, product_name, description))
+        if category:
+            count("taxonomy.local.category1")
+            return category
+
+    client = get_openai_client()
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=10
-        )
-        return response.choices[0].message.content.strip()
+        content = cached_chat_completion(client, **category1_request(brand, product_name, description))
+        return content.strip()
+    except ProviderUnavailable:
+        raise
     except Exception as e:
         return "Uncategorized"
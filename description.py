@@ -1,25 +1,28 @@
-import openai
-import os
 from dotenv import load_dotenv
+from response_cache import cached_chat_completion
+from openai_client import get_openai_client
+from scheduler import ProviderUnavailable
 
 # Load environment variables
 load_dotenv()
 
-def create_description(brand, product_name):
-    api_key = os.getenv("OPENAI_API_KEY")  # Get API key securely
-    if not api_key:
-        raise ValueError("OpenAI API key is missing. Set the environment variable OPENAI_API_KEY.")
-
-    client = openai.OpenAI(api_key=api_key)
-
+def description_request(brand, product_name):
+    """Chat completion arguments for the description prompt, shared with the bulk mode in bulk.py."""
     prompt = f"Generate a concise, one-paragraph description for a {brand} product named {product_name}. The description should be brief but informative."
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 100
+    }
+
+def create_description(brand, product_name):
+    client = get_openai_client()
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=100
-        )
-        return response.choices[0].message.content.strip()
+        content = cached_chat_completion(client, **description_request(brand, product_name))
+        return content.strip()
+    except ProviderUnavailable:
+        # Not a bad answer but an outage: let the caller fail (and resume) instead of storing the fallback
+        raise
     except Exception as e:
         return "Description not available"
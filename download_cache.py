@@ -0,0 +1,301 @@
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+import requests
+import requests.adapters
+from instrumentation import span, count
+from scheduler import get_scheduler
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "downloads")
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 3600  # used only for responses without ETag/Last-Modified
+DEFAULT_REVALIDATE_AFTER = 3600
+MAX_VALIDATED_URLS = 100_000
+
+
+class DownloadTooLarge(Exception):
+    """Raised when a body is larger than the caller's max_bytes."""
+
+
+class DownloadCache:
+    """
+    A content-addressed on-disk cache for downloaded files (mostly images).
+
+    Bodies are stored once per SHA-256 hash under `directory`, and an SQLite index
+    maps each URL to its blob plus the ETag/Last-Modified validators. Cached
+    entries are revalidated with a conditional request, at most once per
+    `revalidate_after` seconds within a process (the most recently validated
+    MAX_VALIDATED_URLS URLs are remembered). The least recently used blobs are
+    evicted once their total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL,
+                 revalidate_after=DEFAULT_REVALIDATE_AFTER):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.revalidate_after = revalidate_after
+        self.session = requests.Session()
+        # Room for every download the scheduler lets through at once
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=64)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self._validated = OrderedDict()
+        self._lock = threading.Lock()
+        self._url_locks = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                " url TEXT PRIMARY KEY,"
+                " sha256 TEXT NOT NULL,"
+                " etag TEXT,"
+                " last_modified TEXT,"
+                " content_type TEXT,"
+                " fetched_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " sha256 TEXT PRIMARY KEY,"
+                " size INTEGER NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256)")
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    @contextmanager
+    def _url_lock(self, url):
+        """Serialize fetches of one URL; the lock is dropped once no thread uses it."""
+        with self._lock:
+            entry = self._url_locks.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._url_locks[url]
+
+    def _recently_validated(self, url):
+        with self._lock:
+            validated_at = self._validated.get(url)
+            if validated_at is None:
+                return False
+            if time.time() - validated_at < self.revalidate_after:
+                return True
+            del self._validated[url]
+            return False
+
+    def _mark_validated(self, url):
+        with self._lock:
+            self._validated[url] = time.time()
+            self._validated.move_to_end(url)
+            while len(self._validated) > MAX_VALIDATED_URLS:
+                self._validated.popitem(last=False)
+
+    def _lookup(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256, etag, last_modified, content_type, fetched_at FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None or not os.path.exists(self._blob_path(row[0])):
+            return None
+        return dict(zip(("sha256", "etag", "last_modified", "content_type", "fetched_at"), row))
+
+    def _read_blob(self, sha256, max_bytes=None):
+        """Return a cached body, or None if another process evicted it in the meantime."""
+        try:
+            if max_bytes is not None and os.path.getsize(self._blob_path(sha256)) > max_bytes:
+                raise DownloadTooLarge(f"Cached file exceeds {max_bytes} bytes")
+            with open(self._blob_path(sha256), "rb") as blob:
+                data = blob.read()
+        except FileNotFoundError:
+            return None
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE blobs SET accessed_at = ? WHERE sha256 = ?", (time.time(), sha256))
+        return data
+
+    def _store(self, url, response, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs (sha256, size, accessed_at) VALUES (?, ?, ?)",
+                (sha256, len(data), now)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO urls (url, sha256, etag, last_modified, content_type, fetched_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (url, sha256, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                 response.headers.get("Content-Type"), now)
+            )
+            self._evict()
+        return data
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for sha256, size in self._conn.execute("SELECT sha256, size FROM blobs ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            self._conn.execute("DELETE FROM urls WHERE sha256 = ?", (sha256,))
+            try:
+                os.remove(self._blob_path(sha256))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} files from download cache")
+
+    def fetch(self, url, timeout=10, max_bytes=None):
+        """
+        Return the body of `url`, downloading it only if needed.
+
+        Args:
+            url (str): URL to fetch
+            timeout (float): Request timeout in seconds
+            max_bytes (int): Refuse bodies larger than this many bytes
+
+        Returns:
+            bytes: Response body
+
+        Raises:
+            requests.RequestException: If the download fails or returns a non-2xx status
+            scheduler.ProviderUnavailable: If it keeps failing with retryable errors
+            DownloadTooLarge: If the body exceeds `max_bytes`
+        """
+        with self._url_lock(url):
+            entry = self._lookup(url)
+            if entry is not None:
+                fresh = self._recently_validated(url) or (
+                    not entry["etag"] and not entry["last_modified"] and time.time() - entry["fetched_at"] < self.ttl
+                )
+                if fresh:
+                    data = self._read_blob(entry["sha256"], max_bytes)
+                    if data is not None:
+                        self.hits += 1
+                        count("download_cache.hits")
+                        return data
+                    entry = None
+
+            headers = {}
+            if entry is not None:
+                if entry["etag"]:
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    headers["If-Modified-Since"] = entry["last_modified"]
+
+            with span("download"):
+                count("download.requests")
+                response, data = get_scheduler().call("download", self._download, url, headers, timeout, max_bytes)
+
+            if response.status_code == 304 and entry is not None:
+                data = self._read_blob(entry["sha256"], max_bytes)
+                if data is not None:
+                    self.hits += 1
+                    count("download_cache.revalidated")
+                    self._mark_validated(url)
+                    with self._lock, self._conn:
+                        self._conn.execute("UPDATE urls SET fetched_at = ? WHERE url = ?", (time.time(), url))
+                    return data
+                # Evicted while revalidating: download the body unconditionally
+                with span("download"):
+                    count("download.requests")
+                    response, data = get_scheduler().call("download", self._download, url, {}, timeout, max_bytes)
+
+            self.misses += 1
+            self.bytes_downloaded += len(data)
+            count("download_cache.misses")
+            count("download.bytes", len(data))
+            self._mark_validated(url)
+            return self._store(url, response, data)
+
+    def _download(self, url, headers, timeout, max_bytes):
+        """One GET attempt; returns (response, body), with a None body for 304 Not Modified."""
+        with self.session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+            if response.status_code == 304 and headers:
+                return response, None
+            response.raise_for_status()
+            return response, self._read_body(url, response, max_bytes)
+
+    def _read_body(self, url, response, max_bytes):
+        if max_bytes is None:
+            return response.content
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise DownloadTooLarge(f"{url} is {length} bytes, limit is {max_bytes}")
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            received += len(chunk)
+            if received > max_bytes:
+                raise DownloadTooLarge(f"{url} exceeds {max_bytes} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def content_type(self, url):
+        """Return the Content-Type recorded for a cached URL, if any."""
+        entry = self._lookup(url)
+        return entry["content_type"] if entry else None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes_downloaded": self.bytes_downloaded}
+
+
+_download_cache = None
+_download_cache_lock = threading.Lock()
+
+
+def get_download_cache():
+    """
+    Return the process-wide download cache.
+
+    Configured through DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES and
+    DOWNLOAD_CACHE_TTL and DOWNLOAD_CACHE_REVALIDATE_AFTER environment variables.
+    """
+    global _download_cache
+    with _download_cache_lock:
+        if _download_cache is None:
+            _download_cache = DownloadCache(
+                directory=os.getenv("DOWNLOAD_CACHE_DIR", DEFAULT_CACHE_DIR),
+                max_bytes=int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+                ttl=float(os.getenv("DOWNLOAD_CACHE_TTL", DEFAULT_TTL)),
+                revalidate_after=float(os.getenv("DOWNLOAD_CACHE_REVALIDATE_AFTER", DEFAULT_REVALIDATE_AFTER))
+            )
+        return _download_cache
+
+
+def fetch_bytes(url, timeout=10, max_bytes=None):
+    """Download `url` through the shared cache. See DownloadCache.fetch."""
+    return get_download_cache().fetch(url, timeout=timeout, max_bytes=max_bytes)
@@ -0,0 +1,111 @@
+import json
+import logging
+from dotenv import load_dotenv
+from response_cache import cached_chat_completion
+from openai_client import get_openai_client
+from scheduler import ProviderUnavailable
+from description import create_description
+from category1 import create_category_level_1
+from category2 import create_category_level_2, CATEGORY_HIERARCHY
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Structured outputs need a model that supports json_schema response formats
+ENRICHMENT_MODEL = "gpt-4o-mini"
+
+
+def _enrichment_schema():
+    subcategories = sorted({sub for subs in CATEGORY_HIERARCHY.values() for sub in subs})
+    return {
+        "name": "product_enrichment",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "description": {"type": "string"},
+                "category1": {"type": "string", "enum": list(CATEGORY_HIERARCHY)},
+                "category2": {"type": "string", "enum": subcategories},
+            },
+            "required": ["description", "category1", "category2"],
+            "additionalProperties": False,
+        },
+    }
+
+
+def _build_prompt(brand, product_name):
+    hierarchy = "\n".join(f"- {category}: {', '.join(subs)}" for category, subs in CATEGORY_HIERARCHY.items())
+    return (
+        f"Generate a concise, one-paragraph description for a {brand} product named {product_name}. "
+        f"The description should be brief but informative.\n\n"
+        f"Then select the most appropriate category and subcategory for the product from this hierarchy "
+        f"(the subcategory must belong to the chosen category):\n{hierarchy}\n\n"
+        f"Return a JSON object with the keys \"description\", \"category1\" and \"category2\"."
+    )
+
+
+def parse_enrichment(content):
+    """
+    Parse and validate a structured enrichment answer.
+
+    Returns:
+        dict: Parsed answer with "description", "category1", "category2" keys. The
+            "valid" key is True only if category2 belongs to category1 in CATEGORY_HIERARCHY.
+    """
+    try:
+        data = json.loads(content)
+    except (TypeError, json.JSONDecodeError):
+        return {"valid": False}
+    if not isinstance(data, dict):
+        return {"valid": False}
+
+    description = str(data.get("description", "")).strip()
+    category1 = data.get("category1")
+    category2 = data.get("category2")
+    valid = bool(description) and category1 in CATEGORY_HIERARCHY and category2 in CATEGORY_HIERARCHY[category1]
+    return {"description": description, "category1": category1, "category2": category2, "valid": valid}
+
+
+def enrich_product(brand, product_name):
+    """
+    Generate description, category and subcategory with a single structured call.
+
+    Falls back to the step-by-step prompts (create_description, create_category_level_1,
+    create_category_level_2) only when the structured answer fails validation. A valid
+    description is reused by the fallback.
+
+    Args:
+        brand (str): Product brand
+        product_name (str): Product name
+
+    Returns:
+        tuple: (description, category1, category2)
+    """
+    result = {"valid": False}
+    try:
+        content = cached_chat_completion(
+            get_openai_client(),
+            model=ENRICHMENT_MODEL,
+            messages=[{"role": "user", "content": _build_prompt(brand, product_name)}],
+            max_tokens=250,
+            response_format={"type": "json_schema", "json_schema": _enrichment_schema()},
+            validate=lambda answer: parse_enrichment(answer)["valid"]
+        )
+        result = parse_enrichment(content)
+    except ProviderUnavailable:
+        raise
+    except Exception as e:
+        logger.warning(f"Structured enrichment failed for {brand} {product_name}: {e}")
+
+    if result["valid"]:
+        return result["description"], result["category1"], result["category2"]
+
+    logger.info(f"Falling back to step-by-step enrichment for {brand} {product_name}")
+    description = result.get("description") or create_description(brand, product_name)
+    category_level_1 = create_category_level_1(brand, product_name, description)
+    category_level_2 = create_category_level_2(product_name, description, category_level_1, brand=brand)
+    return description, category_level_1, category_level_2
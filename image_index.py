@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from instrumentation import count
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = os.path.join(".cache", "image_features.sqlite")
+
+
+class FeatureIndex:
+    """
+    A persistent index of the image features measured by ProductImageSelector.
+
+    Features (background coverage and brightness, object size, quality, difference
+    hash) are stored once per content hash and scoring configuration, and every
+    scored URL points at its content hash, so a URL is never downloaded or scored
+    twice and identical files behind different URLs are scored once. The candidate
+    URLs of every product are recorded too, which lets rerank.py re-run the
+    selection for the whole catalog from the index alone.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                " url TEXT PRIMARY KEY,"
+                " sha256 TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS features ("
+                " sha256 TEXT NOT NULL,"
+                " scoring TEXT NOT NULL,"
+                " features TEXT NOT NULL,"
+                " scored_at REAL NOT NULL,"
+                " PRIMARY KEY (sha256, scoring))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS candidates ("
+                " brand TEXT NOT NULL,"
+                " product_name TEXT NOT NULL,"
+                " urls TEXT NOT NULL,"
+                " selected_url TEXT,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (brand, product_name))"
+            )
+
+    def lookup(self, urls, scoring=None):
+        """
+        Return {url: features} for the URLs already scored
+
+        With `scoring` (see ProductImageSelector.scoring_key) only features measured
+        with those settings are returned; without it, the latest features of each URL.
+        """
+        urls = list(urls)
+        query = ("SELECT u.url, f.features FROM urls u JOIN features f ON f.sha256 = u.sha256"
+                 f" WHERE u.url IN ({', '.join('?' * len(urls))})")
+        params = list(urls)
+        if scoring is not None:
+            query += " AND f.scoring = ?"
+            params.append(scoring)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY f.scored_at", params).fetchall() if urls else []
+        found = {url: json.loads(features) for url, features in rows}
+        count("index.hits", len(found))
+        count("index.misses", len(set(urls)) - len(found))
+        return found
+
+    def lookup_content(self, url, sha256, scoring):
+        """
+        Return the features of already-scored content, or None
+
+        A hit also maps `url` to the content, so later lookups by URL find it.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT features FROM features WHERE sha256 = ? AND scoring = ?", (sha256, scoring)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO urls (url, sha256, updated_at) VALUES (?, ?, ?)", (url, sha256, time.time())
+            )
+        count("index.content_hits")
+        return json.loads(row[0])
+
+    def add(self, url, sha256, scoring, features):
+        """Store the features measured for the content downloaded from `url`."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO features (sha256, scoring, features, scored_at) VALUES (?, ?, ?, ?)",
+                (sha256, scoring, json.dumps(features), now)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO urls (url, sha256, updated_at) VALUES (?, ?, ?)", (url, sha256, now)
+            )
+
+    def record_candidates(self, brand, product_name, urls, selected_url):
+        """Remember the candidate URLs (in search-rank order) and the pick for one product."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO candidates (brand, product_name, urls, selected_url, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (brand, product_name, json.dumps(list(urls)), selected_url, time.time())
+            )
+
+    def products(self):
+        """Return {(brand, product_name): [candidate URLs]} for every recorded product."""
+        with self._lock:
+            rows = self._conn.execute("SELECT brand, product_name, urls FROM candidates").fetchall()
+        return {(brand, product_name): json.loads(urls) for brand, product_name, urls in rows}
+
+
+_feature_index = None
+_feature_index_lock = threading.Lock()
+
+
+def get_feature_index():
+    """
+    Return the process-wide image feature index, or None if disabled.
+
+    Configured through the IMAGE_INDEX_PATH and IMAGE_INDEX_DISABLED environment variables.
+    """
+    global _feature_index
+    if os.getenv("IMAGE_INDEX_DISABLED"):
+        return None
+    with _feature_index_lock:
+        if _feature_index is None:
+            _feature_index = FeatureIndex(os.getenv("IMAGE_INDEX_PATH", DEFAULT_INDEX_PATH))
+        return _feature_index
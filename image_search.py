@@ -1,8 +1,15 @@
 import os
 import csv
+import threading
 import requests
+import requests.adapters
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from instrumentation import span, count
+from response_cache import ResponseCache, DEFAULT_CACHE_PATH
+import scheduler
+from scheduler import ProviderUnavailable, RETRYABLE_STATUS
 
 # Load environment variables
 load_dotenv()
@@ -14,67 +21,207 @@ logger = logging.getLogger(__name__)
 # Configuration from environment variables
 API_KEY = os.getenv("GOOGLE_API_KEY")
 CX = os.getenv("GOOGLE_CX")
-SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_URL = os.getenv("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
+SEARCH_TIMEOUT = float(os.getenv("GOOGLE_SEARCH_TIMEOUT", 10))
+DEFAULT_SEARCH_CACHE_TTL = 24 * 3600
+
+PAGE_SIZE = 5
+PAGE_WORKERS = 8
+
+_session = None
+_page_executor = None
+_search_cache = None
+_search_lock = threading.Lock()
+
+def normalize_query(query):
+    """Case- and whitespace-insensitive form of a query, used as the cache key"""
+    return " ".join(query.lower().split())
+
+
+def get_search_cache():
+    """
+    Return the process-wide cache for search results, or None if disabled.
+
+    Results share the LLM cache database (LLM_CACHE_PATH) under the "cse"
+    namespace and are kept for SEARCH_CACHE_TTL seconds (default 1 day). Set
+    SEARCH_CACHE_DISABLED to bypass the cache.
+    """
+    global _search_cache
+    if os.getenv("SEARCH_CACHE_DISABLED"):
+        return None
+    with _search_lock:
+        if _search_cache is None:
+            _search_cache = ResponseCache(
+                path=os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+                namespace="cse",
+                ttl=float(os.getenv("SEARCH_CACHE_TTL", DEFAULT_SEARCH_CACHE_TTL))
+            )
+        return _search_cache
+
+
+def _get_session():
+    """Shared HTTP session whose connection pool fits the concurrent page requests"""
+    global _session
+    with _search_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=PAGE_WORKERS * 4)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _get_page_executor():
+    global _page_executor
+    with _search_lock:
+        if _page_executor is None:
+            _page_executor = ThreadPoolExecutor(max_workers=PAGE_WORKERS, thread_name_prefix="cse-page")
+        return _page_executor
+
+
+def _fetch_page(query, start, num):
+    """Fetch one page of results; returns the items, or None if the request failed"""
+    params = {
+        "q": query, 
+        "cx": CX, 
+        "key": API_KEY, 
+        "searchType": "image", 
+        "num": num, 
+        "start": start
+    }
+    def request():
+        response = _get_session().get(SEARCH_URL, params=params, timeout=SEARCH_TIMEOUT)
+        if response.status_code in RETRYABLE_STATUS:
+            # Rate limits and server errors are retried by the scheduler
+            response.raise_for_status()
+        return response
+
+    try:
+        with span("google.search"):
+            count("api_calls.google")
+            response = scheduler.call("google", request)
+    except ProviderUnavailable:
+        raise
+    except requests.RequestException as e:
+        logger.error(f"Error fetching images for {query}: {e}")
+        return None
+    if response.status_code != 200:
+        logger.error(f"Error fetching images for {query}: {response.status_code}")
+        return None
+    return response.json().get("items", [])
+
 
 def search_images(query, num_results=10):
     """
     Search for images using Google Custom Search API
     
+    All pages (5 items each) are requested concurrently through the shared
+    scheduler, which retries rate limits and server errors. Results are returned
+    in page order; a short page ends the results and a page that fails for another
+    reason drops that page, so in both cases later pages are discarded (and
+    cancelled if they have not started). Complete, non-empty results are cached
+    per search engine (CX) and normalized query (see get_search_cache).
+    
     Args:
         query (str): The search query
         num_results (int): Number of images to return
     
     Returns:
         list: List of image items
+
+    Raises:
+        scheduler.ProviderUnavailable: If the API stays unavailable or the daily quota is used up
     """
     # Verify API credentials are available
     if not API_KEY or not CX:
         logger.error("Missing API credentials. Set GOOGLE_API_KEY and GOOGLE_CX environment variables.")
         return []
-        
+
+    cache = get_search_cache()
+    key = ResponseCache.make_key(CX, normalize_query(query), num_results)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    executor = _get_page_executor()
+    sizes = [min(PAGE_SIZE, num_results - i) for i in range(0, num_results, PAGE_SIZE)]
+    pages = [executor.submit(_fetch_page, query, i * PAGE_SIZE + 1, size) for i, size in enumerate(sizes)]
     all_items = []
-    for i in range(0, num_results, 5):
-        params = {
-            "q": query, 
-            "cx": CX, 
-            "key": API_KEY, 
-            "searchType": "image", 
-            "num": min(5, num_results - i), 
-            "start": i+1
-        }
-        response = requests.get(SEARCH_URL, params=params)
-        if response.status_code == 200:
-            all_items.extend(response.json().get("items", []))
+    complete = True
+    for page, size in zip(pages, sizes):
+        try:
+            items = page.result()
+        except ProviderUnavailable:
+            for later in pages:
+                later.cancel()
+            raise
+        if items is None:
+            complete = False
         else:
-            logger.error(f"Error fetching images for {query}: {response.status_code}")
+            all_items.extend(items)
+        if items is None or len(items) < size:
+            # Later pages are not used, cancel them if they have not started yet
+            for later in pages:
+                later.cancel()
             break
-    return all_items[:num_results]
+
+    results = all_items[:num_results]
+    if cache is not None and complete and results:
+        cache.set(key, results)
+    return results
+
+
+def iter_image_records(products, num_results=10, workers=1):
+    """
+    Search images for each product and yield one record per candidate image
+    
+    Args:
+        products (iterable): Dicts with 'brand' and 'product_name' keys
+        num_results (int): Number of images to search for per product
+        workers (int): Queries run concurrently; with more than one, `products` is
+            read eagerly, but records are still yielded in input order
+    
+    Yields:
+        dict: {'brand', 'product_name', 'image_url'} in search-rank order
+    """
+    def search(row):
+        query = f"{row['brand']} {row['product_name']}"
+        logger.info(f"Searching images for: {query}")
+        return row, search_images(query, num_results=num_results)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cse-query") as executor:
+            yield from _records(executor.map(search, products))
+    else:
+        yield from _records(map(search, products))
+
+
+def _records(results):
+    for row, images in results:
+        for image in images:
+            yield {
+                "brand": row['brand'], 
+                "product_name": row['product_name'], 
+                "image_url": image.get("link")
+            }
 
 
-def fetch_images(input_csv, output_csv):
+def fetch_images(input_csv, output_csv, workers=4):
     """
     Fetch images for products listed in input CSV and save results to output CSV
     
     Args:
         input_csv (str): Path to input CSV with 'brand' and 'product_name' columns
         output_csv (str): Path to output CSV where results will be saved
+        workers (int): Number of products searched concurrently
     """
     if not os.path.exists(input_csv):
         logger.error(f"Input file {input_csv} not found!")
         return
 
-    results = []
     with open(input_csv, "r") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            query = f"{row['brand']} {row['product_name']}"
-            logger.info(f"Searching images for: {query}")
-            for image in search_images(query, num_results=10):
-                results.append({
-                    "brand": row['brand'], 
-                    "product_name": row['product_name'], 
-                    "image_url": image.get("link")
-                })
+        results = list(iter_image_records(csv.DictReader(infile), workers=workers))
 
     with open(output_csv, "w", newline="") as outfile:
         writer = csv.DictWriter(outfile, fieldnames=["brand", "product_name", "image_url"])
@@ -1,61 +1,278 @@
-import os
+import re
+import hashlib
 import cv2
 import numpy as np
-import pandas as pd
-import requests
+import csv
+from itertools import groupby
+from download_cache import fetch_bytes
+from image_index import get_feature_index
+from instrumentation import span, count
 from PIL import Image
-from pathlib import Path
 from io import BytesIO
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Evaluation result for candidates that are skipped or cannot be loaded
+REJECTED = (False, 0, 0, 0, None, 0)
+
+# Query parameters that only select a size, format or cache version of the same image
+VARIANT_PARAMS = {
+    "w", "h", "width", "height", "imwidth", "size", "sz", "resize", "fit", "crop", "dpr",
+    "quality", "qlt", "fm", "format", "auto", "v", "ver", "version", "ts", "cb", "cache",
+}
+# Size suffixes added by common CDNs and shop platforms, e.g. -300x300.jpg, _800x.png, ._SL1500_.jpg
+_PATH_SIZE_SUFFIX = re.compile(r"(?:[-_](\d+)x(\d*)|_x(\d+)|\._[A-Z]{2}[A-Z0-9_,]*?(\d*)_)(?=\.\w+$)")
+
+
+def canonicalize_url(url):
+    """
+    Return a canonical form of an image URL and the size hinted by the URL
+
+    Scheme, a leading "www." and fragments are dropped, as are size/format/cache
+    query parameters and CDN size suffixes, so resized variants of one file map
+    to the same key.
+
+    Returns:
+        tuple: (canonical URL, hinted pixel count or None if the URL carries no size)
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+
+    hint = None
+    query = []
+    for key, value in parse_qsl(parts.query, keep_blank_values=True):
+        if key.lower() in VARIANT_PARAMS:
+            if key.lower() in ("w", "width", "imwidth", "h", "height", "size", "sz") and value.isdigit():
+                hint = (hint or 1) * int(value)
+            continue
+        query.append((key, value))
+
+    path = parts.path
+    match = _PATH_SIZE_SUFFIX.search(path)
+    if match:
+        numbers = [int(group) for group in match.groups() if group]
+        if numbers:
+            hint = 1
+            for number in numbers:
+                hint *= number
+        path = path[:match.start()] + path[match.end():]
+
+    canonical = urlunsplit(("", host, path, urlencode(sorted(query)), ""))
+    return canonical, hint
+
+
+_scoring_pools = {}
+_scoring_pools_lock = threading.Lock()
+
+
+def _get_scoring_pool(workers):
+    """Return a shared process pool for OpenCV scoring, or None to score in-process"""
+    if not workers:
+        return None
+    with _scoring_pools_lock:
+        if workers not in _scoring_pools:
+            # spawn rather than fork: the parent runs download and API threads
+            _scoring_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _scoring_pools[workers]
+
+
 class ProductImageSelector:
     """
     A class to select the best product image for marketplace listings based on:
     1. White/bright background (mandatory)
     2. Largest object/product size in the image
     3. Image quality (sharpness, resolution)
+
+    Candidates are downloaded concurrently (`download_workers` threads) and scored
+    on a shared process pool of `scoring_workers` processes, or in the calling
+    process when `scoring_workers` is 0.
+
+    Scoring is a cascade: a reduced-size grayscale decode (`thumbnail_size`) rejects
+    candidates that cannot have a bright background, and only survivors are decoded
+    at full resolution. Files larger than `max_bytes` are skipped and images above
+    `max_pixels` are scored on a downscaled copy.
+
+    Near-duplicates are dropped before scoring: URLs that only differ by size or
+    cache parameters are downloaded once, and downloaded images whose difference
+    hashes are within `dedup_distance` bits are scored once, keeping the
+    highest-resolution copy. Hosts in `ignored_hosts` are never downloaded.
+
+    With `early_exit`, candidates are evaluated in search-rank order (the next
+    `early_exit_prefetch` are downloaded ahead) and evaluation stops at the
+    first one that meets `min_bg_score`, `min_object_percentage` and
+    `min_quality_score`; the remaining candidates are never downloaded.
+
+    With `use_index` (the default), measured features are kept in the image
+    feature index (see image_index.py) under the URL and content hash: URLs
+    already scored with the same settings are neither downloaded nor scored
+    again. Among the candidates with a bright background, those within
+    `size_band` of the largest object are ranked by `selection_weights`
+    (object size, quality, background), and rerank.py re-runs that step over
+    the index with different weights or thresholds.
     """
     
-    def __init__(self, input_csv, output_csv, min_background_brightness=180):
+    def __init__(self, input_csv=None, output_csv=None, min_background_brightness=180,
+                 download_workers=8, scoring_workers=0, thumbnail_size=256,
+                 max_pixels=16_000_000, max_bytes=25 * 1024 * 1024,
+                 dedup=True, dedup_distance=6, ignored_hosts=("images.openfoodfacts.org",),
+                 early_exit=False, early_exit_prefetch=2, min_bg_score=5.0, min_object_percentage=0.25,
+                 min_quality_score=3.0, size_band=0.95, selection_weights=(0.7, 0.2, 0.1), use_index=True):
         self.input_csv = input_csv
         self.output_csv = output_csv
         self.min_background_brightness = min_background_brightness
-        self.temp_dir = Path("temp_images")
-        os.makedirs(self.temp_dir, exist_ok=True)
+        self.download_workers = download_workers
+        self.scoring_workers = scoring_workers
+        self.thumbnail_size = thumbnail_size
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.dedup = dedup
+        self.dedup_distance = dedup_distance
+        self.ignored_hosts = tuple(ignored_hosts or ())
+        self.early_exit = early_exit
+        self.early_exit_prefetch = early_exit_prefetch
+        self.min_bg_score = min_bg_score
+        self.min_object_percentage = min_object_percentage
+        self.min_quality_score = min_quality_score
+        self.size_band = size_band
+        self.selection_weights = tuple(selection_weights)
+        self.use_index = use_index
+
+    def scoring_key(self):
+        """Settings that change the measured features; indexed features are reused only under the same key"""
+        return f"bg={self.min_background_brightness};px={self.max_pixels};thumb={self.thumbnail_size}"
+
+    def decode_image(self, data):
+        """Decode image bytes into an OpenCV image, downscaled to at most max_pixels"""
+        img = Image.open(BytesIO(data))
+        if self.max_pixels and img.width * img.height > self.max_pixels:
+            scale = (self.max_pixels / (img.width * img.height)) ** 0.5
+            target = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+            # JPEG can decode straight at 1/2, 1/4 or 1/8 size; finish with a resize
+            img.draft(None, target)
+            img = img.resize(target, Image.BILINEAR)
+        return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+
+    def decode_thumbnail(self, data):
+        """Decode a small grayscale version of the image for the cheap first pass"""
+        img = Image.open(BytesIO(data))
+        img.draft("L", (self.thumbnail_size, self.thumbnail_size))
+        img = img.convert("L")
+        img.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        return np.array(img)
+
+    def perceptual_hash(self, data):
+        """
+        Compute a 64-bit difference hash from a tiny grayscale decode
+
+        Returns:
+            tuple: (hash as int, (width, height) of the full image)
+        """
+        img = Image.open(BytesIO(data))
+        size = img.size
+        img.draft("L", (64, 64))
+        pixels = np.asarray(img.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        return int("".join("1" if bit else "0" for bit in bits), 2), size
+
+    def find_duplicates(self, images, hashed=()):
+        """
+        Group near-identical images and pick one copy of each
+
+        Args:
+            images (list): (index, data) pairs in search-rank order
+            hashed (iterable): (index, hash, pixel count) of images whose hash is already known
 
-    def load_image_from_url(self, url):
-        """Load image from URL and return as OpenCV image"""
+        Returns:
+            dict: index of each duplicate -> index of the copy that is kept (the
+                highest resolution, then the best ranked)
+        """
+        hashed = list(hashed)
+        for index, data in images:
+            try:
+                image_hash, (width, height) = self.perceptual_hash(data)
+            except Exception:
+                continue
+            hashed.append((index, image_hash, width * height))
+
+        # Highest resolution first, so every group is represented by its largest member
+        hashed.sort(key=lambda item: (-item[2], item[0]))
+        kept = []
+        duplicates = {}
+        for index, image_hash, _ in hashed:
+            original = next((kept_index for kept_index, kept_hash in kept
+                             if bin(image_hash ^ kept_hash).count("1") <= self.dedup_distance), None)
+            if original is None:
+                kept.append((index, image_hash))
+            else:
+                duplicates[index] = original
+        return duplicates
+
+    def download_image(self, url):
+        """Download image bytes, or return None if the download fails or is too large"""
         try:
-            response = requests.get(url, timeout=10)
-            img = Image.open(BytesIO(response.content))
-            return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+            return fetch_bytes(url, timeout=10, max_bytes=self.max_bytes)
         except Exception as e:
             logger.warning(f"Could not load image from {url}: {e}")
             return None
 
-    def check_background_brightness(self, img):
-        """Check if the image has a white/bright background"""
+    def to_gray(self, img):
+        """Return the grayscale version of an image (no copy if it is already gray)"""
         if len(img.shape) == 3:
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = img
-            
+            return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+
+    def may_have_bright_background(self, thumbnail):
+        """
+        Cheap first pass on a grayscale thumbnail
+
+        The full check needs more than 30% of pixels to be bright background, and
+        background pixels are a subset of the bright pixels, so a thumbnail with
+        clearly fewer bright pixels than that cannot pass. The margin absorbs the
+        averaging introduced by downscaling.
+        """
+        bright_fraction = np.count_nonzero(thumbnail > self.min_background_brightness) / thumbnail.size
+        return bright_fraction > 0.25, bright_fraction
+
+    def measure_background(self, gray):
+        """
+        Find the bright, edge-free background of a grayscale image
+
+        Returns:
+            tuple: (background mask, fraction of the image it covers, its mean brightness)
+        """
         _, bright_mask = cv2.threshold(gray, self.min_background_brightness, 255, cv2.THRESH_BINARY)
         edges = cv2.Canny(gray, 50, 150)
         dilated_edges = cv2.dilate(edges, np.ones((5,5), np.uint8), iterations=1)
         background_mask = cv2.bitwise_and(bright_mask, bright_mask, mask=cv2.bitwise_not(dilated_edges))
         
-        background_percentage = np.sum(background_mask > 0) / (background_mask.shape[0] * background_mask.shape[1])
-        # Use numpy masked array to calculate mean of background pixels
-        masked_gray = np.ma.array(gray, mask=(background_mask == 0))
-        avg_background_brightness = masked_gray.mean() if np.any(background_mask > 0) else 0
-        
+        background_pixels = cv2.countNonZero(background_mask)
+        background_percentage = background_pixels / (background_mask.shape[0] * background_mask.shape[1])
+        avg_background_brightness = cv2.mean(gray, mask=background_mask)[0] if background_pixels else 0
+        return background_mask, background_percentage, avg_background_brightness
+
+    def is_bright_background(self, background_percentage, background_brightness):
+        """True if enough of the image is background and it is bright enough"""
+        return background_percentage > 0.3 and background_brightness > self.min_background_brightness
+
+    def check_background_brightness(self, img, gray=None):
+        """Check if the image has a white/bright background"""
+        if gray is None:
+            gray = self.to_gray(img)
+            
+        background_mask, background_percentage, avg_background_brightness = self.measure_background(gray)
         background_score = background_percentage * (avg_background_brightness / 255) * 10
-        has_bright_background = background_percentage > 0.3 and avg_background_brightness > self.min_background_brightness
+        has_bright_background = self.is_bright_background(background_percentage, avg_background_brightness)
         
         return has_bright_background, background_score, background_mask
 
@@ -78,15 +295,13 @@ class ProductImageSelector:
         
         return object_area_pixels, object_percentage, largest_contour
 
-    def get_image_quality_score(self, img):
+    def get_image_quality_score(self, img, gray=None, original_size=None):
         """Calculate image quality score based on sharpness and resolution"""
-        height, width = img.shape[:2]
+        width, height = original_size or (img.shape[1], img.shape[0])
         resolution_score = min(10, width * height / 1000000)
         
-        if len(img.shape) == 3:
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = img
+        if gray is None:
+            gray = self.to_gray(img)
             
         laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
         sharpness_score = min(10, laplacian_var / 100)
@@ -94,86 +309,435 @@ class ProductImageSelector:
         quality_score = (0.6 * sharpness_score) + (0.4 * resolution_score)
         return quality_score
 
-    def evaluate_image(self, url):
-        """Evaluate an image based on background, object size, and quality"""
-        # Ignore images from the specified domain
-        if url.startswith("https://images.openfoodfacts.org"):
+    def is_ignored(self, url):
+        """Ignore images from the hosts in `ignored_hosts`"""
+        host = urlsplit(url).netloc.lower()
+        if host in self.ignored_hosts:
             logger.info(f"Ignoring image from domain: {url}")
-            return False, 0, 0, 0, None, 0
-        
-        img = self.load_image_from_url(url)
-        if img is None:
-            return False, 0, 0, 0, None, 0
-            
-        has_bright_bg, bg_score, background_mask = self.check_background_brightness(img)
+            return True
+        return False
+
+    def measure_image_data(self, data, url=None):
+        """
+        Decode downloaded image bytes and measure their features (runs in the scoring pool)
+
+        Returns:
+            dict: JSON-serializable features (see measure_image), plus the difference
+                hash and original size; None if the image cannot be decoded
+        """
+        try:
+            image_hash, original_size = self.perceptual_hash(data)
+            with span("decode.thumbnail"):
+                thumbnail = self.decode_thumbnail(data)
+            passed, bright_fraction = self.may_have_bright_background(thumbnail)
+            if not passed:
+                count("select.rejected_by_thumbnail")
+                features = {
+                    "stage": "thumbnail",
+                    "bright_fraction": bright_fraction,
+                    # Approximate background score, only used in the score log
+                    "bg_score": bright_fraction * (thumbnail.mean() / 255) * 10,
+                }
+            else:
+                with span("decode.full"):
+                    img = self.decode_image(data)
+                features, _ = self.measure_image(img, original_size)
+        except Exception as e:
+            logger.warning(f"Could not load image from {url}: {e}")
+            return None
+        features.update(dhash=f"{image_hash:016x}", width=original_size[0], height=original_size[1],
+                        min_background_brightness=self.min_background_brightness)
+        return features
+
+    def measure_image(self, img, original_size=None):
+        """
+        Measure background, object size and quality of a decoded image
+
+        Object size and quality are only measured when the background is bright.
+        If the image was downscaled, `original_size` (width, height) keeps the
+        resolution score and object area in original-resolution units.
+
+        Returns:
+            tuple: (features dict, largest object contour or None)
+        """
+        gray = self.to_gray(img)
+        with span("score.background"):
+            background_mask, background_percentage, background_brightness = self.measure_background(gray)
+        features = {
+            "stage": "full",
+            "background_percentage": background_percentage,
+            "background_brightness": background_brightness,
+            "bg_score": background_percentage * (background_brightness / 255) * 10,
+            "object_area": 0,
+            "object_percentage": 0,
+            "quality_score": 0,
+        }
+        if not self.is_bright_background(background_percentage, background_brightness):
+            return features, None
         
-        if not has_bright_bg:
+        with span("score.object_size"):
+            object_area_pixels, object_percentage, largest_contour = self.get_object_size(img, background_mask)
+        if original_size and original_size != (img.shape[1], img.shape[0]):
+            object_area_pixels *= (original_size[0] * original_size[1]) / (img.shape[0] * img.shape[1])
+        with span("score.quality"):
+            quality_score = self.get_image_quality_score(img, gray, original_size)
+        features.update(object_area=object_area_pixels, object_percentage=object_percentage, quality_score=quality_score)
+        return features, largest_contour
+
+    def evaluation(self, features):
+        """
+        Turn measured features into an evaluation tuple: (has bright background,
+        object area, quality score, object percentage, None, background score)
+
+        The background check is applied with this selector's
+        `min_background_brightness`, so indexed features can be judged under a
+        stricter threshold than the one they were measured with.
+        """
+        if features is None:
+            return REJECTED
+        bg_score = features["bg_score"]
+        if features["stage"] != "full" or not self.is_bright_background(features["background_percentage"],
+                                                                         features["background_brightness"]):
             return False, 0, 0, 0, None, bg_score
+        return True, features["object_area"], features["quality_score"], features["object_percentage"], None, bg_score
+
+    def evaluate_images(self, urls):
+        """
+        Evaluate several candidate URLs concurrently
+
+        Downloads run on a thread pool. With `dedup` off each image is scored as
+        soon as it arrives; with it on, scoring starts once all candidates are
+        downloaded and near-duplicates are dropped, and skipped copies get the
+        REJECTED result. Results are returned in the order of `urls`; in
+        `early_exit` mode candidates after the first good-enough one are REJECTED
+        without being downloaded.
+
+        Decode and scoring spans are only recorded when scoring runs in-process;
+        with a scoring pool the "select.evaluate" span covers the whole batch.
+        """
+        with span("select.evaluate"):
+            return self._evaluate_images(urls)
+
+    def _evaluate_images(self, urls):
+        pool = _get_scoring_pool(self.scoring_workers)
+        count("select.candidates", len(urls))
+        wanted = [not self.is_ignored(url) for url in urls]
+        if self.dedup:
+            wanted = self._drop_url_variants(urls, wanted)
+        feature_index = get_feature_index() if self.use_index else None
+        indexed = {}
+        if feature_index is not None:
+            indexed = feature_index.lookup([url for url, keep in zip(urls, wanted) if keep], self.scoring_key())
+        known = [indexed.get(url) if keep else None for url, keep in zip(urls, wanted)]
+        if self.early_exit:
+            return self._evaluate_until_good_enough(urls, wanted, known, pool, feature_index)
+
+        fetch = [keep and features is None for keep, features in zip(wanted, known)]
+        with ThreadPoolExecutor(max_workers=max(1, self.download_workers)) as downloader:
+            if not self.dedup:
+                downloads = [downloader.submit(self.download_image, url) if needed else None
+                             for url, needed in zip(urls, fetch)]
+                return self._score_downloads(urls, (download.result() if download else None for download in downloads),
+                                             pool, known, feature_index)
+            downloads = list(downloader.map(lambda item: self.download_image(item[0]) if item[1] else None,
+                                            zip(urls, fetch)))
+
+        with span("select.dedup"):
+            duplicates = self.find_duplicates(
+                [(index, data) for index, data in enumerate(downloads) if data is not None],
+                [(index, *self._indexed_hash(features)) for index, features in enumerate(known) if features is not None]
+            )
+        for index, original in sorted(duplicates.items()):
+            logger.info(f"Skipping near-duplicate {urls[index]} (same image as {urls[original]})")
+            downloads[index] = None
+            known[index] = None
+        count("select.duplicates_skipped", len(duplicates))
+        return self._score_downloads(urls, downloads, pool, known, feature_index)
+
+    def evaluate_indexed(self, urls, features):
+        """
+        Evaluate candidates from already measured features, without downloads
+
+        Ignored hosts, URL variants and near-duplicates are skipped as in
+        evaluate_images, so the result matches a fresh selection over the same
+        features. Candidates missing from `features` are REJECTED.
+
+        Args:
+            urls (list): Candidate URLs in search-rank order
+            features (dict): URL -> features (see FeatureIndex.lookup)
+        """
+        wanted = [not self.is_ignored(url) and url in features for url in urls]
+        if self.dedup:
+            wanted = self._drop_url_variants(urls, wanted)
+            duplicates = self.find_duplicates([], [(index, *self._indexed_hash(features[url]))
+                                                   for index, url in enumerate(urls) if wanted[index]])
+            for index in duplicates:
+                wanted[index] = False
+        return [self.evaluation(features[url]) if keep else REJECTED for url, keep in zip(urls, wanted)]
+
+    def is_good_enough(self, evaluation):
+        """True if an evaluation meets every early-exit threshold"""
+        has_bright_bg, _, quality_score, object_percentage, _, bg_score = evaluation
+        return (has_bright_bg and bg_score >= self.min_bg_score
+                and object_percentage >= self.min_object_percentage
+                and quality_score >= self.min_quality_score)
+
+    def _evaluate_until_good_enough(self, urls, wanted, known, pool, feature_index):
+        """
+        Evaluate candidates in rank order and stop at the first good-enough one
+
+        Near-duplicates are resolved as in the full scan: a later copy with more
+        pixels replaces the kept one, otherwise it is skipped.
+        """
+        order = [index for index, keep in enumerate(wanted) if keep]
+        results = [REJECTED] * len(urls)
+        kept = []  # [hash, index, pixel count] per distinct image
+        downloads = {}
+        submitted = 0
+        evaluated = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.early_exit_prefetch + 1)) as downloader:
+            for position, index in enumerate(order):
+                # Keep the current candidate and the next `early_exit_prefetch` downloading
+                while submitted < len(order) and submitted <= position + self.early_exit_prefetch:
+                    if known[order[submitted]] is None:
+                        downloads[order[submitted]] = downloader.submit(self.download_image, urls[order[submitted]])
+                    submitted += 1
+                evaluated += 1
+                features = known[index]
+                if features is not None:
+                    count("select.features_reused")
+                    image_hash, pixels = self._indexed_hash(features)
+                else:
+                    data = downloads.pop(index).result()
+                    if data is None:
+                        continue
+                    image_hash = None
+                    if self.dedup:
+                        try:
+                            image_hash, (width, height) = self.perceptual_hash(data)
+                            pixels = width * height
+                        except Exception:
+                            pass
+
+                if self.dedup and image_hash is not None:
+                    original = next((entry for entry in kept
+                                     if bin(image_hash ^ entry[0]).count("1") <= self.dedup_distance), None)
+                    if original is None:
+                        kept.append([image_hash, index, pixels])
+                    elif pixels > original[2]:
+                        logger.info(f"Skipping near-duplicate {urls[original[1]]} (same image as {urls[index]})")
+                        count("select.duplicates_skipped")
+                        results[original[1]] = REJECTED
+                        original[1:] = [index, pixels]
+                    else:
+                        logger.info(f"Skipping near-duplicate {urls[index]} (same image as {urls[original[1]]})")
+                        count("select.duplicates_skipped")
+                        continue
+
+                if features is None:
+                    pending = self._start_measure(urls[index], data, pool, feature_index)
+                    features = self._finish_measure(urls[index], *pending, feature_index)
+                results[index] = self.evaluation(features)
+
+                if self.is_good_enough(results[index]):
+                    cancelled = sum(1 for future in downloads.values() if future.cancel())
+                    avoided = sum(1 for later in order[submitted:] if known[later] is None) + cancelled
+                    logger.info(f"Early exit at candidate {position + 1} of {len(urls)} ({urls[index]}): "
+                                f"{avoided} downloads avoided")
+                    count("select.early_exits")
+                    count("select.downloads_avoided", avoided)
+                    break
+            else:
+                logger.info(f"No candidate met the early-exit thresholds; evaluated all {evaluated}")
+        return results
+
+    def _drop_url_variants(self, urls, wanted):
+        """Download only one URL per canonical form, preferring the largest hinted size"""
+        best = {}
+        for index, url in enumerate(urls):
+            if not wanted[index]:
+                continue
+            canonical, hint = canonicalize_url(url)
+            # URLs without a size hint usually point at the original file
+            size = float("inf") if hint is None else hint
+            if canonical not in best or size > best[canonical][1]:
+                best[canonical] = (index, size)
+        keep = {index for index, _ in best.values()}
+        skipped = [index for index, flag in enumerate(wanted) if flag and index not in keep]
+        for index in skipped:
+            logger.info(f"Skipping URL variant {urls[index]}")
+        count("select.url_variants_skipped", len(skipped))
+        return [index in keep for index in range(len(urls))]
+
+    def _indexed_hash(self, features):
+        """Difference hash and pixel count of an image from its indexed features"""
+        return int(features["dhash"], 16), features["width"] * features["height"]
+
+    def _start_measure(self, url, data, pool, feature_index):
+        """
+        Start measuring downloaded bytes, in-process or on the scoring pool
+
+        Returns:
+            tuple: (content hash to add to the index or None, features or a Future of them)
+        """
+        sha256 = None
+        if feature_index is not None:
+            # The same file behind another URL was already measured
+            sha256 = hashlib.sha256(data).hexdigest()
+            features = feature_index.lookup_content(url, sha256, self.scoring_key())
+            if features is not None:
+                return None, features
+        if pool is not None:
+            return sha256, pool.submit(self.measure_image_data, data, url)
+        return sha256, self.measure_image_data(data, url)
+
+    def _finish_measure(self, url, sha256, features, feature_index):
+        """Wait for a measurement started by _start_measure and add it to the index"""
+        if isinstance(features, Future):
+            features = features.result()
+        if sha256 and features is not None:
+            feature_index.add(url, sha256, self.scoring_key(), features)
+        return features
+
+    def _score_downloads(self, urls, downloads, pool, known=None, feature_index=None):
+        """
+        Score downloaded bytes in `urls` order, in-process or on the scoring pool
+
+        Candidates with features in `known` (aligned with `urls`) are not scored
+        again; new measurements are added to `feature_index`.
+        """
+        known = known or [None] * len(urls)
+        pending = []
+        for url, data, features in zip(urls, downloads, known):
+            if features is not None:
+                count("select.features_reused")
+                pending.append((None, features))
+            elif data is None:
+                pending.append((None, None))
+            else:
+                pending.append(self._start_measure(url, data, pool, feature_index))
+        return [self.evaluation(self._finish_measure(url, sha256, features, feature_index))
+                for url, (sha256, features) in zip(urls, pending)]
+
+    def choose_best_image(self, urls, evaluations):
+        """
+        Pick the best candidate from its evaluations
+
+        Candidates without a bright background are dropped. The one with the
+        largest object wins, unless others come within `size_band` of it; those
+        are ranked by `selection_weights` applied to the relative object size,
+        quality and background score.
+
+        Returns:
+            str: URL of the best image, or None if no candidate has a bright background
+        """
+        bright_bg_images = [
+            (url, object_area_pixels, quality_score, bg_score)
+            for url, (has_bright_bg, object_area_pixels, quality_score, _, _, bg_score) in zip(urls, evaluations)
+            if has_bright_bg
+        ]
+        if not bright_bg_images:
+            return None
         
-        object_area_pixels, object_percentage, largest_contour = self.get_object_size(img, background_mask)
-        quality_score = self.get_image_quality_score(img)
+        bright_bg_images.sort(key=lambda x: x[1], reverse=True)
+        best_image_url, largest_object_size, _, _ = bright_bg_images[0]
         
-        return has_bright_bg, object_area_pixels, quality_score, object_percentage, largest_contour, bg_score
-
-    def select_best_images(self):
-        """Process CSV and select the best image for each product"""
-        df = pd.read_csv(self.input_csv)
-        results = []
+        similar_size_images = [
+            (url, size, q_score, b_score) for url, size, q_score, b_score in bright_bg_images
+            if size >= largest_object_size * self.size_band
+        ]
         
-        for (brand, product_name), group in df.groupby(['brand', 'product_name']):
-            logger.info(f"Processing product: {brand} - {product_name}")
-            
-            bright_bg_images = []
-            scores_table = []
+        if len(similar_size_images) > 1:
+            size_weight, quality_weight, background_weight = self.selection_weights
+            weighted_scores = []
+            for url, size, q_score, b_score in similar_size_images:
+                norm_size = size / largest_object_size
+                weighted_score = (size_weight * norm_size) + (quality_weight * q_score / 10) + (background_weight * b_score / 10)
+                weighted_scores.append((url, weighted_score))
             
-            for _, row in group.iterrows():
-                url = row['image_url']
-                has_bright_bg, object_area_pixels, quality_score, obj_pct, _, bg_score = self.evaluate_image(url)
-                
-                status = "✓" if has_bright_bg else "✗"
-                scores_table.append((
-                    url, status, object_area_pixels, 
-                    round(quality_score, 2), f"{obj_pct:.1%}", round(bg_score, 2)
-                ))
-                
-                if has_bright_bg:
-                    bright_bg_images.append((url, object_area_pixels, quality_score, bg_score))
-            
-            bright_bg_images.sort(key=lambda x: x[1], reverse=True)
-            
-            best_image_url = None
-            if bright_bg_images:
-                best_image_url, largest_object_size, quality_score, bg_score = bright_bg_images[0]
-                
-                similar_size_images = [
-                    (url, size, q_score, b_score) for url, size, q_score, b_score in bright_bg_images
-                    if size >= largest_object_size * 0.95
-                ]
-                
-                if len(similar_size_images) > 1:
-                    weighted_scores = []
-                    for url, size, q_score, b_score in similar_size_images:
-                        norm_size = size / largest_object_size
-                        weighted_score = (0.7 * norm_size) + (0.2 * q_score / 10) + (0.1 * b_score / 10)
-                        weighted_scores.append((url, weighted_score))
-                    
-                    best_image_url, _ = max(weighted_scores, key=lambda x: x[1])
-            
-            logger.info(f"Scores for {brand} - {product_name}:")
-            for score_row in sorted(scores_table, key=lambda x: x[2] if x[1] == "✓" else 0, reverse=True):
-                logger.info(f"  {score_row[0]}: {score_row[1]} {score_row[2]} (q:{score_row[3]}, {score_row[4]}, bg:{score_row[5]})")
+            best_image_url, _ = max(weighted_scores, key=lambda x: x[1])
+        return best_image_url
+
+    def select_best_image(self, brand, product_name, urls):
+        """
+        Score candidate URLs for one product and return the best one
+
+        With `use_index`, the candidate list and the pick are recorded in the
+        feature index for rerank.py.
+
+        Args:
+            brand (str): Product brand
+            product_name (str): Product name
+            urls (iterable): Candidate image URLs in search-rank order
+
+        Returns:
+            str: URL of the best image, or None if no candidate has a bright background
+        """
+        logger.info(f"Processing product: {brand} - {product_name}")
+        
+        urls = list(urls)
+        evaluations = self.evaluate_images(urls)
+        scores_table = []
+        for url, evaluation in zip(urls, evaluations):
+            has_bright_bg, object_area_pixels, quality_score, obj_pct, _, bg_score = evaluation
             
+            status = "✓" if has_bright_bg else "✗"
+            scores_table.append((
+                url, status, object_area_pixels, 
+                round(quality_score, 2), f"{obj_pct:.1%}", round(bg_score, 2)
+            ))
+        
+        best_image_url = self.choose_best_image(urls, evaluations)
+        
+        logger.info(f"Scores for {brand} - {product_name}:")
+        for score_row in sorted(scores_table, key=lambda x: x[2] if x[1] == "✓" else 0, reverse=True):
+            logger.info(f"  {score_row[0]}: {score_row[1]} {score_row[2]} (q:{score_row[3]}, {score_row[4]}, bg:{score_row[5]})")
+        
+        if best_image_url:
+            logger.info(f"Selected best image for {brand} - {product_name}: {best_image_url}")
+        else:
+            logger.warning(f"No suitable image found for {brand} - {product_name}")
+        feature_index = get_feature_index() if self.use_index else None
+        if feature_index is not None:
+            feature_index.record_candidates(brand, product_name, urls, best_image_url)
+        return best_image_url
+
+    def iter_best_images(self, records):
+        """
+        Select the best image per product from a stream of candidate records
+
+        Records for the same product must be consecutive, as produced by
+        image_search.iter_image_records. Each product is scored as soon as its
+        last candidate has arrived.
+
+        Args:
+            records (iterable): Dicts with 'brand', 'product_name' and 'image_url' keys
+
+        Yields:
+            dict: {'brand', 'product_name', 'image_url'} for every product with a suitable image
+        """
+        for (brand, product_name), group in groupby(records, key=lambda r: (r['brand'], r['product_name'])):
+            best_image_url = self.select_best_image(brand, product_name, (row['image_url'] for row in group))
             if best_image_url:
-                logger.info(f"Selected best image for {brand} - {product_name}: {best_image_url}")
-                results.append({
+                yield {
                     'brand': brand,
                     'product_name': product_name,
                     'image_url': best_image_url
-                })
-            else:
-                logger.warning(f"No suitable image found for {brand} - {product_name}")
+                }
+
+    def select_best_images(self):
+        """Process CSV and select the best image for each product"""
+        with open(self.input_csv, "r", newline="") as infile:
+            rows = list(csv.DictReader(infile))
+        # Products are processed in sorted order, matching the previous DataFrame.groupby behaviour
+        rows.sort(key=lambda r: (r['brand'], r['product_name']))
+        
+        results = list(self.iter_best_images(rows))
         
-        pd.DataFrame(results).to_csv(self.output_csv, index=False)
+        with open(self.output_csv, "w", newline="") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=['brand', 'product_name', 'image_url'])
+            writer.writeheader()
+            writer.writerows(results)
         logger.info(f"Saved best images to {self.output_csv}")
 
 
@@ -1,86 +1,236 @@
 import openai
 import sys
-import time
 import os
 import json
 import base64
+import socket
+import ipaddress
 import requests
+from io import BytesIO
+from urllib.parse import urlparse
+from PIL import Image, ImageOps, UnidentifiedImageError
 from openai import OpenAI
+from response_cache import cached_chat_completion
+from download_cache import fetch_bytes, get_download_cache
+from scheduler import ProviderUnavailable
+from instrumentation import count
+
+# How the input photo is sent to the vision model:
+#   "optimized" - downscaled/re-encoded inline image (default)
+#   "raw"       - the downloaded bytes, inlined unchanged
+#   "url"       - the photo URL itself when it is publicly reachable, else "optimized"
+VISION_PAYLOAD = os.getenv("VISION_PAYLOAD", "optimized")
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", 1024))
+VISION_QUALITY = int(os.getenv("VISION_QUALITY", 85))
+VISION_DETAIL = os.getenv("VISION_DETAIL", "auto")  # "low", "high" or "auto"
+
+# Formats the vision API accepts inline
+_INLINE_FORMATS = {"JPEG", "PNG", "WEBP", "GIF"}
+
+def _raw_mime(image_url, content):
+    """MIME type of downloaded bytes: sniffed by PIL, else the server's Content-Type, else JPEG."""
+    try:
+        return Image.MIME.get(Image.open(BytesIO(content)).format, "image/jpeg")
+    except (UnidentifiedImageError, OSError):
+        content_type = get_download_cache().content_type(image_url) or ""
+        return content_type.split(";")[0].strip() if content_type.startswith("image/") else "image/jpeg"
 
 def image_to_base64(image_url):
     """
-    Downloads an image from a URL and converts it to a base64-encoded string.
+    Downloads an image from a URL and converts it to a base64 data URL with its real MIME type.
+
+    Formats PIL cannot open (e.g. HEIC) are sent unchanged, like before the MIME detection.
     """
     try:
-        response = requests.get(image_url)
-        if response.status_code == 200:
-            return f"data:image/jpeg;base64,{base64.b64encode(response.content).decode()}"
-        else:
-            print(f"Failed to fetch image: HTTP {response.status_code}")
-            return None
+        content = fetch_bytes(image_url, timeout=30)
+        return f"data:{_raw_mime(image_url, content)};base64,{base64.b64encode(content).decode()}"
+    except requests.HTTPError as e:
+        print(f"Failed to fetch image: HTTP {e.response.status_code}")
+        return None
     except Exception as e:
         print(f"Error fetching image: {str(e)}")
         return None
 
-def get_brand_and_product(client, image_url):
+def optimize_image(data, max_side=VISION_MAX_SIDE, quality=VISION_QUALITY):
     """
-    Identify the brand and product name from an image.
-    Converts the image to a base64 string for OpenAI API.
+    Shrink image bytes for the vision model.
+
+    Images larger than `max_side` are downscaled (JPEGs are decoded at reduced
+    size) and re-encoded as JPEG at `quality`, upright according to their EXIF
+    orientation. Smaller upright images in a supported format are only replaced
+    if the JPEG re-encode is smaller.
+
+    Returns:
+        tuple: (bytes, MIME type)
     """
-    image_base64 = image_to_base64(image_url)
-    if not image_base64:
-        return None, None  # Exit if image fetching fails
-    
-    prompt = """Identify the brand and product name from this image.
+    img = Image.open(BytesIO(data))
+    original_format = img.format
+    fits = max(img.size) <= max_side
+    upright = img.getexif().get(0x0112, 1) == 1  # EXIF Orientation
+    if not fits:
+        img.draft("RGB", (max_side, max_side))
+    # Phone photos are often stored sideways with an orientation tag, which re-encoding drops
+    img = ImageOps.exif_transpose(img)
+    if not fits:
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+    if img.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency on white, like a product page would show it
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel("A"))
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    encoded = buffer.getvalue()
+    if fits and upright and original_format in _INLINE_FORMATS and len(encoded) >= len(data):
+        return data, Image.MIME[original_format]
+    return encoded, "image/jpeg"
+
+def is_public_url(image_url):
+    """True if the URL is http(s) and its host resolves only to public addresses."""
+    parsed = urlparse(image_url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, parsed.port or 443)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split("%")[0]).is_global for address in addresses)
+
+def image_payload(image_url, mode=None, detail=None):
+    """
+    Build the image_url content part for the vision request.
+
+    Args:
+        image_url (str): Input photo URL
+        mode (str): "optimized", "raw" or "url" (defaults to VISION_PAYLOAD)
+        detail (str): Vision detail level (defaults to VISION_DETAIL)
+
+    Returns:
+        tuple: (image_url part dict or None if the image could not be fetched,
+            stats dict with "mode", "original_bytes" and "upload_bytes")
+    """
+    mode = mode or VISION_PAYLOAD
+    detail = detail or VISION_DETAIL
+    if mode == "url" and is_public_url(image_url):
+        return {"url": image_url, "detail": detail}, {"mode": "url", "original_bytes": 0, "upload_bytes": len(image_url)}
+
+    if mode == "raw":
+        data_url = image_to_base64(image_url)
+        if not data_url:
+            return None, {"mode": mode}
+        return {"url": data_url, "detail": detail}, {"mode": mode, "original_bytes": len(data_url) * 3 // 4,
+                                                     "upload_bytes": len(data_url)}
+
+    try:
+        content = fetch_bytes(image_url, timeout=30)
+        try:
+            encoded, mime = optimize_image(content)
+        except (UnidentifiedImageError, OSError):
+            # PIL cannot decode it (e.g. HEIC): send the original bytes
+            encoded, mime = content, _raw_mime(image_url, content)
+    except requests.HTTPError as e:
+        print(f"Failed to fetch image: HTTP {e.response.status_code}")
+        return None, {"mode": "optimized"}
+    except Exception as e:
+        print(f"Error fetching image: {str(e)}")
+        return None, {"mode": "optimized"}
+    data_url = f"data:{mime};base64,{base64.b64encode(encoded).decode()}"
+    return {"url": data_url, "detail": detail}, {"mode": "optimized", "original_bytes": len(content),
+                                                 "upload_bytes": len(data_url)}
+
+def has_brand_and_product(content):
+    """Only well-formed answers are worth caching."""
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and bool(str(data.get("brand", "")).strip()) and bool(str(data.get("product_name", "")).strip())
+
+def _report_payload(stats, usage):
+    """Print and count the size, latency and token cost of one vision request."""
+    count("vision.requests")
+    count("vision.upload_bytes", stats["upload_bytes"])
+    count("vision.original_bytes", stats["original_bytes"])
+    if usage.get("cached"):
+        print(f"Vision payload ({stats['mode']}): {stats['upload_bytes'] / 1024:.0f} KB, answered from cache")
+        return
+    count("vision.prompt_tokens", usage.get("prompt_tokens") or 0)
+    print(f"Vision payload ({stats['mode']}): {stats['upload_bytes'] / 1024:.0f} KB uploaded "
+          f"(source {stats['original_bytes'] / 1024:.0f} KB), {usage.get('seconds', 0):.2f}s, "
+          f"{usage.get('prompt_tokens')} prompt tokens")
+
+BRAND_PROMPT = """Identify the brand and product name from this image.
     Return a JSON object in the format:
     {
         "brand": "<brand_name>",
         "product_name": "<product_name>"
     }
     Ensure the response is strictly in English."""
+
+def brand_request(image_part):
+    """
+    Chat completion arguments for identifying a product photo.
+
+    Args:
+        image_part (dict): image_url content part (see image_payload)
+    """
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant. Ensure responses are strictly in JSON format."},
+            {"role": "user", "content": [
+                {"type": "text", "text": BRAND_PROMPT},
+                {"type": "image_url", "image_url": image_part}
+            ]}
+        ],
+        "max_tokens": 200,
+        "response_format": {"type": "json_object"}
+    }
+
+def parse_brand_response(content):
+    """Return (brand, product_name) from the model's answer, or (None, None) if it is unusable."""
+    content = (content or "").strip()
+    print(f"Raw OpenAI Response: {content}")  # Debugging log
+    
+    try:
+        data = json.loads(content)
+        brand = data.get("brand", "").strip()
+        product_name = data.get("product_name", "").strip()
+    except json.JSONDecodeError:
+        print("Error: Response is not in JSON format.")
+        return None, None
     
-    max_retries = 3
-    current_retry = 0
+    if not brand or not product_name:
+        print("Error: Brand or product name not detected properly.")
+        return None, None
     
-    while current_retry < max_retries:
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant. Ensure responses are strictly in JSON format."},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": image_base64}}
-                    ]}
-                ],
-                max_tokens=200,
-                response_format={"type": "json_object"}
-            )
-
-            content = response.choices[0].message.content.strip()
-            print(f"Raw OpenAI Response: {content}")  # Debugging log
-            
-            try:
-                data = json.loads(content)
-                brand = data.get("brand", "").strip()
-                product_name = data.get("product_name", "").strip()
-            except json.JSONDecodeError:
-                print("Error: Response is not in JSON format.")
-                return None, None
-            
-            if not brand or not product_name:
-                print("Error: Brand or product name not detected properly.")
-                return None, None
-            
-            return brand, product_name
-            
-        except Exception as e:
-            current_retry += 1
-            print(f"Error occurred: {str(e)}. Retrying... Attempt {current_retry}/{max_retries}")
-            time.sleep(5 * current_retry)
-
-    print("Failed after maximum retry attempts.")
-    return None, None
+    return brand, product_name
+
+def get_brand_and_product(client, image_url):
+    """
+    Identify the brand and product name from an image.
+    The image is sent as configured by VISION_PAYLOAD (see image_payload).
+    """
+    image_part, payload_stats = image_payload(image_url)
+    if not image_part:
+        return None, None  # Exit if image fetching fails
+    
+    # Transient API errors are retried by the shared scheduler (see scheduler.py)
+    usage = {}
+    try:
+        content = cached_chat_completion(client, validate=has_brand_and_product, usage=usage,
+                                         **brand_request(image_part))
+    except ProviderUnavailable:
+        raise
+    except Exception as e:
+        print(f"Error occurred: {str(e)}")
+        return None, None
+
+    _report_payload(payload_stats, usage)
+    return parse_brand_response(content)
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
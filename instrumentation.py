@@ -0,0 +1,216 @@
+import json
+import time
+import random
+import resource
+import threading
+from contextlib import contextmanager
+
+_enabled = False
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_started_at = None
+
+# Durations kept per span for the percentiles; count, total and max are exact
+RESERVOIR_SIZE = 1024
+
+
+class _NullSpan:
+    """Shared no-op context manager returned while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _SpanStats:
+    """Running totals of one span plus a uniform sample of its durations (reservoir sampling)."""
+    __slots__ = ("count", "total", "max", "samples", "_random")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+        self._random = random.Random(0)
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(elapsed)
+        else:
+            slot = self._random.randrange(self.count)
+            if slot < RESERVOIR_SIZE:
+                self.samples[slot] = elapsed
+
+
+class _Span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        with _lock:
+            stats = _spans.get(self.name)
+            if stats is None:
+                stats = _spans[self.name] = _SpanStats()
+            stats.add(elapsed)
+            if exc_type is not None:
+                _counters[f"errors.{self.name}"] = _counters.get(f"errors.{self.name}", 0) + 1
+        return False
+
+
+def enable():
+    """Start collecting spans and counters (clears previous data)."""
+    global _enabled, _started_at
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _started_at = time.perf_counter()
+        _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name):
+    """
+    Time a block of code under `name`.
+
+    Returns a shared no-op context manager when instrumentation is disabled, so
+    call sites cost one function call and one flag check.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, value=1):
+    """Add `value` to the counter `name` (no-op when disabled)."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def report():
+    """
+    Return the collected data as a dict.
+
+    Spans are summarized as count, total, mean, p50, p95 and max seconds (the
+    percentiles are estimated from up to RESERVOIR_SIZE sampled durations);
+    counters are returned as-is, and process CPU time and peak RSS are included.
+    """
+    with _lock:
+        spans = {name: (stats.count, stats.total, stats.max, sorted(stats.samples))
+                 for name, stats in _spans.items()}
+        counters = dict(_counters)
+        wall = time.perf_counter() - _started_at if _started_at is not None else 0.0
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "wall_seconds": wall,
+        "spans": {
+            name: {
+                "count": span_count,
+                "total_seconds": total,
+                "mean_seconds": total / span_count,
+                "p50_seconds": _percentile(samples, 0.5),
+                "p95_seconds": _percentile(samples, 0.95),
+                "max_seconds": longest,
+            }
+            for name, (span_count, total, longest, samples) in sorted(spans.items())
+        },
+        "counters": dict(sorted(counters.items())),
+        "resources": {
+            "cpu_user_seconds": usage.ru_utime,
+            "cpu_system_seconds": usage.ru_stime,
+            "max_rss_kb": usage.ru_maxrss,
+        },
+    }
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(data=None):
+    """Render a report in the Prometheus text exposition format."""
+    data = data or report()
+    lines = [
+        "# HELP pipeline_span_seconds Time spent in instrumented pipeline spans.",
+        "# TYPE pipeline_span_seconds summary",
+    ]
+    for name, stats in data["spans"].items():
+        label = _label(name)
+        lines.append(f'pipeline_span_seconds{{span="{label}",quantile="0.5"}} {stats["p50_seconds"]:.6f}')
+        lines.append(f'pipeline_span_seconds{{span="{label}",quantile="0.95"}} {stats["p95_seconds"]:.6f}')
+        lines.append(f'pipeline_span_seconds_sum{{span="{label}"}} {stats["total_seconds"]:.6f}')
+        lines.append(f'pipeline_span_seconds_count{{span="{label}"}} {stats["count"]}')
+    lines += [
+        "# HELP pipeline_events_total Pipeline counters (API calls, retries, bytes, cache hits).",
+        "# TYPE pipeline_events_total counter",
+    ]
+    for name, value in data["counters"].items():
+        lines.append(f'pipeline_events_total{{name="{_label(name)}"}} {value}')
+    lines += [
+        "# TYPE pipeline_wall_seconds gauge",
+        f"pipeline_wall_seconds {data['wall_seconds']:.6f}",
+        "# TYPE process_cpu_seconds_total counter",
+        f"process_cpu_seconds_total {data['resources']['cpu_user_seconds'] + data['resources']['cpu_system_seconds']:.6f}",
+        "# TYPE process_max_resident_memory_kilobytes gauge",
+        f"process_max_resident_memory_kilobytes {data['resources']['max_rss_kb']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def write_report(path):
+    """Write the report to `path`: Prometheus text for .prom/.txt files, JSON otherwise."""
+    data = report()
+    with open(path, "w") as outfile:
+        if path.endswith((".prom", ".txt")):
+            outfile.write(to_prometheus(data))
+        else:
+            json.dump(data, outfile, indent=2)
+    return data
+
+
+@contextmanager
+def profiling(path):
+    """Enable instrumentation for a block and write the report to `path` afterwards (no-op if path is None)."""
+    if not path:
+        yield
+        return
+    enable()
+    try:
+        yield
+    finally:
+        write_report(path)
+        disable()
+        print(f"Profile report written to {path}")
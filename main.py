@@ -1,103 +1,132 @@
-import sys
-import pandas as pd
-from description import create_description
-from category1 import create_category_level_1
-from category2 import create_category_level_2
-from dotenv import load_dotenv
 import os
-from image_search import fetch_images
-from image_selector import ProductImageSelector
-from backgroundrm import process_image
-from image_to_brand import get_brand_and_product
-from openai import OpenAI
 import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+from dotenv import load_dotenv
+from instrumentation import profiling
 
 # Load environment variables from .env
 load_dotenv()
 
+# Same as backgroundrm.ENGINES; repeated so that submitting to a running service
+# does not import the pipeline (see service.py)
+ENGINES = ("replicate", "local", "auto")
+# Seconds each status request to the service is held open while the job runs
+SERVICE_POLL_SECONDS = 30
+
+
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python main.py <image_url>")
-        return
+    parser = argparse.ArgumentParser(description="Run the product pipeline for one image URL.")
+    parser.add_argument("image_url", help="URL of the product photo")
+    parser.add_argument("--enrichment", choices=["stepwise", "structured"], default="stepwise",
+                        help="Generate description and categories with three prompts or one structured call")
+    parser.add_argument("--store", default="products.db", help="Product store database")
+    parser.add_argument("--download-workers", type=int, default=8, help="Candidate images downloaded concurrently")
+    parser.add_argument("--scoring-workers", type=int, default=0,
+                        help="Processes used to score candidate images (0 scores in the main process)")
+    parser.add_argument("--background-engine", choices=ENGINES, default=None,
+                        help="Background removal engine (default: BACKGROUND_ENGINE or replicate)")
+    parser.add_argument("--early-exit", action="store_true",
+                        help="Stop evaluating candidate images once one meets the quality thresholds")
+    parser.add_argument("--force", action="store_true", help="Reprocess products that are already stored")
+    parser.add_argument("--export-csv", metavar="PATH", help="Also export the catalog as CSV (e.g. data.csv)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write per-stage timings and counters to PATH (.prom for Prometheus text, else JSON)")
+    parser.add_argument("--server", metavar="URL", default=os.getenv("PIPELINE_SERVER"),
+                        help="Submit the image to a running pipeline service (python service.py) instead of "
+                             "processing it here; the service's own settings apply except --enrichment "
+                             "and --force (default: PIPELINE_SERVER; if unset, the whole pipeline runs in this process)")
+    args = parser.parse_args()
 
-    image_url = sys.argv[1]
-    
-    # Retrieve API key from environment variable
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OpenAI API key is missing. Set the environment variable OPENAI_API_KEY.")
-    
-    # Initialize OpenAI client
-    client = OpenAI(api_key=api_key)
-    
-    # Extract brand and product name from image
-    brand, product_name = get_brand_and_product(client, image_url)
-    
-    if not brand or not product_name:
-        print("Failed to identify brand and product name. Exiting.")
+    if args.server:
+        submit(args.server, args.image_url, enrichment=args.enrichment, force=args.force)
         return
+    with profiling(args.profile):
+        run(args)
+
+
+def _request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=SERVICE_POLL_SECONDS + 30) as response:
+        return json.load(response)
+
+
+def submit(server, image_url, enrichment=None, force=False):
+    """
+    Process an image URL on a running pipeline service and wait for the result.
+
+    Args:
+        server (str): Base URL of the service, e.g. http://127.0.0.1:8765
+        image_url (str): URL of the product photo
+        enrichment (str): Enrichment mode for this job
+        force (bool): Reprocess the product even if it is already stored
+
+    Returns:
+        dict: The finished job (see service.PipelineService.get), or None if the
+            service could not be reached
+    """
+    server = server.rstrip("/")
+    try:
+        job = _request(f"{server}/jobs", {"image_url": image_url, "enrichment": enrichment, "force": force})
+        print(f"Submitted {image_url} as job {job['id']} ({job['status']})")
+        started = time.monotonic()
+        while job["status"] in ("queued", "running"):
+            job = _request(f"{server}/jobs/{job['id']}?wait={SERVICE_POLL_SECONDS}")
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        print(f"Pipeline service at {server} is not available: {e}")
+        return None
 
-    print(f"Identified Brand: {brand}, Product Name: {product_name}")
-
-    # Generate description
-    description = create_description(brand, product_name)
-
-    # Generate category level 1
-    category_level_1 = create_category_level_1(brand, product_name, description)
-    
-    # Generate category level 2
-    category_level_2 = create_category_level_2(product_name, description, category_level_1)
-
-    # Step 1: Create temporary CSV with product info
-    temp_input_csv = "temp_product.csv"
-    pd.DataFrame({"brand": [brand], "product_name": [product_name]}).to_csv(temp_input_csv, index=False)
-
-    # Step 2: Fetch images using the separated image_search module
-    temp_images_csv = "temp_images.csv"
-    fetch_images(input_csv=temp_input_csv, output_csv=temp_images_csv)
-    
-    # Step 3: Select the best image using the separated image_selector module
-    temp_best_image_csv = "temp_best_image.csv"
-    selector = ProductImageSelector(input_csv=temp_images_csv, output_csv=temp_best_image_csv)
-    selector.select_best_images()
-    
-    # Check if temp_best_image.csv exists and has content
-    if os.path.exists(temp_best_image_csv) and os.stat(temp_best_image_csv).st_size > 0:
-        best_image_df = pd.read_csv(temp_best_image_csv)
-        best_image_url = best_image_df['image_url'].iloc[0] if not best_image_df.empty else None
+    outcome = job["outcome"]
+    if job["status"] == "ok":
+        print(f"Processed {outcome['product']} in {time.monotonic() - started:.1f}s")
+        print(json.dumps(outcome["record"], indent=2))
+    elif job["status"] == "skipped":
+        print(f"{outcome['product']} is already in the catalog. Skipping.")
     else:
-        print("Error: No images found. Exiting.")
+        print(f"{outcome['error']} Exiting.")
+    return job
+
+
+def run(args):
+    """Process the image URL given on the command line in this process and store the result."""
+    # Imported here so that submitting to a running service stays cheap
+    from batch import process_url
+    from openai_client import get_openai_client
+    from product_store import open_store
+    from response_cache import report_cache_stats
+    from taxonomy_classifier import train_from_store
+
+    store = open_store(args.store)
+    if not args.force and store.is_processed(args.image_url):
+        print(f"{args.image_url} has already been processed. Use --force to run it again.")
         return
-    
-    processed_image_path = None
-    if best_image_url:
-        processed_filename = f"{brand}_{product_name.replace(' ', '_')}.png"
-        processed_image_path = process_image(best_image_url, processed_filename)
-        print(f"Image processed and saved to: {processed_image_path}")
-
-    # Clean up temporary files
-    for temp_file in [temp_input_csv, temp_images_csv, temp_best_image_csv]:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-
-    # Load existing CSV or create new one
-    try:
-        data = pd.read_csv("data.csv")
-    except FileNotFoundError:
-        data = pd.DataFrame(columns=["brand", "product_name", "description", "category1", "category2", "image_url", "processed_image_path"])
-
-    new_entry = pd.DataFrame({
-        "brand": [brand],
-        "product_name": [product_name],
-        "description": [description],
-        "category1": [category_level_1],
-        "category2": [category_level_2],
-        "image_url": [best_image_url],
-        "processed_image_path": [processed_image_path]
-    })
-    
-    data = pd.concat([data, new_entry], ignore_index=True)
-    data.to_csv("data.csv", index=False)
+
+    # Shared OpenAI client (raises if OPENAI_API_KEY is missing)
+    client = get_openai_client()
+    # Categories of products similar to stored ones are predicted locally
+    train_from_store(store)
+
+    outcome = process_url(args.image_url, client, store, enrichment=args.enrichment, force=args.force,
+                          selector_options={"download_workers": args.download_workers,
+                                            "scoring_workers": args.scoring_workers,
+                                            "early_exit": args.early_exit},
+                          background_engine=args.background_engine)
+    if outcome["resumed"]:
+        print(f"Resumed {args.image_url}: {', '.join(outcome['resumed'])} already done.")
+    if outcome["status"] == "skipped":
+        print(f"{outcome['product']} is already in the catalog. Skipping.")
+        return
+    if outcome["status"] != "ok":
+        print(f"{outcome['error']} Exiting.")
+        return
+
+    if args.export_csv:
+        store.export_csv(args.export_csv)
+    report_cache_stats()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
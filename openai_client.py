@@ -0,0 +1,28 @@
+import os
+import threading
+from openai import OpenAI
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """
+    Return a process-wide OpenAI client, created on first use.
+
+    The client is thread-safe and keeps its HTTP connection pool between calls,
+    so modules should share it rather than building their own. Its built-in
+    retries are off: calls go through scheduler.call, which owns retries.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OpenAI API key is missing. Set the environment variable OPENAI_API_KEY.")
+            _client = OpenAI(api_key=api_key, max_retries=0)
+        return _client
@@ -0,0 +1,263 @@
+import threading
+from description import create_description
+from category1 import create_category_level_1
+from category2 import create_category_level_2
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from image_search import iter_image_records
+from image_selector import ProductImageSelector
+from backgroundrm import process_image
+from image_to_brand import get_brand_and_product
+from enrichment import enrich_product
+from instrumentation import span
+from scheduler import ProviderUnavailable
+from taxonomy import taxonomy_hash
+
+# Load environment variables from .env
+load_dotenv()
+
+class PipelineError(Exception):
+    """Raised when a product cannot make it through the pipeline."""
+
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+class ProductSkipped(Exception):
+    """Raised when the identified product is already in the catalog."""
+
+    def __init__(self, record):
+        super().__init__(f"{record['brand']} - {record['product_name']} is already in the catalog.")
+        self.record = record
+
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _claim(product):
+    """
+    Claim a (brand, product_name) for this thread, waiting while another thread processes it.
+
+    Returns:
+        dict: The record produced by the thread that held the claim (the caller does not
+            hold the claim then), or None once the caller holds it
+    """
+    while True:
+        with _in_flight_lock:
+            holder = _in_flight.get(product)
+            if holder is None:
+                _in_flight[product] = {"done": threading.Event(), "record": None}
+                return None
+        holder["done"].wait()
+        if holder["record"] is not None:
+            return holder["record"]
+
+
+def _release(product, record=None):
+    """Release a claim taken with _claim, handing `record` to the threads waiting for it."""
+    with _in_flight_lock:
+        holder = _in_flight.pop(product)
+    holder["record"] = record
+    holder["done"].set()
+
+
+def _staged(name, fn, job=None):
+    """
+    Wrap a graph task so its run time is recorded as the "stage.<name>" span.
+
+    With a job record (product_store.Job), a saved output is returned instead of
+    running the task, and new outputs are saved as soon as the task finishes.
+    None results (nothing found or failed) are not saved, so they are retried.
+    A provider that stays unavailable fails the stage with a PipelineError.
+    """
+    def run(**kwargs):
+        if job is not None and name in job:
+            return job.resume(name)
+        try:
+            with span(f"stage.{name}"):
+                result = fn(**kwargs)
+        except ProviderUnavailable as e:
+            raise PipelineError(name, f"{e}") from e
+        if job is not None and result is not None:
+            job.save(name, result)
+        return result
+    return run
+
+
+def run_graph(tasks, max_workers=None):
+    """
+    Run a small dependency graph of tasks, starting each one as soon as its inputs are ready.
+
+    Args:
+        tasks (dict): Task name -> (callable, [dependency names]). The callable is invoked
+            with the results of its dependencies as keyword arguments.
+        max_workers (int): Thread pool size (defaults to the number of tasks)
+
+    Returns:
+        dict: Task name -> result
+
+    Raises:
+        The first exception raised by any task; tasks that have not started are cancelled.
+    """
+    for name, (_, deps) in tasks.items():
+        missing = [dep for dep in deps if dep not in tasks]
+        if missing:
+            raise ValueError(f"Task {name} depends on unknown tasks: {missing}")
+
+    results = {}
+    pending = dict(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks) or 1) as executor:
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    running[executor.submit(fn, **{dep: results[dep] for dep in deps})] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Dependency cycle between tasks: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+
+    return results
+
+
+def process_product(client, image_url, enrichment="stepwise", store=None, selector_options=None,
+                    background_engine=None, job=None, image_dir=None, save=None):
+    """
+    Run every pipeline stage for a single product image.
+
+    Once the brand and product name are known, the text branch (description and
+    categories) and the image branch (search, selection, background removal) run
+    concurrently, since neither depends on the other. Rate limits, concurrency caps
+    and retries of the individual API calls are handled by the shared scheduler.
+
+    Args:
+        client (OpenAI): OpenAI client used for brand extraction
+        image_url (str): URL of the product photo
+        enrichment (str): "stepwise" for separate description/category prompts, or
+            "structured" for a single validated JSON call (see enrichment.py)
+        store (ProductStore): If given, products already in the store are not
+            processed again once identified
+        selector_options (dict): Extra keyword arguments for ProductImageSelector
+        background_engine (str): "replicate", "local" or "auto" (see backgroundrm.py)
+        job (Job): Checkpoint record (see ProductStore.job); stages with a saved
+            output are skipped and every completed stage is saved
+        save (callable): Called with the finished record while the product is still
+            claimed, so no other thread starts on it before it is stored
+
+    Returns:
+        dict: The product record (see product_store.CSV_COLUMNS) with the
+            "taxonomy_hash" its categories were assigned under
+
+    Raises:
+        PipelineError: If a stage fails
+        ProductSkipped: If the identified product is already in `store`, or another
+            thread of this process produced it while this one waited for it
+    """
+    def identify():
+        # Extract brand and product name from image
+        brand, product_name = get_brand_and_product(client, image_url)
+
+        if not brand or not product_name:
+            raise PipelineError("identify", "Failed to identify brand and product name.")
+
+        print(f"Identified Brand: {brand}, Product Name: {product_name}")
+
+        existing = store.get(brand, product_name) if store is not None else None
+        if existing:
+            raise ProductSkipped(existing)
+        return brand, product_name
+
+    def enrich(identify):
+        brand, product_name = identify
+        if enrichment == "structured":
+            return enrich_product(brand, product_name)
+
+        # Generate description
+        description = create_description(brand, product_name)
+
+        # Generate category level 1
+        category_level_1 = create_category_level_1(brand, product_name, description)
+
+        # Generate category level 2
+        category_level_2 = create_category_level_2(product_name, description, category_level_1, brand=brand)
+        return description, category_level_1, category_level_2
+
+    def search(identify):
+        brand, product_name = identify
+        # Step 1: Search candidate images; records are handed over in memory
+        return list(iter_image_records([{"brand": brand, "product_name": product_name}]))
+
+    def select(search):
+        # Step 2: Score the candidates and keep the best one
+        if not search:
+            raise PipelineError("select", "Error: No images found.")
+        selector = ProductImageSelector(**(selector_options or {}))
+        best = next(selector.iter_best_images(search), None)
+        return best["image_url"] if best else None
+
+    def remove_background(identify, select):
+        brand, product_name = identify
+        if not select:
+            return None
+        processed_filename = f"{brand}_{product_name.replace(' ', '_')}.png"
+        processed_image_path = process_image(select, processed_filename, engine=background_engine,
+                                             output_dir=image_dir)
+        print(f"Image processed and saved to: {processed_image_path}")
+        return processed_image_path
+
+    graph = {
+        "identify": (identify, []),
+        "enrich": (enrich, ["identify"]),
+        "search": (search, ["identify"]),
+        "select": (select, ["search"]),
+        "remove_background": (remove_background, ["identify", "select"]),
+    }
+    tasks = {name: (_staged(name, fn, job), deps) for name, (fn, deps) in graph.items()}
+    claimed = []
+    staged_identify = tasks["identify"][0]
+
+    def identify_and_claim():
+        # Two photos of one product may be in flight at once; only the first one is processed
+        product = tuple(staged_identify())
+        record = _claim(product)
+        if record is not None:
+            raise ProductSkipped(record)
+        claimed.append(product)
+        return product
+
+    tasks["identify"] = (identify_and_claim, [])
+    record = None
+    try:
+        results = run_graph(tasks)
+        brand, product_name = results["identify"]
+        description, category_level_1, category_level_2 = results["enrich"]
+        finished = {
+            "brand": brand,
+            "product_name": product_name,
+            "description": description,
+            "category1": category_level_1,
+            "category2": category_level_2,
+            "image_url": results["select"],
+            "processed_image_path": results["remove_background"],
+            "taxonomy_hash": taxonomy_hash(category_level_1)
+        }
+        if save is not None:
+            save(finished)
+        record = finished
+        return record
+    finally:
+        if claimed:
+            _release(claimed[0], record)
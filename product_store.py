@@ -0,0 +1,278 @@
+import os
+import csv
+import json
+import sys
+import time
+import sqlite3
+import threading
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = "products.db"
+LEGACY_CSV_PATH = "data.csv"
+# Background-removed copies of the selected images (see backgroundrm.py)
+PROCESSED_IMAGES_DIR = "processed_images"
+
+# Column layout of the legacy data.csv, kept for CSV import/export
+CSV_COLUMNS = ["brand", "product_name", "description", "category1", "category2", "image_url", "processed_image_path"]
+
+
+class ProductStore:
+    """
+    SQLite-backed product catalog.
+
+    Products are unique on (brand, product_name) and every source photo URL that
+    produced a product is indexed, so "already processed?" checks are single index
+    lookups and each write touches one row. The database runs in WAL mode so several
+    pipeline processes can write to it at once.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS products ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " brand TEXT NOT NULL,"
+                " product_name TEXT NOT NULL,"
+                " description TEXT,"
+                " category1 TEXT,"
+                " category2 TEXT,"
+                " image_url TEXT,"
+                " processed_image_path TEXT,"
+                " updated_at REAL NOT NULL,"
+                " UNIQUE (brand, product_name))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                " source_image_url TEXT PRIMARY KEY,"
+                " brand TEXT NOT NULL,"
+                " product_name TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                " source_image_url TEXT NOT NULL,"
+                " stage TEXT NOT NULL,"
+                " output TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (source_image_url, stage))"
+            )
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(products)")}
+            if "taxonomy_hash" not in columns:
+                # Taxonomy version the categories were assigned with (see taxonomy.py)
+                self._conn.execute("ALTER TABLE products ADD COLUMN taxonomy_hash TEXT")
+
+    def add(self, record, source_image_url=None):
+        """
+        Insert or update a product record.
+
+        Args:
+            record (dict): Product fields (see CSV_COLUMNS), plus an optional "taxonomy_hash"
+            source_image_url (str): Input photo the record was produced from
+        """
+        values = [record.get(column) for column in CSV_COLUMNS]
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO products ({', '.join(CSV_COLUMNS)}, taxonomy_hash, updated_at)"
+                f" VALUES ({', '.join('?' * len(CSV_COLUMNS))}, ?, ?)"
+                " ON CONFLICT (brand, product_name) DO UPDATE SET"
+                " description = excluded.description, category1 = excluded.category1,"
+                " category2 = excluded.category2, image_url = excluded.image_url,"
+                " processed_image_path = excluded.processed_image_path,"
+                " taxonomy_hash = COALESCE(excluded.taxonomy_hash, products.taxonomy_hash),"
+                " updated_at = excluded.updated_at",
+                values + [record.get("taxonomy_hash"), time.time()]
+            )
+            if source_image_url:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sources (source_image_url, brand, product_name) VALUES (?, ?, ?)",
+                    (source_image_url, record["brand"], record["product_name"])
+                )
+                # The product is complete, so its stage checkpoints are no longer needed
+                self._conn.execute("DELETE FROM checkpoints WHERE source_image_url = ?", (source_image_url,))
+
+    def get(self, brand, product_name):
+        """Return the stored record for a product, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(CSV_COLUMNS)} FROM products WHERE brand = ? AND product_name = ?",
+                (brand, product_name)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def get_by_source(self, source_image_url):
+        """Return the record produced from a given input photo URL, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join('p.' + column for column in CSV_COLUMNS)} FROM sources s"
+                " JOIN products p ON p.brand = s.brand AND p.product_name = s.product_name"
+                " WHERE s.source_image_url = ?",
+                (source_image_url,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def is_processed(self, source_image_url):
+        """Fast check whether an input photo URL has already been processed."""
+        return self.get_by_source(source_image_url) is not None
+
+    def load_checkpoints(self, source_image_url):
+        """Return the saved stage outputs for an input photo URL as a dict."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, output FROM checkpoints WHERE source_image_url = ?", (source_image_url,)
+            ).fetchall()
+        return {row["stage"]: json.loads(row["output"]) for row in rows}
+
+    def save_checkpoint(self, source_image_url, stage, output):
+        """Durably record the (JSON-serializable) output of one pipeline stage."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (source_image_url, stage, output, updated_at) VALUES (?, ?, ?, ?)",
+                (source_image_url, stage, json.dumps(output), time.time())
+            )
+
+    def clear_checkpoints(self, source_image_url):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM checkpoints WHERE source_image_url = ?", (source_image_url,))
+
+    def job(self, source_image_url, resume=True):
+        """
+        Return the checkpoint record for one input photo.
+
+        Args:
+            source_image_url (str): Input photo URL
+            resume (bool): Reuse saved stage outputs; if False they are discarded
+        """
+        if not resume:
+            self.clear_checkpoints(source_image_url)
+        return Job(self, source_image_url)
+
+    def records(self):
+        """Return all records (CSV_COLUMNS plus taxonomy_hash) in insertion order."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(CSV_COLUMNS)}, taxonomy_hash FROM products ORDER BY id"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def sources(self):
+        """Return the input photo URLs of every product as {(brand, product_name): [URLs]}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source_image_url, brand, product_name FROM sources ORDER BY source_image_url"
+            ).fetchall()
+        sources = {}
+        for row in rows:
+            sources.setdefault((row["brand"], row["product_name"]), []).append(row["source_image_url"])
+        return sources
+
+    def categorized_records(self):
+        """Return brand, product name, description, categories and taxonomy_hash of every product."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT brand, product_name, description, category1, category2, taxonomy_hash FROM products ORDER BY id"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def update_categories(self, brand, product_name, category1, category2, taxonomy_hash):
+        """Replace the categories of one product, leaving its images untouched."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE products SET category1 = ?, category2 = ?, taxonomy_hash = ?, updated_at = ?"
+                " WHERE brand = ? AND product_name = ?",
+                (category1, category2, taxonomy_hash, time.time(), brand, product_name)
+            )
+
+    def update_image(self, brand, product_name, image_url, processed_image_path):
+        """Replace the selected image (and its background-removed copy) of one product."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE products SET image_url = ?, processed_image_path = ?, updated_at = ?"
+                " WHERE brand = ? AND product_name = ?",
+                (image_url, processed_image_path, time.time(), brand, product_name)
+            )
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def export_csv(self, path=LEGACY_CSV_PATH):
+        """Write the catalog in the legacy data.csv layout."""
+        records = self.records()
+        # Written to a temporary file first so readers never see a half-written export
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", newline="", encoding="utf-8") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(records)
+        os.replace(tmp_path, path)
+        logger.info(f"Exported {len(records)} products to {path}")
+
+    def import_csv(self, path=LEGACY_CSV_PATH):
+        """Load records from a legacy data.csv file. Returns the number of rows read."""
+        with open(path, "r", newline="", encoding="utf-8") as infile:
+            rows = list(csv.DictReader(infile))
+        for row in rows:
+            self.add({column: (row.get(column) or None) for column in CSV_COLUMNS})
+        logger.info(f"Imported {len(rows)} products from {path}")
+        return len(rows)
+
+
+class Job:
+    """
+    Per-product job record: the saved output of every completed pipeline stage.
+
+    Stages whose output is already saved are not run again; `resumed` lists them
+    in the order they were reused.
+    """
+
+    def __init__(self, store, source_image_url):
+        self.store = store
+        self.source_image_url = source_image_url
+        self.outputs = store.load_checkpoints(source_image_url)
+        self.resumed = []
+
+    def __contains__(self, stage):
+        return stage in self.outputs
+
+    def resume(self, stage):
+        """Return the saved output of `stage` and remember that it was skipped."""
+        self.resumed.append(stage)
+        return self.outputs[stage]
+
+    def save(self, stage, output):
+        self.outputs[stage] = output
+        self.store.save_checkpoint(self.source_image_url, stage, output)
+
+
+def open_store(path=DEFAULT_STORE_PATH, legacy_csv=LEGACY_CSV_PATH):
+    """
+    Open the product store, importing the legacy CSV the first time the store is created.
+    """
+    is_new = not os.path.exists(path)
+    store = ProductStore(path)
+    if is_new and legacy_csv and os.path.exists(legacy_csv):
+        store.import_csv(legacy_csv)
+    return store
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("export", "import"):
+        print("Usage: python product_store.py export|import [csv_path]")
+        sys.exit(1)
+
+    csv_path = sys.argv[2] if len(sys.argv) == 3 else LEGACY_CSV_PATH
+    store = ProductStore(os.getenv("PRODUCT_STORE_PATH", DEFAULT_STORE_PATH))
+    if sys.argv[1] == "export":
+        store.export_csv(csv_path)
+    else:
+        store.import_csv(csv_path)
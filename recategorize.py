@@ -0,0 +1,116 @@
+import time
+import argparse
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from category1 import create_category_level_1
+from category2 import create_category_level_2
+from product_store import open_store
+from response_cache import report_cache_stats
+from taxonomy import taxonomy_hash, stale_stage
+from taxonomy_classifier import get_taxonomy_classifier, learn
+from instrumentation import profiling
+from scheduler import ProviderUnavailable
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def recategorize(store, workers=8, dry_run=False):
+    """
+    Bring stored categories up to date after the taxonomy was edited.
+
+    Only products whose taxonomy branch changed are re-run (see taxonomy.stale_stage):
+    both category stages when the main category list changed, the subcategory stage
+    alone when only their branch did. Categories are recomputed from the stored
+    description, concurrently; images are left untouched. Products stored before
+    taxonomy hashes existed and whose labels are still valid are only stamped.
+
+    Args:
+        store (ProductStore): Product catalog
+        workers (int): Products re-categorized concurrently
+        dry_run (bool): Only report what would be re-run
+
+    Returns:
+        Counter: Number of products per outcome ("current", "stamped", "category1",
+            "category2", "failed")
+    """
+    outcomes = Counter()
+    stale = []
+    current = []
+    for record in store.categorized_records():
+        stage = stale_stage(record)
+        if stage:
+            stale.append((record, stage))
+            outcomes[stage] += 1
+        elif record["taxonomy_hash"]:
+            current.append(record)
+            outcomes["current"] += 1
+        else:
+            current.append(record)
+            outcomes["stamped"] += 1
+            if not dry_run:
+                store.update_categories(record["brand"], record["product_name"], record["category1"],
+                                        record["category2"], taxonomy_hash(record["category1"]))
+    logger.info(f"{len(stale)} products need new categories "
+                f"({outcomes['category1']} both levels, {outcomes['category2']} subcategory only)")
+    if dry_run or not stale:
+        return outcomes
+
+    # Labels from changed branches must not be suggested by the local classifier
+    classifier = get_taxonomy_classifier()
+    if classifier is not None:
+        classifier.train(current)
+
+    def run_one(item):
+        record, stage = item
+        brand, product_name, description = record["brand"], record["product_name"], record["description"]
+        try:
+            category1 = record["category1"]
+            if stage == "category1":
+                category1 = create_category_level_1(brand, product_name, description)
+            category2 = create_category_level_2(product_name, description, category1, brand=brand)
+        except ProviderUnavailable as e:
+            logger.error(f"Could not re-categorize {brand} - {product_name}: {e}")
+            return False
+        store.update_categories(brand, product_name, category1, category2, taxonomy_hash(category1))
+        learn({**record, "category1": category1, "category2": category2})
+        if (category1, category2) != (record["category1"], record["category2"]):
+            logger.info(f"{brand} - {product_name}: {record['category1']} / {record['category2']}"
+                        f" -> {category1} / {category2}")
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes["failed"] = sum(1 for ok in executor.map(run_one, stale) if not ok)
+    return outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-categorize stored products whose taxonomy branch changed.")
+    parser.add_argument("--store", default="products.db", help="Product store database")
+    parser.add_argument("--workers", type=int, default=8, help="Products re-categorized concurrently")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which products would be re-run")
+    parser.add_argument("--export-csv", metavar="PATH", help="Export the catalog as CSV afterwards (e.g. data.csv)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write per-stage timings and counters to PATH (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args()
+
+    store = open_store(args.store)
+    started = time.monotonic()
+    with profiling(args.profile):
+        outcomes = recategorize(store, workers=args.workers, dry_run=args.dry_run)
+    print(f"{outcomes['current']} products current, {outcomes['stamped']} stamped with the taxonomy version, "
+          f"{outcomes['category1']} re-run from the main category, {outcomes['category2']} re-run from the "
+          f"subcategory, {outcomes['failed']} failed ({time.monotonic() - started:.1f}s)")
+    if args.export_csv and not args.dry_run:
+        store.export_csv(args.export_csv)
+    report_cache_stats()
+
+
+if __name__ == "__main__":
+    main()
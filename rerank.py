@@ -0,0 +1,159 @@
+import time
+import argparse
+import logging
+from collections import Counter
+from dotenv import load_dotenv
+from backgroundrm import ENGINES, process_images
+from image_index import FeatureIndex, DEFAULT_INDEX_PATH
+from image_selector import ProductImageSelector
+from product_store import open_store
+from instrumentation import profiling
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def rerank(store, feature_index, selector, scoring, dry_run=False, process=True, background_engine=None):
+    """
+    Re-run the image selection for the whole catalog from indexed features.
+
+    Nothing is downloaded or scored: the candidates recorded for each product are
+    ranked again with the selector's `size_band`, `selection_weights` and
+    `min_background_brightness`, after dropping the URL variants and near-duplicates
+    the selection itself skips. Only features measured under `scoring` are used;
+    candidates that were never scored with those settings (skipped by an early exit,
+    failed downloads, scored with other settings) take no part, and products with
+    none left keep their image. The background check is re-applied to the stored
+    background brightness, so a threshold above the one used for scoring is
+    approximate, and one below it cannot bring back candidates whose object size
+    was never measured.
+
+    Without `process`, changed products get the new image and no processed image,
+    since the old cut-out shows another photo; a later run with `process` removes
+    the background of every product left without one.
+
+    Args:
+        store (ProductStore): Product catalog
+        feature_index (FeatureIndex): Indexed candidates and features
+        selector (ProductImageSelector): Selector configured with the new ranking
+        scoring (str): Scoring key the features must have been measured with
+            (see ProductImageSelector.scoring_key)
+        dry_run (bool): Only report which products would change
+        process (bool): Remove the background of newly selected images (and of
+            products left without a processed image); otherwise it is cleared
+        background_engine (str): Background removal engine (see backgroundrm.process_image)
+
+    Returns:
+        Counter: Number of products per outcome ("unchanged", "changed", "no_suitable",
+            "not_indexed", "other_scoring", "failed"), plus "missing_cutout" for unchanged
+            products without a processed image
+    """
+    outcomes = Counter()
+    candidates = feature_index.products()
+    changes = []
+    for record in store.records():
+        brand, product_name = record["brand"], record["product_name"]
+        urls = candidates.get((brand, product_name))
+        if not urls:
+            outcomes["not_indexed"] += 1
+            continue
+        features = feature_index.lookup(urls, scoring)
+        if not features and feature_index.lookup(urls):
+            # Scored only with other settings; their features are not comparable
+            outcomes["other_scoring"] += 1
+            continue
+        best_image_url = selector.choose_best_image(urls, selector.evaluate_indexed(urls, features))
+        if best_image_url is None:
+            # Keep the current image rather than leaving the product without one
+            outcomes["no_suitable"] += 1
+        elif best_image_url == record["image_url"]:
+            outcomes["unchanged"] += 1
+            if record["image_url"] and not record["processed_image_path"]:
+                outcomes["missing_cutout"] += 1
+                if process:
+                    changes.append((record, urls, best_image_url))
+        else:
+            outcomes["changed"] += 1
+            logger.info(f"{brand} - {product_name}: {record['image_url']} -> {best_image_url}")
+            changes.append((record, urls, best_image_url))
+    logger.info(f"{outcomes['changed']} products get a different image")
+    if dry_run or not changes:
+        return outcomes
+
+    # Without processing the cut-out is cleared, so image_url and processed_image_path never disagree
+    paths = [None] * len(changes)
+    if process:
+        paths = process_images(
+            [(image_url, f"{record['brand']}_{record['product_name'].replace(' ', '_')}.png")
+             for record, _, image_url in changes],
+            engine=background_engine
+        )
+    for (record, urls, image_url), path in zip(changes, paths):
+        if process and path is None:
+            # The product keeps its previous image so image_url and the cut-out stay consistent
+            outcomes["failed"] += 1
+            continue
+        store.update_image(record["brand"], record["product_name"], image_url, path)
+        feature_index.record_candidates(record["brand"], record["product_name"], urls, image_url)
+    return outcomes
+
+
+def parse_weights(value):
+    """Parse "size,quality,background" selection weights, e.g. "0.7,0.2,0.1"."""
+    try:
+        weights = tuple(float(part) for part in value.split(","))
+    except ValueError:
+        weights = ()
+    if len(weights) != 3:
+        raise argparse.ArgumentTypeError(f"expected three comma-separated numbers, got {value!r}")
+    return weights
+
+
+def main():
+    defaults = ProductImageSelector()
+    parser = argparse.ArgumentParser(description="Re-select product images from the image feature index, without downloads.")
+    parser.add_argument("--store", default="products.db", help="Product store database")
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="Image feature index database")
+    parser.add_argument("--weights", type=parse_weights, default=defaults.selection_weights, metavar="S,Q,B",
+                        help="Weights of object size, quality and background score among similar-size candidates "
+                             "(default %(default)s)")
+    parser.add_argument("--size-band", type=float, default=defaults.size_band,
+                        help="Candidates within this fraction of the largest object are ranked by weight (default %(default)s)")
+    parser.add_argument("--min-background-brightness", type=int, default=defaults.min_background_brightness,
+                        help="Minimum mean background brightness (default %(default)s)")
+    parser.add_argument("--scored-background-brightness", type=int, default=defaults.min_background_brightness,
+                        help="Background brightness threshold the candidates were scored with; features measured "
+                             "with other settings are ignored (default %(default)s)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which products would get a different image")
+    parser.add_argument("--no-process", action="store_true",
+                        help="Do not remove backgrounds of newly selected images (their processed path is cleared "
+                             "until a later run without --no-process)")
+    parser.add_argument("--background-engine", choices=ENGINES, default=None,
+                        help="Background removal engine (default: BACKGROUND_ENGINE or replicate)")
+    parser.add_argument("--export-csv", metavar="PATH", help="Export the catalog as CSV afterwards (e.g. data.csv)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write per-stage timings and counters to PATH (.prom for Prometheus text, else JSON)")
+    args = parser.parse_args()
+
+    store = open_store(args.store)
+    selector = ProductImageSelector(min_background_brightness=args.min_background_brightness,
+                                    size_band=args.size_band, selection_weights=args.weights, use_index=False)
+    scoring = ProductImageSelector(min_background_brightness=args.scored_background_brightness).scoring_key()
+    started = time.monotonic()
+    with profiling(args.profile):
+        outcomes = rerank(store, FeatureIndex(args.index), selector, scoring, dry_run=args.dry_run,
+                          process=not args.no_process, background_engine=args.background_engine)
+    print(f"{outcomes['changed']} products changed image, {outcomes['unchanged']} unchanged, "
+          f"{outcomes['no_suitable']} without a suitable candidate, {outcomes['not_indexed']} not in the index, "
+          f"{outcomes['other_scoring']} scored with other settings, {outcomes['missing_cutout']} without a cut-out, "
+          f"{outcomes['failed']} failed ({time.monotonic() - started:.1f}s)")
+    if args.export_csv and not args.dry_run:
+        store.export_csv(args.export_csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+from instrumentation import span, count
+from scheduler import get_scheduler
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "responses.sqlite")
+DEFAULT_TTL = 30 * 24 * 3600  # 30 days
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    A disk-backed key/value cache for paid API responses, stored in SQLite.
+
+    Entries expire after `ttl` seconds and the least recently used entries are
+    evicted once the stored values exceed `max_bytes`. Several caches can share one
+    database file by using different namespaces.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, namespace="default", ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (namespace, accessed_at)")
+
+    @staticmethod
+    def make_key(*parts):
+        """Build a stable cache key from JSON-serializable parts."""
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached value for `key`, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE namespace = ? AND key = ?", (self.namespace, key))
+                self.misses += 1
+                count(f"cache.{self.namespace}.misses")
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key)
+            )
+            self.hits += 1
+            count(f"cache.{self.namespace}.hits")
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        """Store a JSON-serializable value and evict old entries if over budget."""
+        encoded = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (namespace, key, value, size, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, key, encoded, len(encoded), now, now)
+            )
+            self._evict()
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._conn.execute(
+                "DELETE FROM responses WHERE namespace = ? AND created_at < ?",
+                (self.namespace, time.time() - self.ttl)
+            )
+        if self.max_bytes is None:
+            return
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses WHERE namespace = ? ORDER BY accessed_at", (self.namespace,)
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((self.namespace, key))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE namespace = ? AND key = ?", evicted)
+        logger.info(f"Evicted {len(evicted)} entries from {self.namespace} cache")
+
+    def stats(self):
+        """Return hit/miss counts for this process."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """
+    Return the process-wide cache for OpenAI responses, or None if disabled.
+
+    Configured through LLM_CACHE_PATH, LLM_CACHE_TTL (seconds), LLM_CACHE_MAX_BYTES
+    and LLM_CACHE_DISABLED environment variables.
+    """
+    global _llm_cache
+    if os.getenv("LLM_CACHE_DISABLED"):
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = ResponseCache(
+                path=os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+                namespace="llm",
+                ttl=float(os.getenv("LLM_CACHE_TTL", DEFAULT_TTL)),
+                max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+            )
+        return _llm_cache
+
+
+def _hash_images(messages):
+    """Replace inline base64 images with their hash so keys stay small."""
+    hashed = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                url = part.get("image_url", {}).get("url", "") if part.get("type") == "image_url" else ""
+                if url.startswith("data:"):
+                    part = {**part, "image_url": {**part["image_url"], "url": hashlib.sha256(url.encode()).hexdigest()}}
+                parts.append(part)
+            message = {**message, "content": parts}
+        hashed.append(message)
+    return hashed
+
+
+def chat_cache_key(model, messages, **params):
+    """Cache key of a chat completion request (see cached_chat_completion)."""
+    return ResponseCache.make_key(model, _hash_images(messages), params)
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """Rough token count of a chat request for rate limiting (4 characters per token, images ~765)."""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            total += len(content) // 4 + 4
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += len(part["text"]) // 4
+                elif part.get("type") == "image_url":
+                    total += 85 if part["image_url"].get("detail") == "low" else 765
+            total += 4
+    return total + (max_tokens or 0)
+
+
+def cached_chat_completion(client, model, messages, validate=None, usage=None, **params):
+    """
+    Return the message content of a chat completion, served from the LLM cache when possible.
+
+    Args:
+        client (OpenAI): OpenAI client used on a cache miss
+        model (str): Model name
+        messages (list): Chat messages; inline images are keyed by their hash
+        validate (callable): Optional predicate; content failing it is returned but not cached
+        usage (dict): If given, filled with "cached", "seconds", "prompt_tokens" and
+            "completion_tokens" for this call
+        **params: Extra arguments for `chat.completions.create` (also part of the key)
+
+    Returns:
+        str: The response message content
+
+    Raises:
+        scheduler.ProviderUnavailable: If the API keeps failing after the scheduler's retries
+    """
+    cache = get_llm_cache()
+    key = chat_cache_key(model, messages, **params)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            if usage is not None:
+                usage.update(cached=True, seconds=0.0, prompt_tokens=0, completion_tokens=0)
+            return cached
+
+    scheduler = get_scheduler()
+    estimate = estimate_tokens(messages, params.get("max_tokens"))
+    started = time.perf_counter()
+    with span(f"openai.{model}"):
+        count("api_calls.openai")
+        response = scheduler.call("openai", client.chat.completions.create, model=model, messages=messages,
+                                  tokens=estimate, **params)
+    response_usage = getattr(response, "usage", None)
+    if response_usage is not None:
+        count("openai.prompt_tokens", response_usage.prompt_tokens or 0)
+        count("openai.completion_tokens", response_usage.completion_tokens or 0)
+        scheduler.adjust_tokens("openai", (response_usage.total_tokens or 0) - estimate)
+    if usage is not None:
+        usage.update(cached=False, seconds=time.perf_counter() - started,
+                     prompt_tokens=getattr(response_usage, "prompt_tokens", None),
+                     completion_tokens=getattr(response_usage, "completion_tokens", None))
+    content = response.choices[0].message.content
+
+    if cache is not None and content is not None and (validate is None or validate(content)):
+        cache.set(key, content)
+    return content
+
+
+def report_cache_stats():
+    """Print hit/miss counts of the LLM cache for this run."""
+    cache = get_llm_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses")
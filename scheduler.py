@@ -0,0 +1,317 @@
+import os
+import time
+import random
+import threading
+import logging
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from instrumentation import span, count
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Limits per provider; each can be overridden with a <PROVIDER>_<KEY> environment
+# variable, e.g. OPENAI_TOKENS_PER_MINUTE=90000 or GOOGLE_DAILY_QUOTA=10000
+DEFAULT_PROVIDER_LIMITS = {
+    "openai": {"requests_per_minute": 500, "tokens_per_minute": 200_000, "max_in_flight": 8, "max_retries": 5},
+    "google": {"requests_per_minute": 600, "daily_quota": None, "max_in_flight": 4, "max_retries": 4},
+    "replicate": {"requests_per_minute": 600, "max_in_flight": 4, "max_retries": 4},
+    # Prediction status reads have their own, larger budget than creates
+    "replicate_poll": {"requests_per_minute": 3000, "max_in_flight": 8, "max_retries": 4},
+    "download": {"max_in_flight": 32, "max_retries": 2, "base_delay": 0.5},
+}
+DEFAULT_MAX_IN_FLIGHT = 64
+
+# HTTP statuses worth retrying: timeouts, conflicts from busy backends, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+_RETRYABLE_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "TransportError", "ConnectError", "ConnectTimeout",
+    "ReadTimeout", "WriteTimeout", "PoolTimeout", "RemoteProtocolError",
+}
+
+
+class ProviderUnavailable(Exception):
+    """Raised when a provider call still fails after every retry."""
+
+    def __init__(self, provider, message):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+
+
+class QuotaExceeded(ProviderUnavailable):
+    """Raised when a provider's daily quota is used up."""
+
+
+def _status_code(exc):
+    status = getattr(exc, "status_code", None) or getattr(exc, "status", None)
+    if isinstance(status, int):
+        return status
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(exc):
+    """True for connection errors, timeouts, rate limits and 5xx responses."""
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    status = _status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return any(cls.__name__ in _RETRYABLE_ERROR_NAMES or cls.__name__ in ("ConnectionError", "Timeout")
+               for cls in type(exc).__mro__)
+
+
+def retry_after(exc):
+    """Seconds requested by a Retry-After (or retry-after-ms) response header, if any."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    milliseconds = headers.get("retry-after-ms")
+    if milliseconds:
+        try:
+            return float(milliseconds) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second, holding at most `capacity`.
+
+    reserve() debits immediately and returns how long the caller must wait, so
+    callers are served in arrival order and large requests cannot starve.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount=1):
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount):
+        """Debit (or, with a negative amount, refund) tokens after the fact."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ProviderLimiter:
+    """
+    Rate, quota, concurrency and retry settings for one provider.
+
+    None removes a rate, quota or concurrency limit; retries and delays must be set.
+    """
+
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, daily_quota=None,
+                 max_in_flight=8, max_retries=3, base_delay=1.0, max_delay=60.0):
+        for setting, value in (("max_retries", max_retries), ("base_delay", base_delay), ("max_delay", max_delay)):
+            if value is None:
+                raise ValueError(f"{name}: {setting} cannot be unlimited")
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute / 60) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute / 60) if tokens_per_minute else None
+        self.daily_quota = daily_quota
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self._quota_day = None
+        self._quota_used = 0
+        self._lock = threading.Lock()
+
+    def take_quota(self):
+        if self.daily_quota is None:
+            return
+        with self._lock:
+            today = time.strftime("%Y-%m-%d")
+            if today != self._quota_day:
+                self._quota_day, self._quota_used = today, 0
+            if self._quota_used >= self.daily_quota:
+                raise QuotaExceeded(self.name, f"daily quota of {self.daily_quota} requests used up")
+            self._quota_used += 1
+
+    def pause(self, seconds):
+        """Hold back every caller of this provider, e.g. after a 429 with Retry-After."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retry number `attempt` (1-based)."""
+        return min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+
+class Scheduler:
+    """
+    Shared gate for every outbound API call.
+
+    Each provider has token buckets for requests (and, for OpenAI, tokens) per
+    minute, an optional daily quota and a cap on concurrent calls; a global cap
+    bounds all calls in flight (None leaves a cap unbounded). call() retries
+    connection errors, 429s and 5xx responses with jittered exponential backoff,
+    honours Retry-After by pausing the whole provider, and raises
+    ProviderUnavailable once retries run out.
+    """
+
+    def __init__(self, limits=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.providers = {}
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
+        for name, settings in (limits or DEFAULT_PROVIDER_LIMITS).items():
+            self.configure(name, **settings)
+
+    def configure(self, provider, **settings):
+        """Create or update the limits of a provider (call before the run starts)."""
+        current = self.providers.get(provider)
+        if current is not None:
+            merged = {
+                "requests_per_minute": current.requests.rate * 60 if current.requests else None,
+                "tokens_per_minute": current.tokens.rate * 60 if current.tokens else None,
+                "daily_quota": current.daily_quota,
+                "max_in_flight": current.max_in_flight,
+                "max_retries": current.max_retries,
+                "base_delay": current.base_delay,
+                "max_delay": current.max_delay,
+            }
+            settings = {**merged, **settings}
+        self.providers[provider] = ProviderLimiter(provider, **settings)
+        return self.providers[provider]
+
+    def _provider(self, provider):
+        if provider not in self.providers:
+            self.configure(provider)
+        return self.providers[provider]
+
+    @contextmanager
+    def slot(self, provider, tokens=1):
+        """
+        Wait until a call to `provider` is allowed, then hold an in-flight slot.
+
+        Raises:
+            QuotaExceeded: If the provider's daily quota is used up
+        """
+        limiter = self._provider(provider)
+        limiter.take_quota()
+        with span(f"wait.{provider}"):
+            delay = max(0.0, limiter.paused_until - time.monotonic())
+            if limiter.requests is not None:
+                delay = max(delay, limiter.requests.reserve(1))
+            if limiter.tokens is not None:
+                delay = max(delay, limiter.tokens.reserve(tokens))
+            if delay:
+                time.sleep(delay)
+            for semaphore in (limiter.in_flight, self.in_flight):
+                if semaphore is not None:
+                    semaphore.acquire()
+        try:
+            yield limiter
+        finally:
+            for semaphore in (self.in_flight, limiter.in_flight):
+                if semaphore is not None:
+                    semaphore.release()
+
+    def call(self, provider, fn, *args, tokens=1, **kwargs):
+        """
+        Run fn(*args, **kwargs) under the provider's limits, retrying transient failures.
+
+        Args:
+            provider (str): Provider name ("openai", "google", "replicate", "replicate_poll", "download")
+            fn (callable): The API call
+            tokens (int): Estimated tokens for token-per-minute limits
+
+        Raises:
+            ProviderUnavailable: If the call keeps failing with retryable errors
+            Exception: Non-retryable errors from `fn` are raised unchanged
+        """
+        limiter = self._provider(provider)
+        attempt = 0
+        while True:
+            with self.slot(provider, tokens):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    error = e
+            attempt += 1
+            if attempt > limiter.max_retries:
+                raise ProviderUnavailable(provider, f"giving up after {attempt} attempts: {error}") from error
+
+            requested = retry_after(error)
+            if requested is not None:
+                limiter.pause(requested)
+                delay = requested + random.uniform(0, limiter.base_delay)
+            else:
+                delay = limiter.backoff(attempt)
+            count(f"retries.{provider}")
+            logger.warning(f"{provider} call failed ({error}); retry {attempt}/{limiter.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def adjust_tokens(self, provider, amount):
+        """Correct a token estimate once the real usage is known (positive = more used)."""
+        limiter = self._provider(provider)
+        if limiter.tokens is not None and amount:
+            limiter.tokens.adjust(amount)
+
+
+def _env_value(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    if value.lower() in ("", "none", "unlimited"):
+        return None
+    return float(value) if "." in value else int(value)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Return the process-wide scheduler.
+
+    Provider limits default to DEFAULT_PROVIDER_LIMITS and can be overridden with
+    <PROVIDER>_<SETTING> environment variables (e.g. OPENAI_REQUESTS_PER_MINUTE,
+    GOOGLE_DAILY_QUOTA, REPLICATE_MAX_IN_FLIGHT; "none" removes a rate, quota or
+    concurrency limit, and is rejected for retries and delays);
+    SCHEDULER_MAX_IN_FLIGHT caps all calls in flight.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            limits = {
+                provider: {key: _env_value(f"{provider.upper()}_{key.upper()}", value) for key, value in settings.items()}
+                for provider, settings in DEFAULT_PROVIDER_LIMITS.items()
+            }
+            _scheduler = Scheduler(limits, max_in_flight=_env_value("SCHEDULER_MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT))
+        return _scheduler
+
+
+def call(provider, fn, *args, **kwargs):
+    """Run an API call through the shared scheduler. See Scheduler.call."""
+    return get_scheduler().call(provider, fn, *args, **kwargs)
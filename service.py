@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from dotenv import load_dotenv
+from openai_client import get_openai_client
+from product_store import open_store
+from backgroundrm import ENGINES, get_remover
+from batch import process_url
+from taxonomy_classifier import train_from_store
+from response_cache import report_cache_stats
+from scheduler import get_scheduler, DEFAULT_PROVIDER_LIMITS
+import instrumentation
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Finished jobs kept for GET /jobs/<id>; the oldest are forgotten first
+MAX_FINISHED_JOBS = 1000
+# Longest a single GET /jobs/<id>?wait=... request is held open
+MAX_WAIT_SECONDS = 60
+
+FINISHED_STATUSES = ("ok", "skipped", "failed", "error")
+
+
+class PipelineService:
+    """
+    Long-running pipeline that keeps imports, API clients, caches and the catalog warm.
+
+    Jobs are queued on a fixed pool of workers and processed exactly like batch.py
+    processes one manifest line (see batch.process_url). Submitting an image URL that
+    is already queued or running returns the existing job.
+    """
+
+    def __init__(self, store, client, workers=4, enrichment="stepwise", selector_options=None,
+                 background_engine=None, max_finished=MAX_FINISHED_JOBS):
+        self.store = store
+        self.client = client
+        self.workers = workers
+        self.enrichment = enrichment
+        self.selector_options = selector_options
+        self.background_engine = background_engine
+        self.max_finished = max_finished
+        self.started_at = time.time()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # job id -> job dict
+        self._futures = {}  # job id -> Future, while queued or running
+        self._active = {}  # image URL -> job id, while queued or running
+
+    def warm_up(self):
+        """Train the local classifier and create the background remover before the first job arrives."""
+        train_from_store(self.store)
+        get_remover(self.background_engine)
+
+    def submit(self, image_url, force=False, enrichment=None):
+        """
+        Queue a product image.
+
+        Args:
+            image_url (str): URL of the product photo
+            force (bool): Reprocess the product even if it is already stored
+            enrichment (str): Overrides the service's enrichment mode for this job
+
+        Returns:
+            dict: The job (see get)
+        """
+        with self._lock:
+            job_id = self._active.get(image_url)
+            if job_id is not None:
+                return dict(self._jobs[job_id])
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "image_url": image_url,
+                "status": "queued",
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "outcome": None,
+            }
+            self._active[image_url] = job_id
+            self._futures[job_id] = self._executor.submit(self._run, job_id, image_url, force,
+                                                          enrichment or self.enrichment)
+            return dict(self._jobs[job_id])
+
+    def _run(self, job_id, image_url, force, enrichment):
+        with self._lock:
+            self._jobs[job_id].update(status="running", started_at=time.time())
+        outcome = process_url(image_url, self.client, self.store, enrichment=enrichment, force=force,
+                              selector_options=self.selector_options, background_engine=self.background_engine)
+        with self._lock:
+            self._jobs[job_id].update(status=outcome["status"], finished_at=time.time(), outcome=outcome)
+            self._jobs.move_to_end(job_id)
+            del self._active[image_url]
+            del self._futures[job_id]
+            self._forget_old_jobs()
+        logger.info(f"Job {job_id} {outcome['status']}: {image_url} ({outcome['seconds']:.1f}s)")
+
+    def _forget_old_jobs(self):
+        finished = len(self._jobs) - len(self._futures)
+        for job_id in list(self._jobs):
+            if finished <= self.max_finished:
+                break
+            if job_id not in self._futures:
+                del self._jobs[job_id]
+                finished -= 1
+
+    def get(self, job_id, wait_seconds=0):
+        """
+        Return a copy of a job, or None if it is unknown.
+
+        Args:
+            job_id (str): Job ID returned by submit
+            wait_seconds (float): Wait up to this long for a queued or running job to finish
+
+        Returns:
+            dict: "id", "image_url", "status" ("queued", "running", "ok", "skipped", "failed"
+                or "error"), submit/start/finish timestamps and, once finished, the
+                "outcome" returned by batch.process_url
+        """
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None and wait_seconds > 0:
+            wait([future], timeout=wait_seconds)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        """Queue depth, busy workers and job counts."""
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {
+            "queue_depth": statuses.count("queued"),
+            "running": statuses.count("running"),
+            "workers": self.workers,
+            "finished": {status: statuses.count(status) for status in FINISHED_STATUSES},
+            "products_in_store": self.store.count(),
+            "uptime_seconds": time.time() - self.started_at,
+        }
+
+    def shutdown(self, wait_for_jobs=True):
+        """Stop accepting work; by default, let queued and running jobs finish."""
+        self._executor.shutdown(wait=wait_for_jobs, cancel_futures=not wait_for_jobs)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the pipeline service:
+
+        POST /jobs            {"image_url": ..., "force": false, "enrichment": null} -> 202 job
+        GET  /jobs/<id>       job; ?wait=SECONDS holds the request until it finishes
+        GET  /status          queue depth and job counts
+        GET  /metrics         Prometheus text (when started with --metrics)
+    """
+
+    service = None  # set by make_server
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/status":
+            self._send(200, self.service.stats())
+        elif url.path.startswith("/jobs/"):
+            try:
+                wait_seconds = min(MAX_WAIT_SECONDS, float(parse_qs(url.query).get("wait", ["0"])[0]))
+            except ValueError:
+                self._send(400, {"error": "wait must be a number of seconds"})
+                return
+            job = self.service.get(url.path[len("/jobs/"):], wait_seconds=wait_seconds)
+            if job is None:
+                self._send(404, {"error": "unknown job"})
+            else:
+                self._send(200, job)
+        elif url.path == "/metrics" and instrumentation.is_enabled():
+            self._send(200, instrumentation.to_prometheus(), content_type="text/plain; version=0.0.4")
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/jobs":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError:
+            self._send(400, {"error": "request body must be JSON"})
+            return
+        image_url = body.get("image_url") if isinstance(body, dict) else None
+        if not image_url:
+            self._send(400, {"error": "image_url is required"})
+            return
+        if body.get("enrichment") not in (None, "stepwise", "structured"):
+            self._send(400, {"error": "enrichment must be 'stepwise' or 'structured'"})
+            return
+        self._send(202, self.service.submit(image_url, force=bool(body.get("force")),
+                                            enrichment=body.get("enrichment")))
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Create (but do not start) an HTTP server for `service`."""
+    handler = type("BoundServiceHandler", (ServiceHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the product pipeline as a resident HTTP service.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PIPELINE_SERVICE_PORT", DEFAULT_PORT)))
+    parser.add_argument("--workers", type=int, default=4, help="Products processed concurrently")
+    parser.add_argument("--store", default="products.db", help="Product store database")
+    parser.add_argument("--enrichment", choices=["stepwise", "structured"], default="stepwise",
+                        help="Default enrichment mode (jobs can override it)")
+    parser.add_argument("--download-workers", type=int, default=8, help="Candidate images downloaded concurrently per product")
+    parser.add_argument("--scoring-workers", type=int, default=os.cpu_count() or 1,
+                        help="Processes shared by all products for image scoring (0 scores in-thread)")
+    parser.add_argument("--early-exit", action="store_true",
+                        help="Stop evaluating candidate images once one meets the quality thresholds")
+    parser.add_argument("--background-engine", choices=ENGINES, default=None,
+                        help="Background removal engine (default: BACKGROUND_ENGINE or replicate)")
+    for provider, settings in DEFAULT_PROVIDER_LIMITS.items():
+        parser.add_argument(f"--{provider}-limit", type=int, default=None,
+                            help=f"Max concurrent {provider} calls (default {settings['max_in_flight']}, "
+                                 f"or {provider.upper()}_MAX_IN_FLIGHT)")
+    parser.add_argument("--metrics", action="store_true", help="Collect timings and counters and serve them on /metrics")
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrumentation.enable()
+    scheduler = get_scheduler()
+    for provider in DEFAULT_PROVIDER_LIMITS:
+        max_in_flight = getattr(args, f"{provider}_limit")
+        if max_in_flight:
+            scheduler.configure(provider, max_in_flight=max_in_flight)
+
+    service = PipelineService(open_store(args.store), get_openai_client(), workers=args.workers,
+                              enrichment=args.enrichment,
+                              selector_options={"download_workers": args.download_workers,
+                                                "scoring_workers": args.scoring_workers,
+                                                "early_exit": args.early_exit},
+                              background_engine=args.background_engine)
+    service.warm_up()
+    server = make_server(service, args.host, args.port)
+    logger.info(f"Pipeline service listening on http://{args.host}:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down; waiting for running jobs")
+    finally:
+        server.server_close()
+        service.shutdown()
+        report_cache_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os
+import re
+import sys
+import shutil
+import filecmp
+import hashlib
+import argparse
+import logging
+from product_store import ProductStore, open_store, DEFAULT_STORE_PATH, PROCESSED_IMAGES_DIR
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_ROOT = "shards"
+SHARD_STORE = "products.db"
+_SHARD_DIR = re.compile(r"shard-(\d+)-of-(\d+)")
+
+
+def parse_shard(text):
+    """argparse type for "i/n": shard i (1-based) of n."""
+    match = re.fullmatch(r"(\d+)/(\d+)", text.strip())
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"expected i/n with 1 <= i <= n, got {text!r}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_of(image_url, count):
+    """Shard (1-based) an image URL belongs to. It depends only on the URL, so every host agrees."""
+    return int(hashlib.sha256(image_url.encode("utf-8")).hexdigest()[:16], 16) % count + 1
+
+
+def select_shard(image_urls, index, count):
+    """The image URLs of shard `index` of `count`, in manifest order."""
+    return [image_url for image_url in image_urls if shard_of(image_url, count) == index]
+
+
+def shard_dir(root, index, count):
+    """Working directory of one shard: its product store and processed images."""
+    return os.path.join(root, f"shard-{index}-of-{count}")
+
+
+def find_shards(root):
+    """Shard directories under `root` that contain a product store, in (count, index) order."""
+    shards = []
+    for name in os.listdir(root) if os.path.isdir(root) else ():
+        match = _SHARD_DIR.fullmatch(name)
+        if match and os.path.exists(os.path.join(root, name, SHARD_STORE)):
+            shards.append((int(match.group(2)), int(match.group(1)), os.path.join(root, name)))
+    return [path for _, _, path in sorted(shards)]
+
+
+def _copy_image(source, destination):
+    """Copy a processed image atomically; identical existing files are left alone."""
+    if os.path.exists(destination) and filecmp.cmp(source, destination, shallow=False):
+        return False
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+    return True
+
+
+def merge_shards(root, store, image_dir=PROCESSED_IMAGES_DIR):
+    """
+    Merge the shard outputs under `root` into the main catalog and image directory.
+
+    Shards are merged in index order and their products in insertion order. A
+    product produced by several shards keeps the record and image of the last one
+    (and the source photos of all of them), so merging the same shard outputs always
+    gives the same catalog. Processed images are copied into `image_dir` and the
+    records point at the copies. Merging again copies nothing and changes nothing.
+
+    Args:
+        root (str): Directory holding the shard-<i>-of-<n> working directories
+        store (ProductStore): Main catalog
+        image_dir (str): Main processed image directory
+
+    Returns:
+        dict: Number of "shards", distinct "products", "sources" and copied "images"
+    """
+    totals = {"shards": 0, "products": 0, "sources": 0, "images": 0}
+    os.makedirs(image_dir, exist_ok=True)
+    merged = {}
+    for path in find_shards(root):
+        shard_store = ProductStore(os.path.join(path, SHARD_STORE))
+        sources = shard_store.sources()
+        for record in shard_store.records():
+            key = (record["brand"], record["product_name"])
+            earlier_urls = merged.pop(key, (None, None, []))[2]
+            merged[key] = (path, record, earlier_urls + (sources.get(key) or []))
+        totals["shards"] += 1
+
+    for path, record, urls in merged.values():
+        processed = record.get("processed_image_path")
+        if processed:
+            # Resolve by file name, so shard directories can be copied from other hosts
+            filename = os.path.basename(processed)
+            shard_image = os.path.join(path, PROCESSED_IMAGES_DIR, filename)
+            if os.path.exists(shard_image):
+                totals["images"] += _copy_image(shard_image, os.path.join(image_dir, filename))
+                record["processed_image_path"] = os.path.join(image_dir, filename)
+            else:
+                logger.warning(f"Processed image {shard_image} is missing; keeping the path {processed}")
+        for source_image_url in urls or [None]:
+            store.add(record, source_image_url=source_image_url)
+        totals["products"] += 1
+        totals["sources"] += len(urls)
+    logger.info(f"Merged {totals['products']} products from {totals['shards']} shards under {root}")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge shard outputs of batch.py --shard into the main catalog.")
+    parser.add_argument("root", nargs="?", default=DEFAULT_SHARD_ROOT, help="Directory holding the shard directories")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH, help="Main product store database")
+    parser.add_argument("--images", default=PROCESSED_IMAGES_DIR, help="Main processed image directory")
+    parser.add_argument("--export-csv", metavar="PATH", help="Export the merged catalog as CSV (e.g. data.csv)")
+    args = parser.parse_args()
+
+    if not find_shards(args.root):
+        print(f"No shard outputs found under {args.root}")
+        sys.exit(1)
+    store = open_store(args.store)
+    totals = merge_shards(args.root, store, image_dir=args.images)
+    print(f"Merged {totals['products']} products ({totals['sources']} source photos, {totals['images']} new images) "
+          f"from {totals['shards']} shards into {args.store}")
+    if args.export_csv:
+        store.export_csv(args.export_csv)
+
+
+if __name__ == "__main__":
+    main()
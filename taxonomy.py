@@ -0,0 +1,46 @@
+import json
+import hashlib
+from category1 import CATEGORIES
+from category2 import CATEGORY_HIERARCHY
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+
+
+def taxonomy_hash(category1):
+    """
+    Version of the taxonomy a product labelled `category1` was categorized with.
+
+    The hash has two parts, "<main categories>:<subcategories of category1>", so an
+    edit to one subcategory list only invalidates the products in that branch.
+    """
+    return f"{_digest(CATEGORIES)}:{_digest(CATEGORY_HIERARCHY.get(category1))}"
+
+
+def stale_stage(record):
+    """
+    Return the category stage a stored product must re-run under the current taxonomy.
+
+    Args:
+        record (dict): Stored product with "category1", "category2" and "taxonomy_hash"
+
+    Returns:
+        str: "category1" (both levels), "category2" (subcategory only) or None if
+            the labels are current. Products stored before hashes were recorded are
+            only re-run if their labels are no longer part of the taxonomy.
+    """
+    category1 = record.get("category1")
+    if not record.get("taxonomy_hash"):
+        if category1 not in CATEGORY_HIERARCHY:
+            return "category1"
+        if record.get("category2") not in CATEGORY_HIERARCHY[category1]:
+            return "category2"
+        return None
+    main, _, branch = record["taxonomy_hash"].partition(":")
+    current_main, _, current_branch = taxonomy_hash(category1).partition(":")
+    if main != current_main:
+        return "category1"
+    if branch != current_branch:
+        return "category2"
+    return None
@@ -0,0 +1,229 @@
+import os
+import re
+import math
+import threading
+import logging
+from collections import Counter, defaultdict
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_CONFIDENCE = 0.8
+DEFAULT_MIN_SIMILARITY = 0.5
+DEFAULT_MIN_SUPPORT = 2
+# Share of the catalog that must be added before IDF weights are recomputed
+DEFAULT_IDF_REFRESH = 0.1
+
+
+def product_text(brand, product_name, description=None):
+    """
+    Text the classifier is trained and queried on.
+
+    The description is included when known, so the product itself outweighs the
+    brand n-grams shared by everything a brand sells.
+    """
+    return " ".join(part for part in (brand, product_name, description) if part)
+
+
+class TaxonomyClassifier:
+    """
+    Nearest-neighbour classifier over the fixed category taxonomy.
+
+    Product texts are represented as TF-IDF vectors of character n-grams and a query
+    is labelled by a similarity-weighted vote of its `k` most similar catalog
+    products. Examples can be added one at a time: their postings are indexed
+    right away, weighted with the current IDF snapshot, and the IDF weights are
+    recomputed lazily once the catalog has grown by `idf_refresh` since they were
+    last computed, so learning one product never rebuilds the whole index.
+
+    Only neighbours at least `min_similarity` similar vote. A prediction is
+    returned when at least `min_support` of them agree on the winning label and
+    it holds at least `min_confidence` of their vote, so unfamiliar products
+    (and one-off lookalikes) still go to the LLM.
+    """
+
+    def __init__(self, hierarchy, k=5, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                 min_similarity=DEFAULT_MIN_SIMILARITY, min_support=DEFAULT_MIN_SUPPORT, ngram_range=(2, 4),
+                 idf_refresh=DEFAULT_IDF_REFRESH):
+        self.hierarchy = hierarchy
+        self.k = k
+        self.min_confidence = min_confidence
+        self.min_similarity = min_similarity
+        self.min_support = min_support
+        self.ngram_range = ngram_range
+        self.idf_refresh = idf_refresh
+        self._lock = threading.Lock()
+        self._docs = {}  # text -> (term counts, category1, category2)
+        self._document_frequency = Counter()
+        self._postings = defaultdict(list)  # term -> [(text, count)], append-only
+        # IDF snapshot: (idf, IDF of terms unseen at snapshot time, text -> vector norm)
+        self._weights = ({}, 1.0, {})
+        self._weighted_docs = 0
+
+    def ngrams(self, text):
+        """Character n-gram counts of the normalized text, padded at word boundaries."""
+        normalized = " " + re.sub(r"[^\w]+", " ", text.lower()).strip() + " "
+        low, high = self.ngram_range
+        return Counter(normalized[i:i + n] for n in range(low, high + 1) for i in range(len(normalized) - n + 1))
+
+    def add(self, text, category1, category2):
+        """
+        Add or relabel one example. Labels outside the taxonomy are ignored.
+
+        Returns:
+            bool: True if the example was used
+        """
+        if category1 not in self.hierarchy or category2 not in self.hierarchy[category1] or not text.strip():
+            return False
+        with self._lock:
+            previous = self._docs.get(text)
+            if previous is not None:
+                self._docs[text] = (previous[0], category1, category2)
+                return True
+            terms = self.ngrams(text)
+            self._document_frequency.update(terms.keys())
+            # Labels and norm are set before the postings, so concurrent queries never see half a document
+            self._docs[text] = (terms, category1, category2)
+            idf, unseen_idf, norms = self._weights
+            norms[text] = self._norm(terms, idf, unseen_idf)
+            for term, count in terms.items():
+                self._postings[term].append((text, count))
+        return True
+
+    def add_record(self, record):
+        """Add a product record (see product_store.CSV_COLUMNS)."""
+        return self.add(product_text(record.get("brand"), record.get("product_name"), record.get("description")),
+                        record.get("category1"), record.get("category2"))
+
+    def train(self, records):
+        """Add every labelled record. Returns the number of examples used."""
+        used = sum(1 for record in records if self.add_record(record))
+        logger.info(f"Taxonomy classifier trained on {used} products")
+        return used
+
+    def __len__(self):
+        return len(self._docs)
+
+    @staticmethod
+    def _norm(terms, idf, unseen_idf):
+        return math.sqrt(sum((count * idf.get(term, unseen_idf)) ** 2 for term, count in terms.items()))
+
+    def _refresh_weights(self):
+        """Recompute IDF and document norms over the whole catalog (called with the lock held)."""
+        total = len(self._docs)
+        idf = {term: math.log((1 + total) / (1 + frequency)) + 1 for term, frequency in self._document_frequency.items()}
+        unseen_idf = math.log((1 + total) / 2) + 1
+        norms = {text: self._norm(terms, idf, unseen_idf) for text, (terms, _, _) in self._docs.items()}
+        self._weights = (idf, unseen_idf, norms)
+        self._weighted_docs = total
+
+    def _current_weights(self):
+        with self._lock:
+            if len(self._docs) - self._weighted_docs > self.idf_refresh * self._weighted_docs:
+                self._refresh_weights()
+            return self._weights
+
+    def neighbours(self, text, category1=None):
+        """
+        Return the k most similar catalog products.
+
+        Args:
+            text (str): Query text (see product_text)
+            category1 (str): If given, only products in this category are considered
+
+        Returns:
+            list: (cosine similarity, category1, category2) tuples, most similar first
+        """
+        idf, unseen_idf, norms = self._current_weights()
+        postings, docs = self._postings, self._docs
+
+        terms = self.ngrams(text)
+        weights = {term: count * idf.get(term, unseen_idf) for term, count in terms.items() if term in postings}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+        if not norm:
+            return []
+
+        scores = defaultdict(float)
+        for term, weight in weights.items():
+            term_idf = idf.get(term, unseen_idf)
+            for doc, count in postings[term]:
+                # Documents added after this snapshot was taken have no norm in it yet
+                doc_norm = norms.get(doc)
+                if doc_norm:
+                    scores[doc] += weight / norm * count * term_idf / doc_norm
+
+        ranked = []
+        for doc, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+            _, doc_category1, doc_category2 = docs[doc]
+            if category1 is None or doc_category1 == category1:
+                ranked.append((score, doc_category1, doc_category2))
+                if len(ranked) == self.k:
+                    break
+        return ranked
+
+    def _vote(self, neighbours, label_index):
+        votes = Counter()
+        support = Counter()
+        for neighbour in neighbours:
+            if neighbour[0] >= self.min_similarity:
+                votes[neighbour[label_index]] += neighbour[0]
+                support[neighbour[label_index]] += 1
+        if not votes:
+            return None, 0.0
+        label, weight = votes.most_common(1)[0]
+        confidence = weight / sum(votes.values())
+        if confidence < self.min_confidence or support[label] < self.min_support:
+            return None, confidence
+        return label, confidence
+
+    def predict_category1(self, text):
+        """Return (category1, confidence), or (None, confidence) when not confident."""
+        return self._vote(self.neighbours(text), 1)
+
+    def predict_category2(self, text, category1):
+        """Return (category2 within category1, confidence), or (None, confidence) when not confident."""
+        if category1 not in self.hierarchy:
+            return None, 0.0
+        return self._vote(self.neighbours(text, category1), 2)
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def get_taxonomy_classifier():
+    """
+    Return the process-wide classifier, or None if it is disabled.
+
+    Configured through TAXONOMY_MIN_CONFIDENCE, TAXONOMY_MIN_SIMILARITY,
+    TAXONOMY_MIN_SUPPORT and TAXONOMY_CLASSIFIER_DISABLED environment variables. It starts empty; callers
+    train it from the product store (see train_from_store).
+    """
+    global _classifier
+    if os.getenv("TAXONOMY_CLASSIFIER_DISABLED"):
+        return None
+    with _classifier_lock:
+        if _classifier is None:
+            from category2 import CATEGORY_HIERARCHY
+            _classifier = TaxonomyClassifier(
+                CATEGORY_HIERARCHY,
+                min_confidence=float(os.getenv("TAXONOMY_MIN_CONFIDENCE", DEFAULT_MIN_CONFIDENCE)),
+                min_similarity=float(os.getenv("TAXONOMY_MIN_SIMILARITY", DEFAULT_MIN_SIMILARITY)),
+                min_support=int(os.getenv("TAXONOMY_MIN_SUPPORT", DEFAULT_MIN_SUPPORT))
+            )
+        return _classifier
+
+
+def train_from_store(store):
+    """Train the shared classifier on every product in `store` (no-op when disabled)."""
+    classifier = get_taxonomy_classifier()
+    if classifier is not None:
+        classifier.train(store.records())
+
+
+def learn(record):
+    """Add a newly stored product to the shared classifier (no-op when disabled)."""
+    classifier = get_taxonomy_classifier()
+    if classifier is not None:
+        classifier.add_record(record)
@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_services import FakeServices, DEFAULT_LATENCY
+
+# Latencies short enough for unit tests; individual tests raise them where timing matters
+TEST_LATENCY = {"openai": 0.0, "google": 0.0, "replicate": 0.05, "images": 0.0, "batch": 0.05}
+
+_services = None
+
+
+def pytest_configure(config):
+    """
+    Start one set of fake services for the session.
+
+    Several modules read their endpoints and credentials from the environment at
+    import or first use, so the environment must point at the fakes before any
+    test module is imported.
+    """
+    global _services
+    _services = FakeServices(latency=TEST_LATENCY).start()
+    os.environ.update(_services.env())
+    cache_dir = tempfile.mkdtemp(prefix="pipeline-tests-")
+    os.environ.update({
+        "DOWNLOAD_CACHE_DIR": os.path.join(cache_dir, "downloads"),
+        "LLM_CACHE_DISABLED": "1",
+        "SEARCH_CACHE_DISABLED": "1",
+        "IMAGE_INDEX_DISABLED": "1",
+        "TAXONOMY_CLASSIFIER_DISABLED": "1",
+    })
+
+
+def pytest_unconfigure(config):
+    if _services is not None:
+        _services.stop()
+
+
+@pytest.fixture
+def services(tmp_path, monkeypatch):
+    """The shared fake services with default test latencies, no errors and cleared counters."""
+    _services.latency = {**DEFAULT_LATENCY, **TEST_LATENCY}
+    _services.error_rate = {provider: 0.0 for provider in _services.latency}
+    _services.requests.clear()
+    _services.errors.clear()
+    monkeypatch.chdir(tmp_path)
+    return _services
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """A fresh shared scheduler, so limits configured by a test do not leak into others."""
+    import scheduler as scheduler_module
+    fresh = scheduler_module.Scheduler()
+    monkeypatch.setattr(scheduler_module, "_scheduler", fresh)
+    return fresh
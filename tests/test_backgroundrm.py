@@ -0,0 +1,61 @@
+import os
+import pytest
+from PIL import Image
+from backgroundrm import PredictionQueue, PredictionFailed
+
+
+def test_predictions_are_written_to_disk(services, scheduler, tmp_path):
+    queue = PredictionQueue(max_in_flight=2, poll_interval=0.02)
+    urls = services.product_photo_urls(3)
+    futures = [queue.submit(url, str(tmp_path / f"out-{index}.png")) for index, url in enumerate(urls)]
+
+    paths = [future.result(timeout=30) for future in futures]
+
+    assert paths == [str(tmp_path / f"out-{index}.png") for index in range(3)]
+    for path in paths:
+        assert Image.open(path).mode == "RGBA"
+    assert services.requests["replicate"] == 3
+    assert services.requests["replicate_cancel"] == 0
+
+
+def test_polls_do_not_use_the_create_budget(services, scheduler, tmp_path):
+    services.latency["replicate"] = 0.3
+    providers = []
+    call = scheduler.call
+
+    def recording_call(provider, fn, *args, **kwargs):
+        providers.append(provider)
+        return call(provider, fn, *args, **kwargs)
+
+    scheduler.call = recording_call
+    queue = PredictionQueue(max_in_flight=2, poll_interval=0.02)
+    queue.submit(services.product_photo_urls(1)[0], str(tmp_path / "out.png")).result(timeout=30)
+
+    assert providers.count("replicate") == 1
+    assert providers.count("replicate_poll") >= 2
+    assert services.requests["replicate_poll"] == providers.count("replicate_poll")
+
+
+def test_prediction_is_canceled_when_its_status_cannot_be_read(services, scheduler, tmp_path):
+    services.latency["replicate"] = 5.0
+    services.error_rate["replicate_poll"] = 1.0
+    scheduler.configure("replicate_poll", max_retries=0)
+    queue = PredictionQueue(max_in_flight=2, poll_interval=0.02)
+
+    future = queue.submit(services.product_photo_urls(1)[0], str(tmp_path / "out.png"))
+
+    with pytest.raises(Exception):
+        future.result(timeout=30)
+    assert services.requests["replicate_cancel"] == 1
+    assert not os.path.exists(tmp_path / "out.png")
+
+
+def test_prediction_is_canceled_after_the_timeout(services, scheduler, tmp_path):
+    services.latency["replicate"] = 5.0
+    queue = PredictionQueue(max_in_flight=2, timeout=0.2, poll_interval=0.02)
+
+    future = queue.submit(services.product_photo_urls(1)[0], str(tmp_path / "out.png"))
+
+    with pytest.raises(PredictionFailed, match="timed out"):
+        future.result(timeout=30)
+    assert services.requests["replicate_cancel"] == 1
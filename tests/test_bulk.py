@@ -0,0 +1,133 @@
+import pytest
+import bulk
+from bulk import BatchRunner, run_bulk, _custom_id
+from openai_client import get_openai_client
+from product_store import open_store
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def store(tmp_path):
+    return open_store(str(tmp_path / "products.db"), legacy_csv=None)
+
+
+@pytest.fixture
+def runner(services, scheduler, tmp_path):
+    return BatchRunner(get_openai_client(), workdir=str(tmp_path / "bulk"), poll_interval=0.01)
+
+
+@pytest.fixture
+def payloads(monkeypatch):
+    """Photo URLs the vision wave downloaded and encoded, in order."""
+    fetched = []
+    image_payload = bulk.image_payload
+
+    def counting_payload(url, *args, **kwargs):
+        fetched.append(url)
+        return image_payload(url, *args, **kwargs)
+
+    monkeypatch.setattr(bulk, "image_payload", counting_payload)
+    return fetched
+
+
+def test_every_photo_is_identified_and_enriched(services, runner, store):
+    urls = services.product_photo_urls(5)
+
+    ready = run_bulk(urls, runner, store)
+
+    assert ready == urls
+    for url in urls:
+        job = store.job(url)
+        assert len(job.outputs["identify"]) == 2
+        description, category1, category2 = job.outputs["enrich"]
+        assert description and category1 and category2
+    # Identify, description, category1 and category2 waves
+    assert services.requests["batch"] == 4
+
+
+def test_interrupted_run_resumes_the_submitted_batches(services, runner, store, payloads, monkeypatch):
+    urls = services.product_photo_urls(4)
+    wait = BatchRunner._wait
+
+    def interrupted_wait(self, wave, batch_ids):
+        raise Interrupted(wave)
+
+    monkeypatch.setattr(BatchRunner, "_wait", interrupted_wait)
+    with pytest.raises(Interrupted):
+        run_bulk(urls, runner, store)
+    assert runner.submitted("identify") == {_custom_id("identify", url) for url in urls}
+    assert services.requests["batch"] == 1
+
+    monkeypatch.setattr(BatchRunner, "_wait", wait)
+    ready = run_bulk(urls, BatchRunner(runner.client, workdir=runner.workdir, poll_interval=0.01), store)
+
+    assert ready == urls
+    # The identify batch was collected, not submitted again, and no photo was fetched twice
+    assert services.requests["batch"] == 4
+    assert payloads == urls
+    assert runner.submitted("identify") == set()
+
+
+def test_failed_lines_are_retried_on_the_next_run(services, runner, store):
+    urls = services.product_photo_urls(12)
+    services.error_rate["openai"] = 0.5
+
+    ready = run_bulk(urls, runner, store)
+
+    assert len(ready) < len(urls)
+    # Failed requests are not left as submitted, so the next run sends them again
+    assert runner.submitted("identify") == set()
+    services.error_rate["openai"] = 0.0
+    assert sorted(run_bulk(urls, runner, store)) == sorted(urls)
+
+
+def test_wave_is_split_into_files_within_the_limits(services, runner, store, monkeypatch):
+    urls = services.product_photo_urls(5)
+    monkeypatch.setattr(bulk, "MAX_REQUESTS_PER_FILE", 2)
+    files = {}
+    submit = BatchRunner._submit
+
+    def counting_submit(self, wave, paths):
+        files[wave] = files.get(wave, 0) + len(paths)
+        return submit(self, wave, paths)
+
+    monkeypatch.setattr(BatchRunner, "_submit", counting_submit)
+
+    assert run_bulk(urls, runner, store) == urls
+    # Five photos, at most two requests per file
+    assert files["identify"] == 3
+    assert services.requests["batch"] == sum(files.values())
+
+    lines = [f'{{"custom_id": "x-{index}"}}' for index in range(3)]
+    monkeypatch.setattr(bulk, "MAX_REQUESTS_PER_FILE", 10)
+    monkeypatch.setattr(bulk, "MAX_FILE_BYTES", 1)
+    written = []
+    paths = runner._write_files("limits", ((line, {"messages": []}) for line in lines), written)
+    assert len(paths) == 3 and written == lines
+
+
+def run_main(monkeypatch, manifest, *options):
+    monkeypatch.setattr("sys.argv", ["bulk.py", str(manifest), "--poll-interval", "0.01", "--workers", "2", *options])
+    bulk.main()
+
+
+def test_force_reprocesses_products_from_the_new_checkpoints(services, scheduler, tmp_path, monkeypatch, capsys):
+    urls = services.product_photo_urls(3)
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("\n".join(urls))
+    run_main(monkeypatch, manifest)
+    assert "3 ok" in capsys.readouterr().out
+    chat_calls = services.requests["openai"]
+
+    run_main(monkeypatch, manifest, "--force")
+
+    output = capsys.readouterr().out
+    assert "Processed 3 products" in output and "3 ok" in output
+    assert output.count("resumed, skipped identify, enrich") == 3
+    # Text stages came from the Batch API waves, not from synchronous calls
+    assert services.requests["openai"] == chat_calls
+    store = open_store("products.db", legacy_csv=None)
+    assert all(store.load_checkpoints(url) == {} for url in urls)
@@ -0,0 +1,82 @@
+import pytest
+import pipeline
+from batch import process_url
+from openai_client import get_openai_client
+from product_store import open_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    return open_store(str(tmp_path / "products.db"), legacy_csv=None)
+
+
+@pytest.fixture
+def failing_background_removal(services, scheduler):
+    """Background removal fails without retries until the fixture is switched off."""
+    scheduler.configure("replicate", max_retries=0)
+    services.error_rate["replicate"] = 1.0
+    yield services
+    services.error_rate["replicate"] = 0.0
+
+
+def test_interrupted_run_resumes_from_its_checkpoints(services, store, failing_background_removal):
+    url = services.product_photo_urls(1)[0]
+    client = get_openai_client()
+
+    outcome = process_url(url, client, store)
+
+    assert (outcome["status"], outcome["stage"]) == ("failed", "remove_background")
+    assert set(store.load_checkpoints(url)) == {"identify", "enrich", "search", "select"}
+    calls = {provider: services.requests[provider] for provider in ("openai", "google")}
+
+    services.error_rate["replicate"] = 0.0
+    outcome = process_url(url, client, store)
+
+    assert outcome["status"] == "ok"
+    assert outcome["resumed"][0] == "identify"
+    assert set(outcome["resumed"]) == {"identify", "enrich", "search", "select"}
+    # Text and search stages were not paid for again
+    assert {provider: services.requests[provider] for provider in calls} == calls
+    assert store.get_by_source(url)["processed_image_path"]
+    assert store.load_checkpoints(url) == {}
+
+
+def test_force_discards_the_checkpoints(services, store, failing_background_removal):
+    url = services.product_photo_urls(1)[0]
+    client = get_openai_client()
+    process_url(url, client, store)
+    openai_calls = services.requests["openai"]
+
+    services.error_rate["replicate"] = 0.0
+    outcome = process_url(url, client, store, force=True)
+
+    assert outcome["status"] == "ok" and outcome["resumed"] == []
+    assert services.requests["openai"] > openai_calls
+
+
+def test_product_is_stored_before_its_claim_is_released(services, scheduler, store):
+    url = services.product_photo_urls(1)[0]
+    held = []
+
+    def save(record):
+        product = (record["brand"], record["product_name"])
+        held.append(product in pipeline._in_flight)
+        store.add(record, source_image_url=url)
+
+    record = pipeline.process_product(get_openai_client(), url, store=store, job=store.job(url), save=save)
+
+    assert held == [True]
+    assert (record["brand"], record["product_name"]) not in pipeline._in_flight
+    assert store.get(record["brand"], record["product_name"]) is not None
+
+
+def test_failed_save_releases_the_claim_without_a_record(services, scheduler, store):
+    url = services.product_photo_urls(1)[0]
+
+    def save(record):
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        pipeline.process_product(get_openai_client(), url, store=store, save=save)
+
+    assert pipeline._in_flight == {}
@@ -0,0 +1,130 @@
+import os
+import types
+import itertools
+import pytest
+import download_cache
+from download_cache import DownloadCache, DownloadTooLarge
+
+
+class StubResponse:
+    def __init__(self, status_code, body=b"", headers=None):
+        self.status_code = status_code
+        self.content = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise download_cache.requests.HTTPError(f"HTTP {self.status_code}", response=self)
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class StubSession:
+    """Serves `bodies` with an ETag per body, answering matching If-None-Match with 304."""
+
+    def __init__(self, bodies, content_length=True):
+        self.bodies = bodies
+        self.content_length = content_length
+        self.requests = []
+        self.before_response = None
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        self.requests.append((url, dict(headers or {})))
+        if self.before_response:
+            self.before_response(url, headers or {})
+        body = self.bodies[url]
+        etag = f'"{len(body)}-{hash(body) & 0xffff}"'
+        if (headers or {}).get("If-None-Match") == etag:
+            return StubResponse(304, headers={"ETag": etag})
+        response_headers = {"ETag": etag, "Content-Type": "image/jpeg"}
+        if self.content_length:
+            response_headers["Content-Length"] = str(len(body))
+        return StubResponse(200, body, response_headers)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Strictly increasing wall clock, so LRU order does not depend on timer resolution."""
+    ticks = itertools.count(1_700_000_000)
+    monkeypatch.setattr(download_cache, "time", types.SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def make_cache(tmp_path, bodies, **options):
+    cache = DownloadCache(str(tmp_path / "downloads"), **options)
+    cache.session = StubSession(bodies)
+    return cache
+
+
+def test_cached_body_is_revalidated_with_a_conditional_request(tmp_path, scheduler, clock):
+    cache = make_cache(tmp_path, {"http://a/1.jpg": b"one" * 10}, revalidate_after=0)
+
+    assert cache.fetch("http://a/1.jpg") == b"one" * 10
+    assert cache.fetch("http://a/1.jpg") == b"one" * 10
+
+    (_, first), (_, second) = cache.session.requests
+    assert first == {} and "If-None-Match" in second
+    assert cache.stats() == {"hits": 1, "misses": 1, "bytes_downloaded": 30}
+
+
+def test_recently_validated_body_is_served_without_a_request(tmp_path, scheduler, clock):
+    cache = make_cache(tmp_path, {"http://a/1.jpg": b"one"}, revalidate_after=3600)
+
+    cache.fetch("http://a/1.jpg")
+    cache.fetch("http://a/1.jpg")
+
+    assert len(cache.session.requests) == 1
+
+
+def test_blob_evicted_during_revalidation_is_downloaded_again(tmp_path, scheduler, clock):
+    cache = make_cache(tmp_path, {"http://a/1.jpg": b"one" * 10}, revalidate_after=0)
+    cache.fetch("http://a/1.jpg")
+    blob = cache._blob_path(cache._lookup("http://a/1.jpg")["sha256"])
+
+    def evict_before_304(url, headers):
+        if headers and os.path.exists(blob):
+            os.remove(blob)
+
+    cache.session.before_response = evict_before_304
+
+    assert cache.fetch("http://a/1.jpg") == b"one" * 10
+    headers = [headers for _, headers in cache.session.requests]
+    assert len(headers) == 3 and "If-None-Match" in headers[1] and headers[2] == {}
+    assert os.path.exists(blob)
+
+
+def test_max_bytes_is_enforced_for_downloads_and_cached_bodies(tmp_path, scheduler, clock):
+    bodies = {"http://a/big.jpg": b"x" * 1000, "http://a/streamed.jpg": b"y" * 1000}
+    cache = make_cache(tmp_path, bodies)
+
+    with pytest.raises(DownloadTooLarge):
+        cache.fetch("http://a/big.jpg", max_bytes=100)
+    cache.session.content_length = False
+    with pytest.raises(DownloadTooLarge):
+        cache.fetch("http://a/streamed.jpg", max_bytes=100)
+
+    assert cache.fetch("http://a/big.jpg") == bodies["http://a/big.jpg"]
+    requests_made = len(cache.session.requests)
+    with pytest.raises(DownloadTooLarge):
+        cache.fetch("http://a/big.jpg", max_bytes=100)
+    assert len(cache.session.requests) == requests_made
+
+
+def test_least_recently_used_blobs_are_evicted(tmp_path, scheduler, clock):
+    bodies = {f"http://a/{name}.jpg": name.encode() * 100 for name in "abc"}
+    cache = make_cache(tmp_path, bodies, max_bytes=250, revalidate_after=3600)
+
+    cache.fetch("http://a/a.jpg")
+    cache.fetch("http://a/b.jpg")
+    cache.fetch("http://a/a.jpg")  # a is now more recently used than b
+    cache.fetch("http://a/c.jpg")
+
+    assert cache._lookup("http://a/b.jpg") is None
+    assert cache._lookup("http://a/a.jpg") is not None and cache._lookup("http://a/c.jpg") is not None
@@ -0,0 +1,59 @@
+import threading
+import pytest
+import image_search
+from image_search import search_images
+from response_cache import ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite"), namespace="cse")
+    monkeypatch.setattr(image_search, "get_search_cache", lambda: cache)
+    return cache
+
+
+def test_pages_are_fetched_concurrently_in_page_order(services, scheduler, monkeypatch):
+    services.latency["google"] = 0.2
+    fetch_page = image_search._fetch_page
+    lock = threading.Lock()
+    in_flight = []
+    overlap = []
+
+    def tracked_page(query, start, num):
+        with lock:
+            in_flight.append(start)
+            overlap.append(len(in_flight))
+        try:
+            return fetch_page(query, start, num)
+        finally:
+            with lock:
+                in_flight.remove(start)
+
+    monkeypatch.setattr(image_search, "_fetch_page", tracked_page)
+
+    results = search_images("Acme Widget", num_results=10)
+
+    assert services.requests["google"] == 2
+    assert max(overlap) == 2
+    assert [item["title"] for item in results] == [f"Acme Widget #{rank}" for rank in range(1, 11)]
+
+
+def test_pages_after_a_short_or_failed_page_are_dropped(services, scheduler, cache, monkeypatch):
+    fetch_page = image_search._fetch_page
+    responses = {1: "short"}
+
+    def fake_page(query, start, num):
+        items = fetch_page(query, start, num)
+        outcome = responses.get(start)
+        return items[:2] if outcome == "short" else None if outcome == "failed" else items
+
+    monkeypatch.setattr(image_search, "_fetch_page", fake_page)
+
+    # A short first page is the end of the results, which are complete
+    assert len(search_images("Short Query", num_results=10)) == 2
+    assert cache.get(ResponseCache.make_key(image_search.CX, "short query", 10)) is not None
+
+    responses.clear()
+    responses[6] = "failed"
+    assert len(search_images("Failed Query", num_results=15)) == 5
+    assert cache.get(ResponseCache.make_key(image_search.CX, "failed query", 15)) is None
@@ -0,0 +1,52 @@
+from io import BytesIO
+from PIL import Image, ImageDraw
+from image_selector import ProductImageSelector, REJECTED
+
+
+def packshot(size, box=(0.3, 0.2, 0.7, 0.8), fill=(40, 90, 160)):
+    """A product-like JPEG: a dark shape on a white background."""
+    img = Image.new("RGB", (size, size), (255, 255, 255))
+    x0, y0, x1, y1 = (int(value * size) for value in box)
+    ImageDraw.Draw(img).rectangle((x0, y0, x1, y1), fill=fill)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def selector_for(images, **options):
+    selector = ProductImageSelector(use_index=False, **options)
+    selector.download_image = images.get
+    return selector
+
+
+def test_early_exit_keeps_the_largest_duplicate_like_the_full_scan():
+    images = {
+        "http://shop/small.jpg": packshot(300),
+        "http://cdn/large.jpg": packshot(900),
+        "http://other/side.jpg": packshot(600, box=(0.1, 0.45, 0.9, 0.55), fill=(200, 30, 30)),
+    }
+    urls = list(images)
+    # Thresholds no candidate meets, so every candidate is evaluated
+    early = selector_for(images, early_exit=True, min_quality_score=100)
+    full = selector_for(images)
+
+    evaluations = early.evaluate_images(urls)
+
+    assert evaluations[0] == REJECTED
+    assert evaluations[1][0]
+    assert early.select_best_image("b", "p", urls) == full.select_best_image("b", "p", urls) == "http://cdn/large.jpg"
+
+
+def test_early_exit_stops_at_the_first_good_enough_candidate():
+    images = {f"http://shop/{index}.jpg": packshot(800) if index else packshot(800, box=(0.0, 0.0, 1.0, 1.0))
+              for index in range(4)}
+    downloaded = []
+    selector = selector_for(images, early_exit=True, early_exit_prefetch=0, dedup=False,
+                            min_bg_score=0, min_object_percentage=0, min_quality_score=0)
+    selector.download_image = lambda url: downloaded.append(url) or images[url]
+
+    evaluations = selector.evaluate_images(list(images))
+
+    assert evaluations[1][0]
+    assert evaluations[2:] == [REJECTED, REJECTED]
+    assert downloaded == ["http://shop/0.jpg", "http://shop/1.jpg"]
@@ -0,0 +1,62 @@
+import pytest
+import taxonomy
+from category2 import CATEGORY_HIERARCHY
+from product_store import open_store
+from recategorize import recategorize
+from taxonomy import taxonomy_hash, stale_stage
+
+FIRST, SECOND = list(CATEGORY_HIERARCHY)[:2]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = open_store(str(tmp_path / "products.db"), legacy_csv=None)
+    for index, category1 in enumerate([FIRST, FIRST, SECOND]):
+        store.add({"brand": "B", "product_name": f"P{index}", "description": f"Product number {index}",
+                   "category1": category1, "category2": CATEGORY_HIERARCHY[category1][0],
+                   "taxonomy_hash": taxonomy_hash(category1)})
+    return store
+
+
+def hashes(store):
+    return {record["product_name"]: record["taxonomy_hash"] for record in store.categorized_records()}
+
+
+def test_subcategory_edit_reruns_only_that_branch(services, scheduler, store, monkeypatch):
+    monkeypatch.setattr(taxonomy, "CATEGORY_HIERARCHY",
+                        {**CATEGORY_HIERARCHY, FIRST: CATEGORY_HIERARCHY[FIRST] + ["Brand New Subcategory"]})
+    before = hashes(store)
+
+    assert [stale_stage(record) for record in store.categorized_records()] == ["category2", "category2", None]
+    assert recategorize(store, dry_run=True) == {"category2": 2, "current": 1}
+    assert hashes(store) == before
+
+    outcomes = recategorize(store)
+
+    assert outcomes == {"category2": 2, "current": 1, "failed": 0}
+    # One subcategory request per affected product, no main category requests
+    assert services.requests["openai"] == 2
+    after = hashes(store)
+    assert after["P2"] == before["P2"]
+    assert after["P0"] == after["P1"] == taxonomy.taxonomy_hash(FIRST) != before["P0"]
+    assert recategorize(store) == {"current": 3}
+
+
+def test_main_category_edit_reruns_every_product(services, scheduler, store, monkeypatch):
+    monkeypatch.setattr(taxonomy, "CATEGORIES", taxonomy.CATEGORIES + ["Brand New Category"])
+
+    outcomes = recategorize(store)
+
+    assert outcomes == {"category1": 3, "failed": 0}
+    # Main category and subcategory request per product
+    assert services.requests["openai"] == 6
+    assert all(stale_stage(record) is None for record in store.categorized_records())
+
+
+def test_legacy_records_with_valid_labels_are_only_stamped(services, scheduler, store):
+    store.add({"brand": "Old", "product_name": "Legacy", "description": "Stored before hashes",
+               "category1": SECOND, "category2": CATEGORY_HIERARCHY[SECOND][0]})
+
+    assert recategorize(store) == {"current": 3, "stamped": 1}
+    assert services.requests["openai"] == 0
+    assert hashes(store)["Legacy"] == taxonomy_hash(SECOND)
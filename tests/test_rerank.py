@@ -0,0 +1,75 @@
+import os
+import pytest
+from image_index import FeatureIndex
+from image_selector import ProductImageSelector
+from product_store import open_store
+from rerank import rerank
+
+SCORING = ProductImageSelector().scoring_key()
+
+
+def features(object_area, dhash, width=800, height=800, quality=5.0):
+    return {"stage": "full", "background_percentage": 0.6, "background_brightness": 240, "bg_score": 5.6,
+            "object_area": object_area, "object_percentage": 0.4, "quality_score": quality,
+            "dhash": dhash, "width": width, "height": height, "min_background_brightness": 180}
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    store = open_store(str(tmp_path / "products.db"), legacy_csv=None)
+    index = FeatureIndex(str(tmp_path / "index.sqlite"))
+    store.add({"brand": "B", "product_name": "P", "image_url": "http://a/1.jpg",
+               "processed_image_path": "processed_images/B_P.png"}, source_image_url="http://in/1.jpg")
+    return store, index
+
+
+def add_candidates(index, candidates, scoring=SCORING):
+    for sha, (url, measured) in enumerate(candidates):
+        index.add(url, f"sha-{sha}", scoring, measured)
+    index.record_candidates("B", "P", [url for url, _ in candidates], candidates[0][0])
+
+
+def test_features_of_other_scoring_settings_are_ignored(catalog):
+    store, index = catalog
+    add_candidates(index, [("http://a/1.jpg", features(1000, "00ff00ff00ff00ff")),
+                           ("http://a/2.jpg", features(5000, "ff00ff00ff00ff00"))], scoring="bg=120;px=1;thumb=1")
+
+    outcomes = rerank(store, index, ProductImageSelector(use_index=False), SCORING, process=False)
+
+    assert outcomes == {"other_scoring": 1}
+    assert store.get("B", "P")["image_url"] == "http://a/1.jpg"
+
+
+def test_near_duplicates_are_dropped_like_in_selection(catalog):
+    store, index = catalog
+    # 2.jpg is a small copy of 1.jpg whose measured object came out larger
+    add_candidates(index, [("http://a/1.jpg", features(1000, "00ff00ff00ff00ff", width=1600, height=1600)),
+                           ("http://a/2.jpg", features(1200, "00ff00ff00ff00fe", width=400, height=400))])
+
+    outcomes = rerank(store, index, ProductImageSelector(use_index=False), SCORING, process=False)
+
+    assert outcomes == {"unchanged": 1}
+
+
+def test_changed_product_loses_its_stale_cutout_until_processed(catalog, services, scheduler):
+    store, index = catalog
+    new_url = services.image_url("rerank-2.jpg")
+    add_candidates(index, [("http://a/1.jpg", features(1000, "00ff00ff00ff00ff")),
+                           (new_url, features(5000, "ff00ff00ff00ff00"))])
+    selector = ProductImageSelector(use_index=False)
+
+    outcomes = rerank(store, index, selector, SCORING, process=False)
+
+    assert outcomes == {"changed": 1}
+    record = store.get("B", "P")
+    assert record["image_url"] == new_url
+    assert record["processed_image_path"] is None
+
+    # The next run with processing picks up the product left without a cut-out
+    outcomes = rerank(store, index, selector, SCORING)
+
+    assert outcomes == {"unchanged": 1, "missing_cutout": 1}
+    record = store.get("B", "P")
+    assert record["image_url"] == new_url
+    assert record["processed_image_path"] and os.path.exists(record["processed_image_path"])
+    assert rerank(store, index, selector, SCORING) == {"unchanged": 1}
@@ -0,0 +1,132 @@
+import types
+import pytest
+import scheduler as scheduler_module
+from scheduler import Scheduler, ProviderUnavailable, QuotaExceeded
+
+
+class FakeClock:
+    """Stands in for the time module: sleeping advances the clock instead of waiting."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1_700_000_000 + self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def strftime(self, fmt):
+        return f"day-{int(self.now // 86400)}"
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.response = types.SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler_module, "time", clock)
+    # Jitter at the middle of its range
+    monkeypatch.setattr(scheduler_module.random, "uniform", lambda low, high: (low + high) / 2)
+    return clock
+
+
+def failing(*errors, result="ok"):
+    """A callable that raises `errors` one per call, then returns `result`."""
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    fn.calls = calls
+    return fn
+
+
+def test_token_bucket_spaces_requests_at_the_configured_rate(clock):
+    gate = Scheduler({"api": {"requests_per_minute": 60}})
+
+    for _ in range(3):
+        assert gate.call("api", lambda: "ok") == "ok"
+
+    assert clock.sleeps == [1.0, 1.0]
+
+
+def test_retry_after_pauses_every_caller_of_the_provider(clock):
+    gate = Scheduler({"api": {"max_retries": 3}})
+    fn = failing(HTTPError(429, {"retry-after": "3"}))
+
+    assert gate.call("api", fn) == "ok"
+    # Retry-After plus half of base_delay of jitter
+    assert clock.sleeps == [3.5]
+    assert gate.providers["api"].paused_until == 3.0
+
+    gate.providers["api"].pause(5)
+    gate.call("api", lambda: None)
+    assert clock.sleeps[-1] == 5.0
+
+
+def test_transient_errors_back_off_exponentially_then_give_up(clock):
+    gate = Scheduler({"api": {"max_retries": 3, "base_delay": 1.0}})
+    fn = failing(*[ConnectionError("reset")] * 4)
+
+    with pytest.raises(ProviderUnavailable) as error:
+        gate.call("api", fn)
+
+    assert error.value.provider == "api"
+    assert len(fn.calls) == 4
+    assert clock.sleeps == [1.0, 2.0, 4.0]
+
+
+def test_server_errors_are_retried_and_client_errors_are_not(clock):
+    gate = Scheduler({"api": {"max_retries": 3}})
+    assert gate.call("api", failing(HTTPError(503), HTTPError(500))) == "ok"
+
+    fn = failing(HTTPError(400))
+    with pytest.raises(HTTPError):
+        gate.call("api", fn)
+    assert len(fn.calls) == 1
+
+
+def test_daily_quota_is_enforced_and_resets_the_next_day(clock):
+    gate = Scheduler({"api": {"daily_quota": 2}})
+    fn = failing()
+    gate.call("api", fn)
+    gate.call("api", fn)
+
+    with pytest.raises(QuotaExceeded):
+        gate.call("api", fn)
+    assert len(fn.calls) == 2
+
+    clock.now += 86400
+    assert gate.call("api", fn) == "ok"
+
+
+def test_none_in_the_environment_removes_concurrency_limits(clock, monkeypatch):
+    monkeypatch.setattr(scheduler_module, "_scheduler", None)
+    monkeypatch.setenv("REPLICATE_MAX_IN_FLIGHT", "none")
+    monkeypatch.setenv("SCHEDULER_MAX_IN_FLIGHT", "none")
+
+    gate = scheduler_module.get_scheduler()
+
+    assert gate.providers["replicate"].in_flight is None and gate.in_flight is None
+    assert gate.call("replicate", lambda: "ok") == "ok"
+
+
+def test_none_is_rejected_for_retries(clock, monkeypatch):
+    monkeypatch.setattr(scheduler_module, "_scheduler", None)
+    monkeypatch.setenv("OPENAI_MAX_RETRIES", "none")
+
+    with pytest.raises(ValueError, match="openai: max_retries cannot be unlimited"):
+        scheduler_module.get_scheduler()
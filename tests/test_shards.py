@@ -0,0 +1,79 @@
+import os
+import pytest
+from product_store import ProductStore, open_store, PROCESSED_IMAGES_DIR
+from shards import merge_shards, shard_dir, select_shard, SHARD_STORE
+
+SHARED = {"brand": "Both", "product_name": "Shared"}
+
+
+def write_shard(root, index, count, products):
+    """Write a shard's store and processed images, as batch.py --shard would."""
+    workdir = shard_dir(str(root), index, count)
+    os.makedirs(os.path.join(workdir, PROCESSED_IMAGES_DIR), exist_ok=True)
+    store = ProductStore(os.path.join(workdir, SHARD_STORE))
+    for source, record in products:
+        filename = f"{record['brand']}_{record['product_name']}.png"
+        with open(os.path.join(workdir, PROCESSED_IMAGES_DIR, filename), "wb") as image:
+            image.write(f"{index}:{record['description']}".encode())
+        store.add({**record, "processed_image_path": os.path.join(workdir, PROCESSED_IMAGES_DIR, filename)},
+                  source_image_url=source)
+
+
+SHARDS = {
+    1: [("http://in/1.jpg", {"brand": "One", "product_name": "Only", "description": "first shard"}),
+        ("http://in/2.jpg", {**SHARED, "description": "from shard 1", "image_url": "http://a/1.jpg"})],
+    2: [("http://in/3.jpg", {**SHARED, "description": "from shard 2", "image_url": "http://a/2.jpg"}),
+        ("http://in/4.jpg", {"brand": "Two", "product_name": "Only", "description": "second shard"})],
+}
+
+
+def merged(tmp_path, name, order):
+    root = tmp_path / name / "shards"
+    for index in order:
+        write_shard(root, index, 2, SHARDS[index])
+    store = open_store(str(tmp_path / name / "products.db"), legacy_csv=None)
+    image_dir = str(tmp_path / name / "images")
+    totals = merge_shards(str(root), store, image_dir=image_dir)
+    return store, image_dir, totals
+
+
+def snapshot(store, image_dir):
+    records = [{key: (os.path.basename(value) if key == "processed_image_path" and value else value)
+                for key, value in record.items()} for record in store.records()]
+    images = {name: open(os.path.join(image_dir, name), "rb").read() for name in sorted(os.listdir(image_dir))}
+    return records, store.sources(), images
+
+
+def test_merge_is_independent_of_shard_creation_order(tmp_path):
+    forward = merged(tmp_path, "forward", [1, 2])
+    backward = merged(tmp_path, "backward", [2, 1])
+
+    assert snapshot(*forward[:2]) == snapshot(*backward[:2])
+    assert forward[2] == backward[2] == {"shards": 2, "products": 3, "sources": 4, "images": 3}
+
+
+def test_product_in_both_shards_keeps_the_last_shards_record(tmp_path):
+    store, image_dir, _ = merged(tmp_path, "merge", [2, 1])
+
+    shared = store.get("Both", "Shared")
+    assert shared["description"] == "from shard 2" and shared["image_url"] == "http://a/2.jpg"
+    with open(shared["processed_image_path"], "rb") as image:
+        assert image.read() == b"2:from shard 2"
+    assert store.sources()[("Both", "Shared")] == ["http://in/2.jpg", "http://in/3.jpg"]
+
+
+def test_merging_again_changes_nothing(tmp_path):
+    store, image_dir, _ = merged(tmp_path, "merge", [1, 2])
+    before = snapshot(store, image_dir)
+
+    totals = merge_shards(str(tmp_path / "merge" / "shards"), store, image_dir=image_dir)
+
+    assert snapshot(store, image_dir) == before
+    assert totals["images"] == 0
+
+
+def test_every_url_lands_in_exactly_one_shard():
+    urls = [f"http://in/{index}.jpg" for index in range(200)]
+    shards = [select_shard(urls, index, 4) for index in range(1, 5)]
+    assert sorted(url for shard in shards for url in shard) == sorted(urls)
+    assert all(shards)
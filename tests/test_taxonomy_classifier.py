@@ -0,0 +1,72 @@
+import pytest
+from taxonomy_classifier import TaxonomyClassifier, product_text
+
+HIERARCHY = {"Food": ["Snacks", "Drinks"], "Home": ["Cleaning", "Kitchen"]}
+
+
+def catalog():
+    products = []
+    for index in range(20):
+        products.append(("Crunchy", f"Salted potato crisps {index}", "Food", "Snacks"))
+        products.append(("Sparkle", f"Lemon soda water {index}", "Food", "Drinks"))
+        products.append(("Shine", f"Kitchen surface cleaner spray {index}", "Home", "Cleaning"))
+    return products
+
+
+@pytest.fixture
+def classifier():
+    classifier = TaxonomyClassifier(HIERARCHY)
+    for brand, product_name, category1, category2 in catalog():
+        classifier.add(product_text(brand, product_name), category1, category2)
+    return classifier
+
+
+def test_predicts_the_category_of_close_neighbours(classifier):
+    assert classifier.predict_category1("Crunchy salted potato crisps")[0] == "Food"
+    assert classifier.predict_category2("Shine kitchen cleaner spray", "Home")[0] == "Cleaning"
+    assert classifier.predict_category1("Completely unrelated garden hose")[0] is None
+
+
+def test_added_products_are_found_without_rebuilding_the_index(classifier, monkeypatch):
+    classifier.predict_category1("warm up")
+    refreshes = []
+    refresh = classifier._refresh_weights
+    monkeypatch.setattr(classifier, "_refresh_weights", lambda: refreshes.append(1) or refresh())
+
+    for index in range(3):
+        classifier.add(f"Copper frying pan nonstick {index}", "Home", "Kitchen")
+
+    assert classifier.predict_category2("Copper frying pan nonstick", "Home")[0] == "Kitchen"
+    score, _, category2 = classifier.neighbours("Copper frying pan nonstick 1")[0]
+    assert category2 == "Kitchen" and score == pytest.approx(1.0)
+    assert refreshes == []
+
+
+def test_idf_is_recomputed_once_the_catalog_has_grown(classifier, monkeypatch):
+    classifier.predict_category1("warm up")
+    refreshes = []
+    refresh = classifier._refresh_weights
+    monkeypatch.setattr(classifier, "_refresh_weights", lambda: refreshes.append(1) or refresh())
+
+    grown = int(len(classifier) * classifier.idf_refresh) + 1
+    for index in range(grown):
+        classifier.add(f"Copper frying pan nonstick {index}", "Home", "Kitchen")
+        classifier.predict_category1("Copper frying pan")
+
+    assert refreshes == [1]
+
+
+def test_refreshed_weights_match_a_classifier_built_at_once(classifier):
+    classifier.predict_category1("warm up")
+    classifier.add("Copper frying pan nonstick", "Home", "Kitchen")
+    classifier._refresh_weights()
+    fresh = TaxonomyClassifier(HIERARCHY)
+    for brand, product_name, category1, category2 in catalog():
+        fresh.add(product_text(brand, product_name), category1, category2)
+    fresh.add("Copper frying pan nonstick", "Home", "Kitchen")
+
+    def rounded(neighbours):
+        return [(round(score, 9), category1, category2) for score, category1, category2 in neighbours]
+
+    for query in ("Lemon soda water", "Copper pan"):
+        assert rounded(classifier.neighbours(query)) == rounded(fresh.neighbours(query))